@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+"""
+End-to-end performance benchmarks
+
+Runs offline against a throwaway test database and media directory, so it
+never touches real uploads:
+
+- upload:  upload_file POST until the inference job is done (p50/p95/p99)
+           at several concurrency levels, with in-process job workers
+- frames:  gen_frames MJPEG output FPS from a file-backed VideoCapture
+- gallery: list_files render time with 10k / 100k UploadedImage rows
+- model:   raw predict latency per inference backend
+
+Uses the images / video given, or generates a deterministic synthetic set.
+Results are written as JSON; --compare flags regressions against an
+earlier run and exits non-zero.
+
+    python benchmark.py
+    python benchmark.py --only upload frames --images media/uploads --video site.mp4
+    python benchmark.py --compare benchmarks/baseline.json --tolerance 0.2
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import itertools
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ppe_project.settings')
+os.environ.setdefault('YOLO_CONFIG_DIR', '/tmp')
+os.environ.setdefault('OPENCV_LOG_LEVEL', 'ERROR')
+sys.path.insert(0, str(Path(__file__).parent))
+
+import cv2
+import numpy as np
+import django
+
+django.setup()
+
+from django.conf import settings
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment, override_settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.urls import reverse
+
+SECTIONS = ('upload', 'frames', 'gallery', 'model')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def percentiles(samples):
+    """mean/p50/p95/p99/max in milliseconds for durations in seconds"""
+    if not samples:
+        return {'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+    values = np.array(samples) * 1000
+    return {
+        'mean': round(float(values.mean()), 2),
+        'p50': round(float(np.percentile(values, 50)), 2),
+        'p95': round(float(np.percentile(values, 95)), 2),
+        'p99': round(float(np.percentile(values, 99)), 2),
+        'max': round(float(values.max()), 2),
+    }
+
+
+def make_test_assets(directory, seed=0):
+    """Deterministic synthetic images (several sizes) and a short video with moving shapes"""
+    rng = np.random.default_rng(seed)
+    images = []
+    for index, (width, height) in enumerate([(640, 480), (1280, 720), (1920, 1080)]):
+        image = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+        for _ in range(8):
+            x, y = int(rng.integers(0, width - 100)), int(rng.integers(0, height - 200))
+            cv2.rectangle(image, (x, y), (x + 80, y + 180), tuple(int(c) for c in rng.integers(0, 255, 3)), -1)
+        path = os.path.join(directory, f'synthetic_{index}.jpg')
+        cv2.imwrite(path, image)
+        images.append(path)
+
+    video = os.path.join(directory, 'synthetic.avi')
+    writer = cv2.VideoWriter(video, cv2.VideoWriter_fourcc(*'MJPG'), 15, (640, 480))
+    background = rng.integers(0, 255, (480, 640, 3), dtype=np.uint8)
+    for frame_index in range(150):
+        frame = background.copy()
+        x = 20 + frame_index * 3
+        cv2.rectangle(frame, (x, 150), (x + 80, 330), (0, 200, 255), -1)
+        writer.write(frame)
+    writer.release()
+    return images, video
+
+
+def find_images(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            files.append(path)
+    return [path for path in files if cv2.imread(path) is not None]
+
+
+class LoopingCapture:
+    """File-backed stand-in for a webcam: rewinds at the end of the file"""
+
+    def __init__(self, path):
+        self.capture = cv2.VideoCapture(path)
+
+    def isOpened(self):
+        return self.capture.isOpened()
+
+    def read(self):
+        success, frame = self.capture.read()
+        if not success:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            success, frame = self.capture.read()
+        return success, frame
+
+    def set(self, *args):
+        return self.capture.set(*args)
+
+    def release(self):
+        self.capture.release()
+
+
+_payload_counter = itertools.count()
+
+
+def unique_jpegs(image_paths, count):
+    """`count` JPEG payloads that all hash differently, so the result cache can't short-circuit them"""
+    encoded = [cv2.imencode('.jpg', cv2.imread(path))[1].tobytes() for path in image_paths]
+    payloads = []
+    for index in range(count):
+        # A COM segment right after SOI: same pixels, different bytes
+        comment = f'benchmark {next(_payload_counter)}'.encode()
+        jpeg = encoded[index % len(encoded)]
+        payloads.append(jpeg[:2] + b'\xff\xfe' + (len(comment) + 2).to_bytes(2, 'big') + comment + jpeg[2:])
+    return payloads
+
+
+def bench_upload(image_paths, levels, requests_per_level, poll_interval):
+    """upload_file POST -> job done latency, with the inference workers running as threads in this process"""
+    from myapp.jobs import worker_loop
+    from myapp.models import UploadedImage
+
+    stop = threading.Event()
+    workers = [threading.Thread(target=worker_loop, kwargs={'poll_interval': poll_interval, 'stop_event': stop},
+                                daemon=True)
+               for _ in range(settings.INFERENCE_WORKER_THREADS)]
+    for worker in workers:
+        worker.start()
+
+    def upload(payload):
+        client = Client()
+        started = time.perf_counter()
+        response = client.post(reverse('upload_file'),
+                               {'file': SimpleUploadedFile('benchmark.jpg', payload, 'image/jpeg')},
+                               HTTP_ACCEPT='application/json')
+        accepted = time.perf_counter()
+        job_id = response.json()['job_id']
+        while True:
+            status = UploadedImage.objects.filter(id=job_id).values_list('status', flat=True).first()
+            if status in (UploadedImage.STATUS_DONE, UploadedImage.STATUS_FAILED):
+                break
+            time.sleep(0.005)
+        finished = time.perf_counter()
+        connections.close_all()
+        return accepted - started, finished - started, status == UploadedImage.STATUS_DONE
+
+    results = {}
+    try:
+        for concurrency in levels:
+            payloads = unique_jpegs(image_paths, requests_per_level)
+            started = time.perf_counter()
+            with ThreadPoolExecutor(concurrency) as pool:
+                samples = list(pool.map(upload, payloads))
+            elapsed = time.perf_counter() - started
+            level = results[f'concurrency_{concurrency}'] = {
+                'requests': len(samples),
+                'failed': sum(1 for _, _, ok in samples if not ok),
+                'request_ms': percentiles([request for request, _, _ in samples]),
+                'latency_ms': percentiles([total for _, total, _ in samples]),
+                'throughput_per_s': round(len(samples) / elapsed, 2),
+            }
+            print(f"  upload x{concurrency:<3} p50 {level['latency_ms']['p50']:>9.1f} ms  "
+                  f"p99 {level['latency_ms']['p99']:>9.1f} ms  {level['throughput_per_s']:>6.2f}/s")
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join(timeout=30)
+    return {'poll_interval_s': poll_interval, 'worker_threads': len(workers), 'levels': results}
+
+
+def bench_frames(video, frames, warmup_frames=10):
+    """Encoded MJPEG frames per second out of gen_frames for a file-backed capture"""
+    from myapp.views import gen_frames
+    from myapp.streaming import camera_stats
+
+    stream = gen_frames(source_key='benchmark', open_source=lambda: LoopingCapture(video))
+    try:
+        for _ in range(warmup_frames):
+            next(stream)
+        started = time.perf_counter()
+        sizes = [len(next(stream)) for _ in range(frames)]
+        elapsed = time.perf_counter() - started
+        pipeline = camera_stats()
+    finally:
+        stream.close()
+    result = {
+        'frames': frames,
+        'fps': round(frames / elapsed, 2),
+        'mean_part_kb': round(sum(sizes) / len(sizes) / 1024, 1),
+        'pipeline': pipeline,
+    }
+    print(f"  gen_frames {result['fps']:.1f} fps")
+    return result
+
+
+def bench_gallery(row_counts, runs, image_path):
+    """list_files render time as the number of UploadedImage rows grows"""
+    from myapp.models import UploadedImage
+
+    with open(image_path, 'rb') as image_file:
+        stored = default_storage.save('uploads/benchmark_gallery.jpg', ContentFile(image_file.read()))
+    client = Client()
+    results = {}
+    for rows in sorted(row_counts):
+        missing = rows - UploadedImage.objects.count()
+        for start in range(0, max(0, missing), 5000):
+            UploadedImage.objects.bulk_create([
+                # Every row points at the same real file, like real uploads would
+                UploadedImage(original_image=stored, processed_image=stored, status=UploadedImage.STATUS_DONE,
+                              detection_results=[])
+                for _ in range(min(5000, missing - start))
+            ])
+        samples = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            response = client.get(reverse('list_files'))
+            samples.append(time.perf_counter() - started)
+        results[f'rows_{rows}'] = {
+            'rows': UploadedImage.objects.count(),
+            'render_ms': percentiles(samples),
+            'response_kb': round(len(response.content) / 1024, 1),
+        }
+        print(f"  list_files with {rows} rows: {results[f'rows_{rows}']['render_ms']['p50']:.0f} ms")
+    return results
+
+
+def bench_model(image_paths, backends, runs):
+    from myapp.backends import compare_backends
+
+    images = [cv2.imread(path) for path in image_paths]
+    report = compare_backends(settings.YOLO_MODEL_PATH, backends, images, runs=runs, export_missing=False)
+    for backend, entry in report['backends'].items():
+        if 'error' in entry:
+            print(f"  {backend:<14} unavailable: {entry['error']}")
+        else:
+            print(f"  {backend:<14} mean {entry['latency_ms']['mean']:>8.1f} ms  p95 {entry['latency_ms']['p95']:>8.1f} ms")
+    return report
+
+
+def metadata():
+    import torch
+    import ultralytics
+    from myapp.scheduler import available_cpus
+    from myapp.registry import DEFAULT_MODEL, model_config, weights_fingerprint, backend_version
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        commit = ''
+    path, backend = model_config(DEFAULT_MODEL)
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': commit,
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'ultralytics': ultralytics.__version__,
+        'cpus': available_cpus(),
+        'backend': backend,
+        'model_version': backend_version(weights_fingerprint(path), backend),
+        'max_batch_size': settings.INFERENCE_MAX_BATCH_SIZE,
+    }
+
+
+def flatten(report, prefix=''):
+    flat = {}
+    for key, value in report.items():
+        path = f'{prefix}.{key}' if prefix else str(key)
+        if isinstance(value, dict):
+            flat.update(flatten(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def direction(path):
+    """+1 if higher is better, -1 if lower is better, 0 for counts and other context"""
+    parts = path.split('.')
+    if parts[0] == 'meta' or 'pipeline' in parts:
+        return 0
+    if 'fps' in parts[-1] or 'throughput' in parts[-1]:
+        return 1
+    if any(part.endswith('_ms') for part in parts[:-1]) and parts[-1] in ('mean', 'p50', 'p95', 'p99'):
+        return -1
+    return 0
+
+
+def regressions(baseline, current, tolerance):
+    """Metrics that got worse than the baseline by more than `tolerance` (a fraction)"""
+    before, after = flatten(baseline), flatten(current)
+    found = []
+    for path, value in after.items():
+        sign, old = direction(path), before.get(path)
+        if not sign or not old:
+            continue
+        change = (value - old) / old
+        if change * sign < -tolerance:
+            found.append({'metric': path, 'baseline': old, 'current': value, 'change': round(change, 3)})
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--only', nargs='+', choices=SECTIONS, default=list(SECTIONS), help='Benchmarks to run')
+    parser.add_argument('--images', nargs='+', help='Image files or directories (default: synthetic images)')
+    parser.add_argument('--video', help='Video file for the gen_frames benchmark (default: synthetic video)')
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 16], help='upload_file concurrency levels')
+    parser.add_argument('--requests', type=int, default=32, help='Uploads per concurrency level')
+    parser.add_argument('--poll-interval', type=float, default=None,
+                        help='Job worker poll interval (default: INFERENCE_POLL_INTERVAL)')
+    parser.add_argument('--frames', type=int, default=150, help='Frames to time in the gen_frames benchmark')
+    parser.add_argument('--gallery-rows', nargs='+', type=int, default=[10000, 100000], help='Row counts for list_files')
+    parser.add_argument('--gallery-runs', type=int, default=3, help='Timed renders per row count')
+    parser.add_argument('--backends', nargs='+', default=['torch'], help='Backends for the raw model benchmark')
+    parser.add_argument('--model-runs', type=int, default=5, help='Timed predictions per image and backend')
+    parser.add_argument('--output', help='JSON report path (default: benchmarks/<timestamp>.json)')
+    parser.add_argument('--compare', help='Earlier JSON report to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative slowdown before a regression')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='ppe_benchmark_')
+    synthetic_images, synthetic_video = make_test_assets(scratch)
+    image_paths = find_images(args.images) if args.images else synthetic_images
+    if not image_paths:
+        sys.exit('No readable images to benchmark with')
+    video = args.video or synthetic_video
+
+    # A throwaway database and media directory; sqlite gets a file so worker threads can share it
+    setup_test_environment()
+    if connection.vendor == 'sqlite':
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(scratch, 'benchmark.sqlite3')
+    old_database = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    report = {'meta': metadata()}
+    try:
+        with override_settings(MEDIA_ROOT=os.path.join(scratch, 'media')):
+            from myapp.inference import get_inference_engine
+            if get_inference_engine() is None:
+                sys.exit('The model could not be loaded')
+            if 'model' in args.only:
+                print('Raw model latency...')
+                report['model'] = bench_model(image_paths, args.backends, args.model_runs)
+            if 'upload' in args.only:
+                print('upload_file end to end...')
+                poll_interval = args.poll_interval if args.poll_interval is not None else settings.INFERENCE_POLL_INTERVAL
+                report['upload'] = bench_upload(image_paths, args.concurrency, args.requests, poll_interval)
+            if 'frames' in args.only:
+                print('gen_frames...')
+                report['frames'] = bench_frames(video, args.frames)
+            if 'gallery' in args.only:
+                print('list_files...')
+                report['gallery'] = bench_gallery(args.gallery_rows, args.gallery_runs, image_paths[0])
+    finally:
+        connections.close_all()
+        connection.creation.destroy_test_db(old_database, verbosity=0)
+        teardown_test_environment()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    output = args.output or os.path.join('benchmarks', f"{report['meta']['timestamp'].replace(':', '')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f'Report written to {output}')
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            found = regressions(json.load(baseline_file), report, args.tolerance)
+        for regression in found:
+            print(f"REGRESSION {regression['metric']}: {regression['baseline']} -> {regression['current']} "
+                  f"({regression['change']:+.0%})")
+        if found:
+            sys.exit(1)
+        print(f'No regressions beyond {args.tolerance:.0%} against {args.compare}')
+
+
+if __name__ == '__main__':
+    main()
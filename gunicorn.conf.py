@@ -0,0 +1,26 @@
+"""
+Gunicorn configuration
+
+The app (and with it the YOLO weights) is loaded once in the master and
+forked into the workers, which share the weights copy-on-write. Use
+measure_memory.py to see how much memory each extra worker really costs.
+"""
+
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', '4'))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))  # concurrent requests per worker, batched by its engine
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+preload_app = True
+
+
+def when_ready(server):
+    # Runs in the master after the app is imported and before any worker is forked
+    from myapp.preload import preload_models
+    preload_models()
+
+
+def post_fork(server, worker):
+    from myapp.preload import init_worker_process
+    init_worker_process(server.cfg.workers)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Report how much memory each web/inference worker really costs
+
+Reads /proc/<pid>/smaps_rollup (Linux) for a master process and its forked
+children. Pages shared copy-on-write with the master (the preloaded model
+weights) show up as "shared"; "private" is what each extra worker adds.
+
+    python measure_memory.py                # finds the gunicorn master
+    python measure_memory.py --pattern run_inference_workers
+    python measure_memory.py --pid 1234 --json
+"""
+
+import os
+import sys
+import json
+import argparse
+
+FIELDS = ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty', 'Swap')
+
+
+def read_rollup(pid):
+    """Memory totals of a process in KiB"""
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as rollup:
+        for line in rollup:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].rstrip(':') in FIELDS:
+                values[parts[0].rstrip(':')] = int(parts[1])
+    return {
+        'rss': values.get('Rss', 0),
+        'pss': values.get('Pss', 0),
+        'shared': values.get('Shared_Clean', 0) + values.get('Shared_Dirty', 0),
+        'private': values.get('Private_Clean', 0) + values.get('Private_Dirty', 0),
+        'swap': values.get('Swap', 0),
+    }
+
+
+def cmdline(pid):
+    with open(f'/proc/{pid}/cmdline', 'rb') as command:
+        return command.read().replace(b'\0', b' ').decode(errors='replace').strip()
+
+
+def parent_pid(pid):
+    with open(f'/proc/{pid}/stat') as stat:
+        # The command name may contain spaces, the fields after it don't
+        return int(stat.read().rsplit(')', 1)[1].split()[1])
+
+
+def all_pids():
+    return [int(entry) for entry in os.listdir('/proc') if entry.isdigit()]
+
+
+def find_master(pattern):
+    """The matching process with the most matching children (gunicorn master, worker supervisor)"""
+    matches = set()
+    for pid in all_pids():
+        try:
+            command = cmdline(pid)
+        except OSError:
+            continue
+        if pid != os.getpid() and pattern in command and 'measure_memory' not in command:
+            matches.add(pid)
+    forks = {}
+    for pid in matches:
+        try:
+            forks.setdefault(parent_pid(pid), []).append(pid)
+        except OSError:
+            continue
+    candidates = [(len(forks.get(pid, [])), -pid) for pid in matches]
+    return -max(candidates)[1] if candidates else None
+
+
+def children(pid):
+    found = []
+    for candidate in all_pids():
+        try:
+            if parent_pid(candidate) == pid:
+                found.append(candidate)
+        except OSError:
+            continue
+    return sorted(found)
+
+
+def measure(master):
+    workers = children(master)
+    report = {'master': {'pid': master, **read_rollup(master)}, 'workers': []}
+    for pid in workers:
+        try:
+            report['workers'].append({'pid': pid, **read_rollup(pid)})
+        except OSError:
+            continue
+    private = [worker['private'] for worker in report['workers']]
+    report['summary'] = {
+        'workers': len(private),
+        'mean_worker_private_kb': round(sum(private) / len(private)) if private else 0,
+        # What the pod actually pays: everything private plus the shared pages once
+        'total_pss_kb': report['master']['pss'] + sum(worker['pss'] for worker in report['workers']),
+    }
+    return report
+
+
+def print_report(report):
+    mb = lambda kb: f'{kb / 1024:9.1f}'
+    print(f"{'process':<16}{'rss MB':>10}{'pss MB':>10}{'shared MB':>10}{'private MB':>11}")
+    rows = [('master', report['master'])] + [('worker', worker) for worker in report['workers']]
+    for label, row in rows:
+        print(f"{label + ' ' + str(row['pid']):<16}{mb(row['rss'])} {mb(row['pss'])} {mb(row['shared'])}  {mb(row['private'])}")
+    summary = report['summary']
+    print(f"\n{summary['workers']} worker(s), each adds ~{summary['mean_worker_private_kb'] / 1024:.1f} MB private memory; "
+          f"total PSS {summary['total_pss_kb'] / 1024:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pid', type=int, help='Master process id')
+    parser.add_argument('--pattern', default='gunicorn', help='Command line to look for when --pid is not given')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    if not os.path.exists('/proc/self/smaps_rollup'):
+        sys.exit('measure_memory.py needs Linux /proc/<pid>/smaps_rollup (kernel 4.14+)')
+    master = args.pid or find_master(args.pattern)
+    if master is None:
+        sys.exit(f'No running process matches {args.pattern!r}')
+
+    report = measure(master)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 from django.contrib import admin
-from .models import UploadedImage
+from .models import UploadedImage, Detection
 
 # Register your models here.
 
 admin.site.register(UploadedImage)
+admin.site.register(Detection)
@@ -0,0 +1,147 @@
+"""
+Inference backends
+
+The same YOLO weights can be served by PyTorch (`torch`), ONNX Runtime
+(`onnx`) or Intel OpenVINO (`openvino`), chosen with settings.YOLO_BACKEND.
+Exported models sit next to the .pt file using the ultralytics naming
+(`model.onnx`, `model_openvino_model/`, and `model_int8.onnx` /
+`model_int8_openvino_model/` for the INT8 models promoted by the
+quantize_model command) and are loaded through
+`ultralytics.YOLO`, so every backend returns the same Results objects and
+views, batching and caching don't care which one is active.
+"""
+
+import os
+import time
+import logging
+import numpy as np
+from ultralytics import YOLO
+from .batching import summarize
+from .tracking import iou
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Backend name -> ultralytics export format
+BACKENDS = {
+    'torch': None,
+    'onnx': 'onnx',
+    'openvino': 'openvino',
+    # Only produced by the quantize_model command, never exported on the fly
+    'onnx_int8': None,
+    'openvino_int8': None,
+}
+
+
+def check_backend(backend):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown YOLO backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+    return backend
+
+
+def exported_path(weights_path, backend):
+    """Where the exported model for a backend lives (the .pt file itself for torch)"""
+    stem, _ = os.path.splitext(weights_path)
+    if check_backend(backend) == 'onnx':
+        return f'{stem}.onnx'
+    if backend == 'openvino':
+        return f'{stem}_openvino_model'
+    if backend == 'onnx_int8':
+        return f'{stem}_int8.onnx'
+    if backend == 'openvino_int8':
+        return f'{stem}_int8_openvino_model'
+    return weights_path
+
+
+def export_backend(weights_path, backend, imgsz=640):
+    """Export the .pt weights for a backend and return the exported path"""
+    if check_backend(backend).endswith('_int8'):
+        raise ValueError(f"{backend} models are created by the quantize_model command")
+    if BACKENDS[backend] is None:
+        return weights_path
+    logger.info(f"Exporting {weights_path} to {backend}")
+    # Dynamic axes so the batching engine can send batches of any size
+    return YOLO(weights_path).export(format=BACKENDS[backend], imgsz=imgsz, dynamic=True, verbose=False)
+
+
+def load_backend(backend, weights_path, export_missing=False, imgsz=640):
+    """Load the weights through the given backend, exporting them first if allowed"""
+    started = time.monotonic()
+    path = exported_path(weights_path, backend)
+    if not os.path.exists(path):
+        if backend.endswith('_int8'):
+            raise FileNotFoundError(f"No {backend} model at {path}; run the quantize_model command")
+        if not export_missing:
+            raise FileNotFoundError(f"No {backend} export at {path}; run setup_model.py with YOLO_BACKEND={backend}")
+        path = export_backend(weights_path, backend, imgsz)
+    model = YOLO(path, task='detect')
+    model.backend_name = backend
+    # The .pt file the export came from, which is what the model version is derived from
+    model.weights_path = weights_path
+    model.load_seconds = time.monotonic() - started
+    return model
+
+
+def validate_backend(model, imgsz=640):
+    """Run one dummy prediction so a broken export fails at build time, not on the first request"""
+    model.predict([np.zeros((imgsz, imgsz, 3), dtype=np.uint8)] * 2, verbose=False)
+    return True
+
+
+def detection_agreement(reference, candidate, iou_threshold=0.5):
+    """F1 of candidate detections against reference ones (same class, IoU >= threshold)"""
+    if not reference and not candidate:
+        return 1.0
+    unmatched = list(candidate)
+    matched = 0
+    for expected in reference:
+        for index, detection in enumerate(unmatched):
+            if detection['class_id'] == expected['class_id'] and iou(detection['box'], expected['box']) >= iou_threshold:
+                matched += 1
+                del unmatched[index]
+                break
+    return 2 * matched / (len(reference) + len(candidate))
+
+
+def compare_backends(weights_path, backends, images, runs=3, imgsz=640, export_missing=True):
+    """
+    Time each backend on the same images and measure how closely its
+    detections agree with the first backend in the list.
+    """
+    from .inference import extract_detections
+
+    report = {'weights': weights_path, 'images': len(images), 'runs': runs, 'backends': {}}
+    reference = None
+    for backend in backends:
+        try:
+            model = load_backend(backend, weights_path, export_missing=export_missing, imgsz=imgsz)
+            # Warm-up run, not timed
+            model.predict(images[0], verbose=False)
+        except Exception as e:
+            logger.error(f"Backend {backend} unavailable: {str(e)}")
+            report['backends'][backend] = {'error': str(e)}
+            continue
+
+        latencies = []
+        detections = []
+        for image in images:
+            for run in range(runs):
+                started = time.perf_counter()
+                result = model.predict(image, verbose=False)[0]
+                latencies.append(time.perf_counter() - started)
+            detections.append(extract_detections(result, model.names))
+
+        entry = {
+            'path': exported_path(weights_path, backend),
+            'latency_ms': summarize(latencies),
+            'detections': sum(len(image_detections) for image_detections in detections),
+        }
+        if reference is None:
+            reference = (backend, detections)
+        else:
+            scores = [detection_agreement(expected, actual) for expected, actual in zip(reference[1], detections)]
+            entry['agreement_with'] = reference[0]
+            entry['agreement'] = round(sum(scores) / len(scores), 4) if scores else None
+            entry['speedup'] = round(report['backends'][reference[0]]['latency_ms']['mean'] / entry['latency_ms']['mean'], 2)
+        report['backends'][backend] = entry
+    return report
@@ -0,0 +1,247 @@
+"""
+Dynamic micro-batching for YOLO inference
+
+Concurrent callers submit single images to a BatchingEngine. A background
+thread gathers whatever is queued into one batch of up to `max_batch_size`
+images, waiting at most `max_wait` seconds after the oldest request arrived,
+runs a single `model.predict` call and hands each caller its own result.
+
+The queue is ordered by priority (myapp/scheduler.py), so webcam frames are
+batched ahead of bulk work. A request that would wait longer than its
+deadline is refused with `Overloaded` when it is submitted, or failed with it
+when its turn comes too late, rather than run after its caller gave up.
+"""
+
+import time
+import queue
+import logging
+import itertools
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future, InvalidStateError
+from .scheduler import PRIORITY_INTERACTIVE, PRIORITY_NAMES, Overloaded
+from .metrics import collector
+
+SHED = collector.counter('ppe_inference_shed_total', 'Inference requests refused or expired past their deadline',
+                         ('priority',))
+BATCH_SIZE = collector.histogram('ppe_inference_batch_size', 'Images per batched model call', (),
+                                 buckets=(1, 2, 4, 8, 16, 32, 64))
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Number of recent samples kept for the wait/latency percentiles
+STATS_WINDOW = 1024
+
+# Sorts after every request priority, so close() serves what is already queued
+SHUTDOWN = float('inf')
+
+
+def summarize(samples):
+    """Return mean/p50/p95/max in milliseconds for a list of durations in seconds"""
+    if not samples:
+        return {'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'max': 0.0}
+    ordered = sorted(samples)
+    last = len(ordered) - 1
+    return {
+        'mean': round(sum(ordered) / len(ordered) * 1000, 3),
+        'p50': round(ordered[int(last * 0.50)] * 1000, 3),
+        'p95': round(ordered[int(last * 0.95)] * 1000, 3),
+        'max': round(ordered[-1] * 1000, 3),
+    }
+
+
+class BatchingEngine:
+    """Gather concurrent single-image predictions into batched model calls"""
+
+    def __init__(self, model, max_batch_size=8, max_wait=0.01, predict_kwargs=None):
+        self.model = model
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait))
+        self.predict_kwargs = {'verbose': False, **(predict_kwargs or {})}
+
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._pending = Counter()
+        self._running = False
+        self._batch_time = 0.0  # moving average, seconds
+        self._shed = Counter()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._errors = 0
+        self._batch_sizes = Counter()
+        self._queue_waits = deque(maxlen=STATS_WINDOW)
+        self._batch_times = deque(maxlen=STATS_WINDOW)
+
+        self._closed = False
+        self._thread = None
+        self._start_thread()
+
+    def _start_thread(self):
+        self._thread = threading.Thread(target=self._run, name='yolo-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, image, priority=PRIORITY_INTERACTIVE, deadline=None):
+        """
+        Queue an image (numpy array) and return a Future for its ultralytics
+        Results. Raises Overloaded if it would wait more than `deadline`
+        seconds before its batch starts.
+        """
+        with self._stats_lock:
+            if not self._closed and not self._thread.is_alive():
+                # Queued requests would never be served otherwise
+                logger.error("Batching thread died, restarting it")
+                self._start_thread()
+            self._admit(priority, deadline)
+            self._pending[priority] += 1
+        future = Future()
+        self._queue.put((priority, next(self._sequence), (image, future, time.monotonic(), deadline)))
+        return future
+
+    def predict(self, image, timeout=None, priority=PRIORITY_INTERACTIVE, deadline=None):
+        """Blocking convenience wrapper around submit()"""
+        return self.submit(image, priority, deadline).result(timeout=timeout)
+
+    def admit(self, priority=PRIORITY_INTERACTIVE, deadline=None):
+        """Raise Overloaded if a request of this priority submitted now would miss `deadline`"""
+        with self._stats_lock:
+            self._admit(priority, deadline)
+
+    def _admit(self, priority, deadline):
+        if deadline is None:
+            return
+        wait = self._estimated_wait(priority)
+        if wait > deadline:
+            self._shed[priority] += 1
+            SHED.inc(priority=PRIORITY_NAMES.get(priority, priority))
+            raise Overloaded(wait, priority)
+
+    def estimated_wait(self, priority=PRIORITY_INTERACTIVE):
+        """Seconds a request of this priority submitted now would queue before its batch starts"""
+        with self._stats_lock:
+            return self._estimated_wait(priority)
+
+    def _estimated_wait(self, priority):
+        # Called with the stats lock held. Everything of the same or higher priority goes first.
+        ahead = sum(count for queued_priority, count in self._pending.items() if queued_priority <= priority)
+        return (ahead // self.max_batch_size + (1 if self._running else 0)) * self._batch_time
+
+    def queue_depths(self):
+        """Queued images by priority name"""
+        with self._stats_lock:
+            return {name: self._pending[priority] for priority, name in PRIORITY_NAMES.items()}
+
+    def close(self):
+        """Stop the batching thread once the queued requests have been served"""
+        with self._stats_lock:
+            self._closed = True
+        self._queue.put((SHUTDOWN, next(self._sequence), None))
+        self._thread.join()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': round(self.max_wait * 1000, 3),
+                'queue_depth': self._queue.qsize(),
+                'queue_depth_by_priority': {PRIORITY_NAMES.get(priority, str(priority)): count
+                                            for priority, count in sorted(self._pending.items()) if count},
+                'shed': {PRIORITY_NAMES.get(priority, str(priority)): count for priority, count in sorted(self._shed.items())},
+                'estimated_wait_ms': {name: round(self._estimated_wait(priority) * 1000, 1)
+                                      for priority, name in PRIORITY_NAMES.items()},
+                'batches': self._batches,
+                'items': self._items,
+                'errors': self._errors,
+                'mean_batch_size': round(self._items / self._batches, 3) if self._batches else 0.0,
+                'batch_size_histogram': {str(size): count for size, count in sorted(self._batch_sizes.items())},
+                'queue_wait_ms': summarize(self._queue_waits),
+                'batch_inference_ms': summarize(self._batch_times),
+            }
+
+    def _collect(self):
+        """Block for the first request, then fill the batch until it is full or the oldest request's wait expires"""
+        first = self._queue.get()
+        if first[2] is None:
+            return None
+        batch = [first]
+        deadline = first[2][2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                # Past the deadline we still take whatever is already queued
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item[2] is None:
+                self._queue.put(item)
+                break
+            batch.append(item)
+        with self._stats_lock:
+            for priority, _, _ in batch:
+                self._pending[priority] -= 1
+            self._running = True
+        return [(priority, *request) for priority, _, request in batch]
+
+    def _expire(self, batch, started):
+        """Fail requests whose queue wait already exceeded their deadline; returns the rest"""
+        live = []
+        for priority, image, future, enqueued, deadline in batch:
+            if deadline is not None and started - enqueued > deadline:
+                future.set_exception(Overloaded(started - enqueued, priority))
+                SHED.inc(priority=PRIORITY_NAMES.get(priority, priority))
+                with self._stats_lock:
+                    self._shed[priority] += 1
+            else:
+                live.append((priority, image, future, enqueued, deadline))
+        return live
+
+    def _run(self):
+        while True:
+            batch = []
+            try:
+                batch = self._collect()
+                if batch is None:
+                    return
+                self._dispatch(batch)
+            except Exception as e:
+                # Whatever went wrong, fail this batch and keep serving the next one
+                logger.error(f"Batched inference failed for {len(batch)} image(s): {str(e)}")
+                for _, _, future, _, _ in batch:
+                    try:
+                        future.set_exception(e)
+                    except InvalidStateError:
+                        pass
+                with self._stats_lock:
+                    self._errors += 1
+            finally:
+                with self._stats_lock:
+                    self._running = False
+
+    def _dispatch(self, batch):
+        """Run one collected batch through the model and resolve its futures"""
+        # Skip callers that gave up before their batch started
+        batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+        started = time.monotonic()
+        batch = self._expire(batch, started)
+        if not batch:
+            return
+
+        results = self.model.predict([image for _, image, _, _, _ in batch], **self.predict_kwargs)
+        finished = time.monotonic()
+        if len(results) != len(batch):
+            raise RuntimeError(f"model returned {len(results)} results for {len(batch)} images")
+
+        for (_, _, future, _, _), result in zip(batch, results):
+            future.set_result(result)
+        BATCH_SIZE.observe(len(batch))
+
+        with self._stats_lock:
+            self._batches += 1
+            self._items += len(batch)
+            self._batch_sizes[len(batch)] += 1
+            self._queue_waits.extend(started - enqueued for _, _, _, enqueued, _ in batch)
+            self._batch_times.append(finished - started)
+            # Smoothed, so one slow batch doesn't start shedding on its own
+            elapsed = finished - started
+            self._batch_time = elapsed if not self._batch_time else 0.8 * self._batch_time + 0.2 * elapsed
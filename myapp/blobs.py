@@ -0,0 +1,159 @@
+"""
+Content-addressed media storage
+
+Originals, annotated outputs and their thumbnails are stored under the
+SHA-256 of their bytes, sharded into two levels of prefix directories:
+
+    originals/3f/a9/3fa9...e1.jpg
+    processed/7c/02/7c02...9b.jpg
+    thumbnails/7c/02/7c02...9b_320.webp
+
+so no directory grows past a few thousand entries, and identical bytes are
+written once however many uploads use them. Every stored file has a
+StoredFile row counting the uploads that refer to it: `put` and `acquire`
+add references, `release` drops them, and `collect` removes files nobody
+refers to any more (under a row lock, so a concurrent `put` of the same
+bytes either keeps the file alive or writes it again).
+
+Files are written through the media storage (myapp/storage.py), local disk
+or an S3-compatible bucket; uploads are streamed to it chunk by chunk.
+
+Files from before this layout (uploads/, outputs/) have no StoredFile row;
+`release` hands them back so the caller can fall back to checking other
+uploads. `manage.py migrate_media_layout` moves them over.
+"""
+
+import os
+import hashlib
+import logging
+from collections import Counter
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from .models import StoredFile
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+ORIGINALS = 'originals'
+PROCESSED = 'processed'
+THUMBNAILS = 'thumbnails'
+LAYOUT_DIRS = (ORIGINALS, PROCESSED, THUMBNAILS)
+
+
+def sharded_name(kind, digest, suffix):
+    """e.g. originals/3f/a9/3fa9....jpg for suffix '.jpg'"""
+    return f'{kind}/{digest[:2]}/{digest[2:4]}/{digest}{suffix}'
+
+
+def extension_of(filename, default='.jpg'):
+    extension = os.path.splitext(filename or '')[1].lower()
+    return extension if extension and len(extension) <= 8 else default
+
+
+def _store(name, write, refs):
+    """Add `refs` references to `name`, writing it with `write()` unless a live copy is already stored"""
+    for _ in range(2):
+        if StoredFile.objects.filter(name=name).update(refs=F('refs') + refs, updated_at=timezone.now()):
+            # A failed garbage collection may have removed the file but kept the row
+            if not default_storage.exists(name):
+                write()
+            return name
+        size = write()
+        try:
+            StoredFile.objects.create(name=name, size=size, refs=refs)
+            return name
+        except IntegrityError:
+            # Stored concurrently by another upload of the same bytes: add the reference to that row
+            continue
+    raise IntegrityError(f"Could not store {name}")
+
+
+def put(data, kind, suffix, digest=None, refs=1):
+    """Store bytes under their content address; returns the media-relative name"""
+    name = sharded_name(kind, digest or hashlib.sha256(data).hexdigest(), suffix)
+    return _store(name, lambda: default_storage.write(name, ContentFile(data)), refs)
+
+
+def file_digest(name_or_file):
+    """SHA-256 of a stored file (media-relative name) or an open Django File, read in chunks"""
+    hasher = hashlib.sha256()
+    if isinstance(name_or_file, str):
+        with default_storage.open(name_or_file, 'rb') as source:
+            for chunk in source.chunks():
+                hasher.update(chunk)
+    else:
+        for chunk in name_or_file.chunks():
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def put_file(uploaded_file, kind, digest=None, refs=1):
+    """Store an uploaded (possibly disk-spooled) file chunk by chunk under its content address"""
+    name = sharded_name(kind, digest or file_digest(uploaded_file), extension_of(uploaded_file.name))
+    return _store(name, lambda: default_storage.write(name, uploaded_file), refs)
+
+
+def put_named(data, name, refs=1):
+    """Store bytes under a name derived from another blob's address (thumbnails of a processed image)"""
+    return _store(name, lambda: default_storage.write(name, ContentFile(data)), refs)
+
+
+def adopt(source, name, refs=1):
+    """Store an existing media file (outside the layout) under `name`, linked or copied server-side"""
+    return _store(name, lambda: default_storage.link(source, name), refs)
+
+
+def acquire(names, refs=1):
+    """Add references to stored files (another upload now uses them); unknown names are ignored"""
+    names = [name for name in names if name]
+    if names:
+        StoredFile.objects.filter(name__in=names).update(refs=F('refs') + refs, updated_at=timezone.now())
+
+
+def set_refs(names, refs):
+    StoredFile.objects.filter(name__in=[name for name in names if name]).update(refs=refs, updated_at=timezone.now())
+
+
+def release(names):
+    """
+    Drop one reference per occurrence of each stored file in `names` and
+    remove the ones left unused. Returns (untracked names, sizes of the
+    removed files); the untracked ones predate this layout and the caller
+    has to check them against other uploads itself.
+    """
+    counts = Counter(name for name in names if name)
+    tracked = set(StoredFile.objects.filter(name__in=list(counts)).values_list('name', flat=True))
+    by_count = {}
+    for name in tracked:
+        by_count.setdefault(counts[name], []).append(name)
+    for count, group in by_count.items():
+        StoredFile.objects.filter(name__in=group).update(refs=Greatest(F('refs') - count, 0), updated_at=timezone.now())
+    removed = collect(tracked) if tracked else []
+    return [name for name in counts if name not in tracked], removed
+
+
+def collect(names=None, older_than=None):
+    """
+    Remove stored files without references (optionally only `names`, or
+    unused since `older_than`); returns the sizes of the removed files
+    """
+    unused = StoredFile.objects.filter(refs=0)
+    if names is not None:
+        unused = unused.filter(name__in=list(names))
+    if older_than is not None:
+        unused = unused.filter(updated_at__lt=older_than)
+    removed = []
+    for pk in unused.values_list('pk', flat=True):
+        with transaction.atomic():
+            # Locked and re-checked: a put() that re-referenced the file meanwhile wins
+            stored = StoredFile.objects.select_for_update().filter(pk=pk, refs=0).first()
+            if stored is None:
+                continue
+            stored.delete()
+            default_storage.delete(stored.name)
+            removed.append(stored.size)
+    return removed
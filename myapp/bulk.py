@@ -0,0 +1,225 @@
+"""
+Bulk ingestion of many images or a ZIP archive in one request
+
+Sources are read one at a time (ZIP members are decompressed individually),
+pushed through the shared batching engine with a bounded number of images in
+flight, and reported as one NDJSON line per image as soon as it is done, so
+memory stays flat regardless of how many images a request carries.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import zipfile
+from collections import deque
+from django.conf import settings
+from django.utils import timezone
+from .blobs import ORIGINALS, acquire, extension_of, put
+from .cache import lookup_result, remember_result, entry_files
+from .inference import use_model, decode_image, extract_detections, save_detection
+from .jobs import client_name
+from .models import UploadedImage
+from .tiling import MODE_FULL
+from .scheduler import PRIORITY_BULK, Overloaded, deadline_for
+from .metrics import record_detections
+from .uploads import get_content_hash, get_image_format, size_limit_message
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif')
+
+
+class SourceError(Exception):
+    """An individual image in the request that cannot be processed"""
+
+
+def is_zip_upload(uploaded_file):
+    return uploaded_file.name.lower().endswith('.zip') or uploaded_file.content_type in (
+        'application/zip', 'application/x-zip-compressed')
+
+
+def iter_zip_members(uploaded_file):
+    """Yield (name, bytes) for each image in an archive, decompressing one member at a time"""
+    with zipfile.ZipFile(uploaded_file) as archive:
+        for member in archive.infolist():
+            name = member.filename
+            basename = os.path.basename(name)
+            if member.is_dir() or basename.startswith('.') or name.startswith('__MACOSX/'):
+                continue
+            if not basename.lower().endswith(IMAGE_EXTENSIONS):
+                yield name, SourceError('Not an image file')
+                continue
+            # Check the declared size before inflating anything
+            if member.file_size > settings.UPLOAD_MAX_IMAGE_SIZE:
+                yield name, SourceError(size_limit_message())
+                continue
+            with archive.open(member) as member_file:
+                yield name, member_file.read(settings.UPLOAD_MAX_IMAGE_SIZE + 1)
+
+
+def iter_sources(request, field_name='files'):
+    """Yield (name, bytes or SourceError, content_hash) for every image in the request"""
+    for index, uploaded_file in enumerate(request.FILES.getlist(field_name)):
+        if is_zip_upload(uploaded_file):
+            try:
+                for name, data in iter_zip_members(uploaded_file):
+                    content_hash = hashlib.sha256(data).hexdigest() if isinstance(data, bytes) else ''
+                    yield name, data, content_hash
+            except zipfile.BadZipFile:
+                yield uploaded_file.name, SourceError('Invalid ZIP archive'), ''
+            continue
+
+        if not (uploaded_file.content_type or '').startswith('image/') or \
+                not get_image_format(request, field_name, uploaded_file, index):
+            yield uploaded_file.name, SourceError('Only image files are allowed'), ''
+        elif uploaded_file.size > settings.UPLOAD_MAX_IMAGE_SIZE:
+            yield uploaded_file.name, SourceError(size_limit_message()), ''
+        else:
+            content_hash = get_content_hash(request, field_name, uploaded_file, index)
+            yield uploaded_file.name, uploaded_file.read(), content_hash
+
+
+def start_item(engine, model_name, model_version, name, data, content_hash):
+    """Store one image and submit it for inference; returns an in-flight item or a finished result line"""
+    if isinstance(data, SourceError):
+        return {'name': name, 'status': UploadedImage.STATUS_FAILED, 'error': str(data)}
+    if len(data) > settings.UPLOAD_MAX_IMAGE_SIZE:
+        return {'name': name, 'status': UploadedImage.STATUS_FAILED, 'error': size_limit_message()}
+
+    cached = lookup_result(content_hash, model_version, MODE_FULL)
+    if cached is not None:
+        uploaded_image = UploadedImage.objects.create(
+            original_image=cached['original_image'],
+            original_name=client_name(name),
+            processed_image=cached['processed_image'],
+            detection_results=cached['detection_results'],
+            thumbnails=cached['thumbnails'],
+            content_hash=content_hash,
+            model_name=model_name,
+            model_version=model_version or '',
+            inference_mode=MODE_FULL,
+            status=UploadedImage.STATUS_DONE,
+            processed_at=timezone.now(),
+        )
+        acquire(entry_files(cached))
+        uploaded_image.save_detections()
+        return result_line(name, uploaded_image, cached=True)
+
+    try:
+        image = decode_image(data)
+    except ValueError as e:
+        return {'name': name, 'status': UploadedImage.STATUS_FAILED, 'error': str(e)}
+    try:
+        future = engine.submit(image, PRIORITY_BULK, deadline_for(PRIORITY_BULK))
+    except Overloaded as e:
+        return {'name': name, 'status': UploadedImage.STATUS_FAILED, 'error': str(e), 'retry_after': e.retry_after}
+
+    uploaded_image = UploadedImage(
+        original_image=put(data, ORIGINALS, extension_of(name), content_hash or None),
+        original_name=client_name(name),
+        content_hash=content_hash,
+        model_name=model_name,
+        # Bulk images go through the model full-frame in one batched stream
+        inference_mode=MODE_FULL,
+        status=UploadedImage.STATUS_PROCESSING,
+        started_at=timezone.now(),
+        attempts=1,
+    )
+    uploaded_image.save()
+    return name, uploaded_image, image, future
+
+
+def finish_item(names, model_version, name, uploaded_image, image, future):
+    """Wait for an in-flight image, save its annotated output and return its result line"""
+    try:
+        detections = extract_detections(future.result(), names)
+        record_detections(detections, 'bulk')
+        save_detection(uploaded_image, image, detections)
+        uploaded_image.status = UploadedImage.STATUS_DONE
+        uploaded_image.model_version = model_version or ''
+    except Exception as e:
+        logger.error(f"Error in bulk processing of {name}: {str(e)}")
+        uploaded_image.status = UploadedImage.STATUS_FAILED
+        uploaded_image.error_message = str(e)
+    uploaded_image.processed_at = timezone.now()
+    uploaded_image.save()
+    if uploaded_image.status == UploadedImage.STATUS_DONE:
+        uploaded_image.save_detections()
+        remember_result(uploaded_image)
+    return result_line(name, uploaded_image)
+
+
+def result_line(name, uploaded_image, cached=False):
+    line = {
+        'name': name,
+        'id': uploaded_image.id,
+        'status': uploaded_image.status,
+        'cached': cached,
+        'detections': uploaded_image.detection_results or [],
+        'processed_image_url': uploaded_image.processed_image_url,
+    }
+    if uploaded_image.error_message:
+        line['error'] = uploaded_image.error_message
+    return line
+
+
+def stream_bulk_results(sources, model_name=None):
+    """Process (name, data, content_hash) sources and yield one NDJSON line per image plus a summary"""
+    # One pinned model version for the whole request; released when the stream ends or the client goes away
+    with use_model(model_name) as loaded:
+        engine = loaded.engine
+        names = loaded.names
+        model_version = loaded.version
+        model_name = model_name or ''
+        max_in_flight = settings.BULK_UPLOAD_MAX_IN_FLIGHT
+
+        started = time.monotonic()
+        totals = {'total': 0, 'done': 0, 'cached': 0, 'failed': 0}
+        in_flight = deque()
+
+        def emit(line):
+            line['index'] = totals['total']
+            totals['total'] += 1
+            if line.get('cached'):
+                totals['cached'] += 1
+            totals['done' if line['status'] == UploadedImage.STATUS_DONE else 'failed'] += 1
+            return json.dumps(line) + '\n'
+
+        def finish(item):
+            try:
+                return finish_item(names, model_version, *item)
+            except Exception as e:
+                logger.error(f"Error saving bulk result of {item[0]}: {str(e)}")
+                return {'name': item[0], 'id': item[1].id, 'status': UploadedImage.STATUS_FAILED, 'error': str(e)}
+
+        for index, (name, data, content_hash) in enumerate(sources):
+            if index >= settings.BULK_UPLOAD_MAX_FILES:
+                yield emit({'name': name, 'status': UploadedImage.STATUS_FAILED,
+                            'error': f'Only {settings.BULK_UPLOAD_MAX_FILES} images are accepted per request'})
+                break
+
+            try:
+                item = start_item(engine, model_name, model_version, name, data, content_hash)
+            except Exception as e:
+                # A storage or database error fails this image, not the rest of the stream
+                logger.error(f"Error storing bulk upload {name}: {str(e)}")
+                item = {'name': name, 'status': UploadedImage.STATUS_FAILED, 'error': str(e)}
+            del data
+            if isinstance(item, dict):
+                yield emit(item)
+                continue
+
+            in_flight.append(item)
+            # Keep enough images queued to fill batches, but no more
+            while in_flight and (len(in_flight) >= max_in_flight or in_flight[0][3].done()):
+                yield emit(finish(in_flight.popleft()))
+
+        while in_flight:
+            yield emit(finish(in_flight.popleft()))
+
+        totals['elapsed_ms'] = round((time.monotonic() - started) * 1000, 1)
+        logger.info(f"Bulk upload finished: {totals}")
+        yield json.dumps({'summary': totals}) + '\n'
@@ -0,0 +1,114 @@
+"""
+Content-hash result cache
+
+Identical uploads (same SHA-256) processed by the same model weights in the
+same detection mode reuse the stored detection_results and annotated image
+instead of running YOLO again. A bounded in-process LRU sits in front of the database lookup; its
+keys include the model version, so several models can share it and results of replaced weights age out.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.core.files.storage import default_storage
+from .models import UploadedImage
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """Bounded LRU of finished results keyed by (content_hash + mode, model_version)"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, content_hash, model_version):
+        key = (content_hash, model_version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, content_hash, model_version, entry):
+        if self.max_size <= 0:
+            return
+        key = (content_hash, model_version)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+result_cache = ResultCache(settings.INFERENCE_RESULT_CACHE_SIZE)
+
+
+def cache_entry(uploaded_image):
+    return {
+        'original_image': uploaded_image.original_image.name,
+        'processed_image': uploaded_image.processed_image,
+        'detection_results': uploaded_image.detection_results,
+        'thumbnails': uploaded_image.thumbnails,
+    }
+
+
+def entry_files(entry, include_original=True):
+    """Stored files a cached result refers to, for taking references on them (myapp/blobs.py)"""
+    names = [entry['processed_image'], *(entry['thumbnails'] or {}).values()]
+    return [entry['original_image']] + names if include_original else names
+
+
+def cache_key(content_hash, inference_mode):
+    return f'{content_hash}:{inference_mode}' if inference_mode else content_hash
+
+
+def lookup_result(content_hash, model_version, inference_mode=''):
+    """Return a cached result for this content, model and mode, checking the LRU before the database"""
+    if not content_hash or not model_version:
+        return None
+
+    key = cache_key(content_hash, inference_mode)
+    entry = result_cache.get(key, model_version)
+    if entry is not None:
+        result_cache.record(hit=True)
+        return entry
+
+    match = (UploadedImage.objects
+             .filter(content_hash=content_hash, model_version=model_version, inference_mode=inference_mode,
+                     status=UploadedImage.STATUS_DONE)
+             .exclude(processed_image__isnull=True)
+             .order_by('-id')
+             .first())
+    if match is None or not default_storage.exists(match.processed_image) or not default_storage.exists(match.original_image.name):
+        result_cache.record(hit=False)
+        return None
+
+    entry = cache_entry(match)
+    result_cache.put(key, model_version, entry)
+    result_cache.record(hit=True)
+    return entry
+
+
+def remember_result(uploaded_image):
+    """Add a freshly processed image to the LRU"""
+    if uploaded_image.content_hash and uploaded_image.model_version and uploaded_image.processed_image:
+        key = cache_key(uploaded_image.content_hash, uploaded_image.inference_mode)
+        result_cache.put(key, uploaded_image.model_version, cache_entry(uploaded_image))
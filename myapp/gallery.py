@@ -0,0 +1,69 @@
+"""
+Keyset-paginated gallery
+
+The gallery pages through uploads newest first by (uploaded_at, id), which
+the upload_gallery_order index serves directly, so a page costs the same on
+the first page as on the thousandth and no row count is needed. Cursors are
+the (uploaded_at, id) of the last row shown. Only the columns the template
+renders are loaded, and nothing touches the filesystem; uploads whose files
+went missing are removed by the background sweep (myapp/sweeper.py).
+"""
+
+import base64
+import logging
+from datetime import datetime
+from django.db.models import Q
+from .models import UploadedImage
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Everything file_list.html renders
+GALLERY_FIELDS = ('id', 'uploaded_at', 'status', 'error_message', 'original_image', 'original_name',
+                  'processed_image', 'thumbnails', 'detection_results')
+
+
+def encode_cursor(uploaded_image):
+    value = f'{uploaded_image.uploaded_at.isoformat()}|{uploaded_image.id}'
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(uploaded_at, id) of a cursor; ValueError if it was tampered with"""
+    try:
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        uploaded_at, pk = value.split('|')
+        return datetime.fromisoformat(uploaded_at), int(pk)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid page cursor: {cursor}") from e
+
+
+def gallery_page(page_size, before=None, after=None):
+    """
+    One page of uploads, newest first: the page after the `before` cursor
+    (older uploads) or the page before the `after` cursor (newer uploads).
+    Returns (uploads, older_cursor, newer_cursor); a cursor is None when
+    there is nothing more in that direction.
+    """
+    uploads = UploadedImage.objects.only(*GALLERY_FIELDS)
+    if after:
+        uploaded_at, pk = decode_cursor(after)
+        newer = Q(uploaded_at__gt=uploaded_at) | Q(uploaded_at=uploaded_at, id__gt=pk)
+        rows = list(uploads.filter(newer).order_by('uploaded_at', 'id')[:page_size + 1])
+        has_newer = len(rows) > page_size
+        rows = rows[:page_size][::-1]
+        has_older = True
+    else:
+        if before:
+            uploaded_at, pk = decode_cursor(before)
+            uploads = uploads.filter(Q(uploaded_at__lt=uploaded_at) | Q(uploaded_at=uploaded_at, id__lt=pk))
+        rows = list(uploads.order_by('-uploaded_at', '-id')[:page_size + 1])
+        has_older = len(rows) > page_size
+        rows = rows[:page_size]
+        has_newer = bool(before)
+
+    if not rows:
+        return rows, None, None
+    return (rows,
+            encode_cursor(rows[-1]) if has_older else None,
+            encode_cursor(rows[0]) if has_newer else None)
@@ -0,0 +1,89 @@
+"""
+Liveness and readiness
+
+Liveness only says the process is up and answering; it never touches the
+model or the database, so a long warm-up or a database outage doesn't get
+the container restarted. Readiness says this process can serve detections
+right now: the database answers and the default model is resident, warmed
+up (myapp/registry.py) and has its batching engine running. Until then the
+load balancer keeps traffic on the replicas that are ready, so the first
+requests after a rollout don't pay for the warm-up.
+
+The check_system management command runs the same readiness checks.
+"""
+
+import os
+import time
+import logging
+import threading
+from django.db import connection
+from .registry import registry
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+STARTED_AT = time.time()
+
+_warming = threading.Lock()
+
+
+def liveness():
+    return {
+        'status': 'alive',
+        'pid': os.getpid(),
+        'uptime_s': round(time.time() - STARTED_AT, 1),
+    }
+
+
+def check_database():
+    """None if the database answers, otherwise the error"""
+    try:
+        connection.ensure_connection()
+        return None
+    except Exception as e:
+        return str(e)
+
+
+def warm_up_in_background():
+    """Load and warm up the default model without blocking the caller; at most one warm-up at a time"""
+    if not _warming.acquire(blocking=False):
+        return
+
+    def warm_up():
+        try:
+            registry.get()
+        finally:
+            _warming.release()
+
+    threading.Thread(target=warm_up, name='model-warm-up', daemon=True).start()
+
+
+def readiness(load=False):
+    """
+    (ready, report) for this process. With `load` the default model is
+    loaded and warmed up first (blocking); otherwise a missing or cold model
+    starts warming up in the background and the process reports not ready.
+    """
+    database_error = check_database()
+    entry = registry.get() if load else registry.peek()
+    if not load and (entry is None or entry.engine is None):
+        warm_up_in_background()
+
+    model_ready = entry is not None and entry.engine is not None and entry.warmup_seconds is not None
+    report = {
+        'status': 'ready' if model_ready and database_error is None else 'not ready',
+        'pid': os.getpid(),
+        'uptime_s': round(time.time() - STARTED_AT, 1),
+        'database': database_error or 'ok',
+        'model': None,
+    }
+    if entry is not None:
+        report['model'] = {
+            'name': entry.name,
+            'version': entry.version,
+            'backend': entry.backend,
+            'load_ms': round(entry.load_seconds * 1000, 1),
+            'warmup_ms': round(entry.warmup_seconds * 1000, 1) if entry.warmup_seconds is not None else None,
+            'warmed_up': model_ready,
+        }
+    return report['status'] == 'ready', report
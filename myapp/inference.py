@@ -0,0 +1,142 @@
+import cv2
+import logging
+import numpy as np
+from .registry import registry, model_config, weights_fingerprint, backend_version
+from .scheduler import PRIORITY_BULK
+from .metrics import stage, record_detections
+from .thumbnails import write_thumbnails
+from .blobs import PROCESSED, put
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+def get_model(name=None):
+    """Return the current YOLO model for this process, loading it on first use"""
+    entry = registry.get(name)
+    return entry.model if entry is not None else None
+
+
+def current_model_version(name=None):
+    """Version of the configured weights on disk, without loading the model"""
+    path, backend = model_config(name)
+    version = backend_version(weights_fingerprint(path), backend)
+    if version is None:
+        entry = registry.peek(name)
+        version = entry.version if entry is not None else None
+    return version
+
+
+def loaded_model_version(name=None):
+    """Version of the weights this process is currently serving"""
+    entry = registry.get(name)
+    return entry.version if entry is not None else None
+
+
+def get_inference_engine(name=None):
+    """Return the micro-batching engine of the current model version, or None if the model is unavailable"""
+    entry = registry.get(name)
+    return entry.engine if entry is not None else None
+
+
+def use_model(name=None):
+    """Context manager pinning one model version (see ModelRegistry.use); raises if it can't be loaded"""
+    return registry.use(name)
+
+
+def engine_stats():
+    """Batch-size and queue-wait statistics of the default model for this process, without loading it"""
+    entry = registry.peek()
+    if entry is None or entry.engine is None:
+        return None
+    return entry.engine.stats()
+
+
+def decode_image(data):
+    """Decode encoded image bytes (JPEG, PNG, WebP, ...) into a BGR array"""
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not decode the uploaded image")
+    return image
+
+
+def extract_detections(result, names):
+    """Convert one ultralytics Results object into the detection_results format"""
+    detections = []
+    if result.boxes is None:
+        return detections
+    for box, conf, cls in zip(result.boxes.xyxy.tolist(), result.boxes.conf.tolist(), result.boxes.cls.tolist()):
+        detections.append({
+            'class_id': int(cls),
+            'class': names[int(cls)],
+            'confidence': float(conf),
+            'box': box,
+        })
+    return detections
+
+
+def draw_detections(frame, detections):
+    """Draw boxes and labels onto a BGR frame in place"""
+    for detection in detections:
+        x1, y1, x2, y2 = map(int, detection['box'][:4])
+        label = f"{detection['class']} {round(detection['confidence'], 2)}"
+        if 'track_id' in detection:
+            label = f"#{detection['track_id']} {label}"
+        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+        cv2.putText(frame, label, (x1, max(y1 - 10, 10)), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 2)
+    return frame
+
+
+def encode_jpeg(frame, quality=90):
+    ok, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise Exception("Failed to encode annotated image")
+    return buffer.tobytes()
+
+
+def detect_array(image, loaded=None):
+    """Run YOLO on a decoded image through the batching engine and return detection dicts"""
+    if loaded is None:
+        with use_model() as loaded:
+            return extract_detections(loaded.engine.predict(image), loaded.names)
+    return extract_detections(loaded.engine.predict(image), loaded.names)
+
+
+def save_detection(uploaded_image, image, detection_results):
+    """Annotate a decoded image in memory and store it once under its content address"""
+    uploaded_image.detection_results = detection_results
+    logger.info(f"Processed detection results: {len(detection_results)} detections found")
+
+    with stage('annotate'):
+        draw_detections(image, detection_results)
+    with stage('encode'):
+        jpeg = encode_jpeg(image)
+    with stage('disk_write'):
+        relative_path = put(jpeg, PROCESSED, '.jpg')
+    with stage('thumbnail'):
+        uploaded_image.thumbnails = write_thumbnails(relative_path, image)
+
+    uploaded_image.processed_image = relative_path
+    logger.info(f"Saved processed image to {relative_path}")
+    return detection_results
+
+
+def run_detection(uploaded_image, loaded=None):
+    """Run YOLO on an uploaded image and attach the results and annotated output path to it"""
+    # Read and decode the original exactly once
+    with stage('disk_read'), uploaded_image.original_image.open('rb') as original:
+        data = original.read()
+    with stage('decode'):
+        image = decode_image(data)
+    logger.info(f"Running prediction on image {uploaded_image.id}")
+
+    from .tiling import detect_image
+    with stage('inference'):
+        if loaded is None:
+            with use_model(uploaded_image.model_name or None) as loaded:
+                detections, info = detect_image(image, loaded, uploaded_image.inference_mode, PRIORITY_BULK)
+        else:
+            detections, info = detect_image(image, loaded, uploaded_image.inference_mode, PRIORITY_BULK)
+    record_detections(detections, 'upload')
+    logger.info(f"Image {uploaded_image.id} processed in {info['mode']} mode ({info['tiles']} model input(s))")
+    return save_detection(uploaded_image, image, detections)
@@ -0,0 +1,318 @@
+"""
+Database-backed inference job queue
+
+Uploads are saved as UploadedImage rows (and videos as VideoAnalysis rows)
+in the "pending" state. A pool of worker processes started with
+`manage.py run_inference_workers` claims them, runs YOLO and stores the
+results, so web requests never wait on inference.
+"""
+
+import os
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from datetime import timedelta
+from django.conf import settings
+from django.db import connections
+from django.db.models import F
+from django.utils import timezone
+from .models import UploadedImage, VideoAnalysis
+from .metrics import collector, stage, STAGE_SECONDS, UPLOAD_JOBS
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+def client_name(name):
+    """File name a client sent, without any path and cut to fit UploadedImage.original_name"""
+    return os.path.basename((name or '').replace('\\', '/'))[-255:]
+
+
+def enqueue_upload(uploaded_file, content_hash='', model_name='', inference_mode=''):
+    """Store an uploaded file as a pending detection job, or reuse the results of an identical earlier upload"""
+    from .blobs import ORIGINALS, acquire, put_file
+    from .cache import lookup_result, entry_files
+    from .inference import current_model_version
+
+    model_version = current_model_version(model_name or None)
+    cached = lookup_result(content_hash, model_version, inference_mode)
+    if cached is not None:
+        # Same bytes, same weights: point at the stored files instead of keeping another copy
+        uploaded_image = UploadedImage.objects.create(
+            original_image=cached['original_image'],
+            original_name=client_name(uploaded_file.name),
+            processed_image=cached['processed_image'],
+            detection_results=cached['detection_results'],
+            thumbnails=cached['thumbnails'],
+            content_hash=content_hash,
+            model_name=model_name,
+            model_version=model_version,
+            inference_mode=inference_mode,
+            status=UploadedImage.STATUS_DONE,
+            processed_at=timezone.now(),
+        )
+        acquire(entry_files(cached))
+        uploaded_image.save_detections()
+        logger.info(f"Reused cached results for upload {uploaded_image.id} ({content_hash[:12]})")
+        return uploaded_image
+
+    # Stored under its content hash; identical originals share one file
+    original = put_file(uploaded_file, ORIGINALS, content_hash or None)
+    uploaded_image = UploadedImage(original_image=original, original_name=client_name(uploaded_file.name),
+                                   content_hash=content_hash, model_name=model_name, inference_mode=inference_mode, status=UploadedImage.STATUS_PENDING)
+    uploaded_image.save()
+    logger.info(f"Queued detection job {uploaded_image.id}")
+    return uploaded_image
+
+
+# Job tables in claim priority order: (model, queue order, field showing the job is still alive)
+JOB_QUEUES = [
+    (UploadedImage, ('uploaded_at', 'id'), 'updated_at'),
+    (VideoAnalysis, ('created_at', 'id'), 'updated_at'),
+]
+
+
+def job_queue_depth():
+    return {(model.__name__,): model.objects.filter(status=model.STATUS_PENDING).count()
+            for model, _, _ in JOB_QUEUES}
+
+
+# Read from the database by the scraped process only; every process would report the same numbers
+collector.gauge('ppe_job_queue_depth', 'Pending jobs in the database queue', ('queue',),
+                callback=job_queue_depth, per_process=False)
+
+
+def claim_next_job():
+    """Atomically move the oldest pending job to "processing" and return it, or None if the queue is empty"""
+    for model, ordering, alive_field in JOB_QUEUES:
+        while True:
+            job_id = (model.objects
+                      .filter(status=model.STATUS_PENDING)
+                      .order_by(*ordering)
+                      .values_list('id', flat=True)
+                      .first())
+            if job_id is None:
+                break
+
+            now = timezone.now()
+            # The status filter makes the update a compare-and-swap between workers
+            claimed = model.objects.filter(id=job_id, status=model.STATUS_PENDING).update(
+                status=model.STATUS_PROCESSING,
+                attempts=F('attempts') + 1,
+                **{'started_at': now, alive_field: now},
+            )
+            if claimed:
+                return model.objects.get(id=job_id)
+    return None
+
+
+def requeue_stale_jobs():
+    """Return jobs whose worker died mid-processing to the queue, or fail them after too many attempts"""
+    cutoff = timezone.now() - timedelta(seconds=settings.INFERENCE_JOB_TIMEOUT)
+    requeued = failed = 0
+    for model, ordering, alive_field in JOB_QUEUES:
+        stale = model.objects.filter(status=model.STATUS_PROCESSING, **{f'{alive_field}__lt': cutoff})
+
+        failed += stale.filter(attempts__gte=settings.INFERENCE_MAX_ATTEMPTS).update(
+            status=model.STATUS_FAILED,
+            processed_at=timezone.now(),
+            error_message='Inference timed out',
+        )
+        requeued += stale.filter(attempts__lt=settings.INFERENCE_MAX_ATTEMPTS).update(status=model.STATUS_PENDING)
+    if failed or requeued:
+        logger.warning(f"Stale jobs: {requeued} requeued, {failed} failed")
+    return requeued, failed
+
+
+@contextmanager
+def heartbeat(job, interval=None):
+    """Keep bumping a processing job's liveness field from a thread, so requeue_stale_jobs leaves it alone"""
+    interval = interval if interval is not None else settings.INFERENCE_JOB_TIMEOUT / 5
+    alive_field = next(field for model, _, field in JOB_QUEUES if isinstance(job, model))
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(interval):
+                try:
+                    type(job).objects.filter(id=job.id, status=job.STATUS_PROCESSING).update(
+                        **{alive_field: timezone.now()})
+                except Exception as e:
+                    # A missed beat (e.g. a locked or restarting database) is retried on the next one
+                    logger.warning(f"Heartbeat for job {job.id} failed: {str(e)}")
+                    connections.close_all()
+        finally:
+            connections.close_all()
+
+    thread = threading.Thread(target=beat, name=f'heartbeat-{job.id}', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def process_job(uploaded_image):
+    """Run detection for a claimed job and record the outcome"""
+    if isinstance(uploaded_image, VideoAnalysis):
+        from .video import process_video
+        # Progress saves bump it too, but only between frames
+        with heartbeat(uploaded_image):
+            return process_video(uploaded_image)
+
+    from .blobs import acquire
+    from .cache import lookup_result, remember_result, entry_files
+    from .inference import run_detection, use_model
+
+    if uploaded_image.started_at and uploaded_image.uploaded_at:
+        STAGE_SECONDS.observe((uploaded_image.started_at - uploaded_image.uploaded_at).total_seconds(), stage='queue_wait')
+    try:
+        # Pinned, so a hot reload mid-job can't mix versions
+        with heartbeat(uploaded_image), use_model(uploaded_image.model_name or None) as loaded:
+            # A duplicate may have finished while this job was queued
+            cached = lookup_result(uploaded_image.content_hash, loaded.version, uploaded_image.inference_mode)
+            if cached is not None:
+                uploaded_image.detection_results = cached['detection_results']
+                uploaded_image.processed_image = cached['processed_image']
+                uploaded_image.thumbnails = cached['thumbnails']
+                acquire(entry_files(cached, include_original=False))
+            else:
+                run_detection(uploaded_image, loaded)
+            uploaded_image.model_version = loaded.version or ''
+    except Exception as e:
+        logger.error(f"Error in YOLO processing for job {uploaded_image.id}: {str(e)}")
+        uploaded_image.status = UploadedImage.STATUS_FAILED
+        uploaded_image.error_message = str(e)
+        uploaded_image.processed_at = timezone.now()
+        uploaded_image.save(update_fields=['status', 'error_message', 'processed_at'])
+        UPLOAD_JOBS.inc(status=UploadedImage.STATUS_FAILED)
+        return False
+
+    uploaded_image.status = UploadedImage.STATUS_DONE
+    uploaded_image.error_message = ''
+    uploaded_image.processed_at = timezone.now()
+    with stage('db_save'):
+        uploaded_image.save()
+        uploaded_image.save_detections()
+    UPLOAD_JOBS.inc(status=UploadedImage.STATUS_DONE)
+    remember_result(uploaded_image)
+    logger.info(f"Finished detection job {uploaded_image.id}")
+    return True
+
+
+def worker_loop(poll_interval=None, max_jobs=None, stop_when_empty=False, stop_event=None):
+    """Claim and process jobs until stopped; returns the number of jobs handled"""
+    poll_interval = poll_interval if poll_interval is not None else settings.INFERENCE_POLL_INTERVAL
+    stop_event = stop_event or threading.Event()
+
+    handled = 0
+    last_stale_check = 0.0
+    try:
+        while not stop_event.is_set() and (max_jobs is None or handled < max_jobs):
+            if time.monotonic() - last_stale_check > poll_interval * 30:
+                requeue_stale_jobs()
+                last_stale_check = time.monotonic()
+
+            job = claim_next_job()
+            if job is None:
+                if stop_when_empty:
+                    break
+                stop_event.wait(poll_interval)
+                continue
+
+            process_job(job)
+            handled += 1
+    finally:
+        # Database connections are per thread
+        connections.close_all()
+    return handled
+
+
+def _worker_main(poll_interval, threads, processes=1):
+    """Entry point of one worker process: run `threads` job loops sharing one model and batching engine"""
+    from .inference import engine_stats
+    from .preload import init_worker_process
+
+    init_worker_process(processes)
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    logger.info(f"Inference worker {os.getpid()} started with {threads} thread(s)")
+
+    # Concurrent jobs in one process are batched together by the shared engine
+    job_threads = [
+        threading.Thread(target=worker_loop, kwargs={'poll_interval': poll_interval, 'stop_event': stop_event},
+                         name=f'inference-job-{index}', daemon=True)
+        for index in range(max(1, threads))
+    ]
+    for thread in job_threads:
+        thread.start()
+    while any(thread.is_alive() for thread in job_threads):
+        for thread in job_threads:
+            thread.join(timeout=1)
+
+    logger.info(f"Inference worker {os.getpid()} stopped, batching stats: {engine_stats()}")
+
+
+def run_worker_pool(workers=None, poll_interval=None, threads=None):
+    """Run a supervised pool of inference worker processes until SIGTERM/SIGINT"""
+    workers = workers or settings.INFERENCE_WORKERS
+    poll_interval = poll_interval if poll_interval is not None else settings.INFERENCE_POLL_INTERVAL
+    threads = threads or settings.INFERENCE_WORKER_THREADS
+
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        logger.warning("fork is not available on this platform, running a single in-process worker")
+        _worker_main(poll_interval, threads)
+        return
+
+    context = multiprocessing.get_context('fork')
+    # Load the weights once here; the forked workers share them copy-on-write
+    from .preload import preload_models
+    preload_models()
+    # Children must not inherit the parent's open database connections
+    connections.close_all()
+
+    stopping = False
+
+    def start_worker():
+        process = context.Process(target=_worker_main, args=(poll_interval, threads, workers), daemon=True)
+        process.start()
+        return process
+
+    def start_sweeper():
+        from .sweeper import sweeper_main
+        process = context.Process(target=sweeper_main, args=(settings.INTEGRITY_SWEEP_INTERVAL,), daemon=True)
+        process.start()
+        return process
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    processes = [start_worker() for _ in range(workers)]
+    logger.info(f"Started {workers} inference workers")
+    # Missing-file reconciliation runs beside the workers, off the request path
+    sweeper = start_sweeper() if settings.INTEGRITY_SWEEP_INTERVAL else None
+
+    while not stopping:
+        time.sleep(1)
+        for index, process in enumerate(processes):
+            if not process.is_alive() and not stopping:
+                logger.warning(f"Inference worker {process.pid} exited with code {process.exitcode}, restarting")
+                processes[index] = start_worker()
+        if sweeper is not None and not sweeper.is_alive() and not stopping:
+            logger.warning(f"Storage sweeper {sweeper.pid} exited with code {sweeper.exitcode}, restarting")
+            sweeper = start_sweeper()
+
+    if sweeper is not None:
+        processes.append(sweeper)
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join(timeout=30)
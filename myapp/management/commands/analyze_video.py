@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from myapp.models import VideoAnalysis
+from myapp.video import process_video
+
+
+class Command(BaseCommand):
+    help = 'Run PPE detection over a video file or RTSP/HTTP stream with frame-stride sampling'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='Video file path or rtsp:// / http:// stream URL')
+        sampling = parser.add_mutually_exclusive_group()
+        sampling.add_argument('--stride', type=int, help='Analyse every Nth frame')
+        sampling.add_argument('--fps', type=float, help='Analyse about this many frames per second of video')
+        parser.add_argument('--max-seconds', type=float, help='Stop after this much video (default for streams: VIDEO_STREAM_MAX_SECONDS)')
+        parser.add_argument('--model', default='', help='Registry model to use (default: the default model)')
+        parser.add_argument('--queue', action='store_true', help='Queue the analysis for the inference workers instead of running it here')
+
+    def handle(self, *args, **options):
+        source = options['source']
+        is_stream = '://' in source
+        target_fps = options['fps']
+        if options['stride'] is None and target_fps is None:
+            target_fps = settings.VIDEO_DEFAULT_TARGET_FPS
+        max_seconds = options['max_seconds']
+        if max_seconds is None and is_stream:
+            max_seconds = settings.VIDEO_STREAM_MAX_SECONDS
+
+        video_analysis = VideoAnalysis.objects.create(
+            source_url=source,
+            frame_stride=max(1, options['stride'] or 1),
+            target_fps=target_fps,
+            max_seconds=max_seconds,
+            model_name=options['model'],
+        )
+        if options['queue']:
+            self.stdout.write(self.style.SUCCESS(f'Queued video analysis {video_analysis.id}'))
+            return
+
+        video_analysis.status = VideoAnalysis.STATUS_PROCESSING
+        video_analysis.attempts = 1
+        video_analysis.save()
+        if not process_video(video_analysis):
+            self.stderr.write(self.style.ERROR(f'Video analysis {video_analysis.id} failed: {video_analysis.error_message}'))
+            return
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Video analysis {video_analysis.id}: {video_analysis.frames_analyzed} of {video_analysis.frames_decoded} frames '
+            f'analysed at stride {video_analysis.frame_stride}, {video_analysis.detection_count} detections '
+            f'written to {video_analysis.detections_file}'
+        ))
+        self.stdout.write(f"Summary: {video_analysis.summary}")
@@ -0,0 +1,54 @@
+import os
+import json
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp.health import readiness, check_database
+
+
+class Command(BaseCommand):
+    help = 'Check the database, media storage and model (loaded and warmed up) the way the readiness probe does'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--skip-model', action='store_true', help='Only check the database and media storage')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def check_media(self):
+        # Round trip through the media storage (local directory or bucket)
+        name = f'.check_system_{os.getpid()}'
+        try:
+            default_storage.write(name, ContentFile(b'ok'))
+            default_storage.delete(name)
+            return None
+        except Exception as e:
+            return str(e)
+
+    def handle(self, *args, **options):
+        media_error = self.check_media()
+        if options['skip_model']:
+            database_error = check_database()
+            ready = database_error is None
+            report = {'status': 'ready' if ready else 'not ready', 'database': database_error or 'ok'}
+        else:
+            self.stdout.write('Loading and warming up the model...')
+            ready, report = readiness(load=True)
+        report['media'] = media_error or 'ok'
+        ready = ready and media_error is None
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.stdout.write(f"Database: {report['database']}")
+            self.stdout.write(f"Media storage ({settings.MEDIA_STORAGE}): {report['media']}")
+            model = report.get('model')
+            if model is not None:
+                self.stdout.write(f"Model: {model['name']} {model['version']} ({model['backend']} backend), "
+                                  f"loaded in {model['load_ms']:.0f} ms, warmed up in {model['warmup_ms'] or 0:.0f} ms")
+            elif not options['skip_model']:
+                self.stdout.write('Model: not loaded')
+
+        if not ready:
+            raise CommandError('System check failed')
+        self.stdout.write(self.style.SUCCESS('System ready'))
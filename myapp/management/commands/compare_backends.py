@@ -0,0 +1,67 @@
+import os
+import json
+import cv2
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp.backends import BACKENDS, compare_backends
+from myapp.bulk import IMAGE_EXTENSIONS
+from myapp.blobs import ORIGINALS
+
+
+class Command(BaseCommand):
+    help = 'Compare latency and detection agreement of the torch / onnx / openvino backends on the same images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('images', nargs='*',
+                            help='Image files or directories (default: the stored originals under MEDIA_ROOT)')
+        parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=list(BACKENDS),
+                            help='Backends to compare; agreement is measured against the first one')
+        parser.add_argument('--limit', type=int, default=20, help='Maximum number of images to use')
+        parser.add_argument('--runs', type=int, default=3, help='Timed predictions per image and backend')
+        parser.add_argument('--no-export', action='store_true', help='Skip backends that have not been exported yet')
+        parser.add_argument('--output', help='Also write the JSON report to this file')
+
+    def collect_images(self, paths, limit):
+        files = []
+        for path in paths or [os.path.join(settings.MEDIA_ROOT, ORIGINALS), os.path.join(settings.MEDIA_ROOT, 'uploads')]:
+            if os.path.isdir(path):
+                # Originals are sharded into nested directories (myapp/blobs.py)
+                for root, dirs, names in os.walk(path):
+                    dirs.sort()
+                    files.extend(os.path.join(root, name) for name in sorted(names)
+                                 if name.lower().endswith(IMAGE_EXTENSIONS))
+            else:
+                files.append(path)
+        images = []
+        for path in files:
+            image = cv2.imread(path)
+            if image is not None:
+                images.append(image)
+            if len(images) >= limit:
+                break
+        return images
+
+    def handle(self, *args, **options):
+        images = self.collect_images(options['images'], options['limit'])
+        if not images:
+            raise CommandError('No readable images to compare on')
+
+        self.stdout.write(f"Comparing {', '.join(options['backends'])} on {len(images)} image(s)...")
+        report = compare_backends(settings.YOLO_MODEL_PATH, options['backends'], images,
+                                  runs=options['runs'], export_missing=not options['no_export'])
+
+        for backend, entry in report['backends'].items():
+            if 'error' in entry:
+                self.stdout.write(self.style.WARNING(f"{backend:<9} unavailable: {entry['error']}"))
+                continue
+            line = (f"{backend:<9} mean {entry['latency_ms']['mean']:>8.1f} ms  p95 {entry['latency_ms']['p95']:>8.1f} ms"
+                    f"  detections {entry['detections']:>5}")
+            if 'agreement' in entry:
+                line += f"  agreement {entry['agreement']:.3f}  speedup x{entry['speedup']}"
+            self.stdout.write(line)
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}"))
@@ -0,0 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+
+from myapp.models import UploadedImage
+from myapp.scheduler import available_cpus
+from myapp.thumbnails import thumbnails_from_file
+from myapp.blobs import set_refs
+
+
+class Command(BaseCommand):
+    help = 'Generate gallery thumbnails for processed uploads that have none yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=available_cpus(),
+                            help='Images resized in parallel (default: usable CPUs)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Uploads loaded per query')
+        parser.add_argument('--force', action='store_true', help='Regenerate existing thumbnails too')
+
+    def handle(self, *args, **options):
+        uploads = UploadedImage.objects.exclude(processed_image__isnull=True).exclude(processed_image='')
+        if not options['force']:
+            uploads = uploads.filter(thumbnails__isnull=True)
+
+        generated = failed = 0
+        last_id = 0
+        done = set()
+        # OpenCV releases the GIL while decoding, resizing and encoding, so threads run in parallel
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as executor:
+            while True:
+                batch = list(uploads.filter(id__gt=last_id).order_by('id')
+                             .values_list('id', 'processed_image')[:options['batch_size']])
+                if not batch:
+                    break
+                last_id = batch[-1][0]
+                # Duplicate uploads share one processed image and its thumbnails
+                names = sorted({name for _, name in batch} - done)
+                done.update(names)
+                for name, result in zip(names, executor.map(self.generate, names)):
+                    if isinstance(result, Exception):
+                        failed += 1
+                        self.stderr.write(f'{name}: {result}')
+                        continue
+                    sharing = UploadedImage.objects.filter(processed_image=name)
+                    # One reference per upload showing them
+                    set_refs(result.values(), sharing.count())
+                    sharing.update(thumbnails=result)
+                    generated += 1
+                self.stdout.write(f'{generated} processed images done, {failed} failed')
+
+        self.stdout.write(self.style.SUCCESS(f'Generated thumbnails for {generated} processed image(s), {failed} failed'))
+
+    def generate(self, name):
+        try:
+            return thumbnails_from_file(name, refs=0)
+        except Exception as e:
+            return e
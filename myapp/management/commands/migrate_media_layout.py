@@ -0,0 +1,117 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from myapp.models import UploadedImage
+from myapp.scheduler import available_cpus
+from myapp.blobs import ORIGINALS, PROCESSED, LAYOUT_DIRS, adopt, extension_of, file_digest, set_refs, sharded_name
+from myapp.thumbnails import thumbnail_name
+
+
+def in_layout(name):
+    return bool(name) and name.split('/')[0] in LAYOUT_DIRS
+
+
+class Command(BaseCommand):
+    help = ('Move uploads from the flat uploads/ and outputs/ directories into the sharded, content-addressed '
+            'layout (myapp/blobs.py) while the site keeps running')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='Uploads moved per batch')
+        parser.add_argument('--workers', type=int, default=available_cpus(), help='Files hashed in parallel')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report how many files would move and how many duplicates would be merged')
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.moved = self.merged = self.missing = 0
+        self.merged_bytes = 0
+        self.seen = {}
+
+        # Uploads that still refer to a file outside the layout; moved ones drop out, so reruns pick up where one stopped
+        pending = (UploadedImage.objects
+                   .exclude(Q(original_image__startswith=f'{ORIGINALS}/') &
+                            (Q(processed_image__isnull=True) | Q(processed_image='') |
+                             Q(processed_image__startswith=f'{PROCESSED}/')))
+                   .only('id', 'original_image', 'processed_image', 'thumbnails', 'content_hash'))
+        last_id = 0
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as executor:
+            while True:
+                batch = list(pending.filter(id__gt=last_id).order_by('id')[:options['batch_size']])
+                if not batch:
+                    break
+                last_id = batch[-1].id
+                originals = {uploaded_image.original_image.name: uploaded_image.content_hash for uploaded_image in batch
+                             if uploaded_image.original_image and not in_layout(uploaded_image.original_image.name)}
+                processed = {uploaded_image.processed_image for uploaded_image in batch
+                             if uploaded_image.processed_image and not in_layout(uploaded_image.processed_image)}
+                # Hashing dominates; hashlib releases the GIL on large reads
+                digests = dict(zip(processed, executor.map(self.digest, processed)))
+                digests.update(zip(originals, executor.map(self.digest, originals, originals.values())))
+
+                for name in originals:
+                    self.move_original(name, digests[name])
+                for name in processed:
+                    self.move_processed(name, digests[name])
+                self.stdout.write(f'Up to upload {last_id}: {self.moved} files moved, {self.merged} duplicates merged')
+
+        verb = 'would be' if self.dry_run else 'were'
+        self.stdout.write(self.style.SUCCESS(
+            f'{self.moved} files {verb} moved into the sharded layout, {self.merged} duplicates {verb} merged '
+            f'({self.merged_bytes / 1e6:.1f} MB), {self.missing} files were missing'))
+        if not self.dry_run:
+            self.stdout.write('The old files stay in place (hard links or server-side copies) for requests and jobs that '
+                              'still use their old paths; sweep_storage removes them after ORPHAN_GRACE_SECONDS.')
+
+    def digest(self, name, content_hash=''):
+        if not default_storage.exists(name):
+            return None
+        # Originals were hashed on upload; outputs are hashed here
+        return content_hash or file_digest(name)
+
+    def place(self, name, target, sharing):
+        """Store `name` at `target` with one reference per upload sharing it"""
+        if target in self.seen or default_storage.exists(target):
+            self.merged += 1
+            self.merged_bytes += default_storage.size(name)
+        else:
+            self.moved += 1
+        self.seen[target] = True
+        if not self.dry_run:
+            adopt(name, target, refs=sharing.count())
+
+    def move_original(self, name, digest):
+        if digest is None:
+            self.missing += 1
+            return
+        sharing = UploadedImage.objects.filter(original_image=name)
+        target = sharded_name(ORIGINALS, digest, extension_of(name))
+        self.place(name, target, sharing)
+        if not self.dry_run:
+            sharing.update(original_image=target)
+
+    def move_processed(self, name, digest):
+        if digest is None:
+            self.missing += 1
+            return
+        sharing = UploadedImage.objects.filter(processed_image=name)
+        target = sharded_name(PROCESSED, digest, extension_of(name))
+        self.place(name, target, sharing)
+
+        # Thumbnails follow their processed image
+        thumbnails = {}
+        old_thumbnails = []
+        for uploaded_image in sharing.only('id', 'thumbnails')[:1]:
+            for width, thumbnail in (uploaded_image.thumbnails or {}).items():
+                if not default_storage.exists(thumbnail):
+                    continue
+                moved = thumbnail_name(target, width, os.path.splitext(thumbnail)[1].lstrip('.'))
+                self.place(thumbnail, moved, sharing)
+                thumbnails[width] = moved
+                old_thumbnails.append(thumbnail)
+        if not self.dry_run:
+            sharing.update(processed_image=target, thumbnails=thumbnails or None)
+            # Thumbnails generated under the old names were reference counted; unused now, collected after the grace period
+            set_refs(old_thumbnails, 0)
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp.backends import export_backend, exported_path
+from myapp.registry import DEFAULT_MODEL, weights_fingerprint
+
+
+class Command(BaseCommand):
+    help = 'Roll out new weights (e.g. runs/detect/train/weights/best.pt); running processes hot-reload them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('weights', help='Path of the .pt file to promote')
+        parser.add_argument('--model', default=DEFAULT_MODEL, help='Registry model to replace (default: default)')
+
+    def handle(self, *args, **options):
+        source = options['weights']
+        if not os.path.exists(source):
+            raise CommandError(f'No such weights file: {source}')
+        config = settings.YOLO_MODELS.get(options['model'])
+        if config is None:
+            raise CommandError(f"Unknown model {options['model']!r}; configured: {', '.join(settings.YOLO_MODELS)}")
+        target, backend = config['path'], config.get('backend', 'torch')
+        if backend.endswith('_int8'):
+            raise CommandError(f'{backend} models are produced by quantize_model, promote the FP32 weights with '
+                               f'YOLO_BACKEND set to the matching FP32 backend first')
+
+        target_dir = os.path.dirname(os.path.abspath(target))
+        os.makedirs(target_dir, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=target_dir, prefix='.promote_') as staging_dir:
+            staged = os.path.join(staging_dir, os.path.basename(target))
+            shutil.copy2(source, staged)
+
+            if backend != 'torch':
+                # Replace the export before the weights: processes reload when the .pt changes
+                self.stdout.write(f'Exporting for the {backend} backend...')
+                export_backend(staged, backend)
+                staged_export, served_export = exported_path(staged, backend), exported_path(target, backend)
+                if os.path.isdir(served_export):
+                    shutil.rmtree(served_export)
+                os.replace(staged_export, served_export)
+
+            # Same-filesystem rename, so no process ever sees a half-written file
+            os.replace(staged, target)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Promoted {source} as model {options['model']} (version {weights_fingerprint(target)}); "
+            f"running processes switch over within MODEL_RELOAD_CHECK_INTERVAL seconds"))
@@ -0,0 +1,87 @@
+import os
+import json
+import tempfile
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from ultralytics import YOLO
+
+from myapp.quantization import (GUARDED_METRICS, build_calibration_set, metric_drops, promote, quantize,
+                                read_recorded_metrics, validate)
+
+
+class Command(BaseCommand):
+    help = 'Create an INT8 version of YOLO_MODEL_PATH and promote it only if mAP/recall stay within tolerance'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--data', required=True,
+                            help='Labelled validation dataset yaml (ultralytics format) used to measure mAP')
+        parser.add_argument('--backend', choices=['openvino', 'onnx'], default='openvino',
+                            help='INT8 runtime to produce (served as YOLO_BACKEND=<backend>_int8)')
+        parser.add_argument('--calibration-dir',
+                            help='Folder of calibration images (default: stored UploadedImage originals)')
+        parser.add_argument('--calibration-size', type=int, default=300, help='Maximum calibration images')
+        parser.add_argument('--tolerance', type=float, default=settings.QUANTIZATION_MAX_METRIC_DROP,
+                            help='Maximum absolute drop allowed for each guarded metric')
+        parser.add_argument('--recorded-baseline', nargs='?', const=settings.TRAINING_RESULTS_CSV, metavar='RESULTS_CSV',
+                            help='Compare against the metrics training recorded for these weights (default file: '
+                                 'TRAINING_RESULTS_CSV) instead of validating the FP32 weights on --data')
+        parser.add_argument('--imgsz', type=int, default=640)
+        parser.add_argument('--dry-run', action='store_true', help='Report the result but never promote')
+
+    def handle(self, *args, **options):
+        weights_path = settings.YOLO_MODEL_PATH
+        if not os.path.exists(weights_path):
+            raise CommandError(f'YOLO_MODEL_PATH does not exist: {weights_path}')
+
+        results_csv = options['recorded_baseline']
+        if results_csv:
+            if not os.path.exists(results_csv):
+                raise CommandError(f'No recorded baseline at {results_csv}')
+            try:
+                baseline = read_recorded_metrics(results_csv, weights_path)
+            except ValueError as e:
+                raise CommandError(f'{e}; drop --recorded-baseline to measure it on --data')
+            baseline_source = results_csv
+        else:
+            # Same weights, same data: the drop measures quantization and nothing else
+            self.stdout.write('Measuring FP32 baseline...')
+            baseline = validate(weights_path, options['data'], options['imgsz'])
+            baseline_source = options['data']
+
+        with tempfile.TemporaryDirectory(prefix='quantize_') as staging_dir:
+            data_yaml, count = build_calibration_set(
+                os.path.join(staging_dir, 'calibration'), YOLO(weights_path).names,
+                image_dir=options['calibration_dir'], limit=options['calibration_size'])
+            if not count:
+                raise CommandError('No calibration images found')
+            self.stdout.write(f'Calibrating on {count} image(s)...')
+
+            candidate_path = quantize(weights_path, options['backend'], data_yaml, staging_dir, options['imgsz'])
+            self.stdout.write('Validating INT8 model...')
+            candidate = validate(candidate_path, options['data'], options['imgsz'])
+
+            drops = metric_drops(baseline, candidate)
+            rejected = {metric: drop for metric, drop in drops.items() if drop > options['tolerance']}
+            report = {
+                'weights': weights_path,
+                'backend': f"{options['backend']}_int8",
+                'calibration_images': count,
+                'validation_data': options['data'],
+                'baseline_source': baseline_source,
+                'baseline': {metric: baseline.get(metric) for metric in GUARDED_METRICS},
+                'int8': {metric: candidate.get(metric) for metric in GUARDED_METRICS},
+                'drops': drops,
+                'tolerance': options['tolerance'],
+                'accepted': not rejected,
+            }
+            self.stdout.write(json.dumps(report, indent=2))
+
+            if rejected:
+                raise CommandError(f'INT8 model rejected, accuracy dropped beyond {options["tolerance"]}: {rejected}')
+            if options['dry_run']:
+                self.stdout.write(self.style.WARNING('Dry run: INT8 model passed but was not promoted'))
+                return
+            target = promote(candidate_path, options['backend'], weights_path, report)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"INT8 model promoted to {target}; serve it with YOLO_BACKEND={options['backend']}_int8"))
@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from myapp.jobs import run_worker_pool, worker_loop
+
+
+class Command(BaseCommand):
+    help = 'Run the pool of YOLO inference workers that process queued uploads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.INFERENCE_WORKERS,
+                            help='Number of worker processes (default: INFERENCE_WORKERS)')
+        parser.add_argument('--threads', type=int, default=settings.INFERENCE_WORKER_THREADS,
+                            help='Concurrent jobs per worker process, batched together (default: INFERENCE_WORKER_THREADS)')
+        parser.add_argument('--poll-interval', type=float, default=settings.INFERENCE_POLL_INTERVAL,
+                            help='Seconds to wait between polls when the queue is empty')
+        parser.add_argument('--once', action='store_true',
+                            help='Process the jobs currently queued in this process, then exit')
+
+    def handle(self, *args, **options):
+        if options['once']:
+            handled = worker_loop(poll_interval=options['poll_interval'], stop_when_empty=True)
+            self.stdout.write(self.style.SUCCESS(f'Processed {handled} job(s)'))
+            return
+
+        self.stdout.write(f"Starting {options['workers']} inference worker(s)...")
+        run_worker_pool(workers=options['workers'], poll_interval=options['poll_interval'], threads=options['threads'])
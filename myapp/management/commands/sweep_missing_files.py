@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from myapp.sweeper import sweep_missing_files
+
+
+class Command(BaseCommand):
+    help = 'Remove uploads whose original file is missing, the way the background sweep does'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Uploads loaded per query')
+        parser.add_argument('--dry-run', action='store_true', help='Only report the uploads that would be removed')
+
+    def handle(self, *args, **options):
+        checked, removed = sweep_missing_files(batch_size=options['batch_size'], dry_run=options['dry_run'])
+        verb = 'would be removed' if options['dry_run'] else 'removed'
+        self.stdout.write(self.style.SUCCESS(f'Checked {checked} upload(s), {removed} {verb}'))
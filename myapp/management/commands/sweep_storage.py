@@ -0,0 +1,80 @@
+import json
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp.scheduler import available_cpus
+from myapp.sweeper import (SweepState, sweep_lock, sweep_missing_files, enforce_retention, enforce_quota,
+                           sweep_orphans, media_usage)
+
+PHASES = ('missing', 'age', 'quota', 'orphans')
+
+
+class Command(BaseCommand):
+    help = ('Enforce media retention (age and disk quota), remove uploads whose files are missing and files no '
+            'upload refers to. Safe to run from cron or a Kubernetes CronJob; interrupted runs resume.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--only', nargs='+', choices=PHASES, default=list(PHASES), help='Phases to run')
+        parser.add_argument('--max-age-days', type=float, default=settings.RETENTION_DAYS,
+                            help='Remove finished uploads older than this (default: RETENTION_DAYS, 0 = keep)')
+        parser.add_argument('--quota-mb', type=float, default=settings.MEDIA_QUOTA_MB,
+                            help='Remove the oldest uploads until the stored media fit (default: MEDIA_QUOTA_MB, '
+                                 '0 = unlimited)')
+        parser.add_argument('--orphan-grace', type=float, default=settings.ORPHAN_GRACE_SECONDS,
+                            help='Only remove unreferenced files older than this many seconds')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows / files handled per batch')
+        parser.add_argument('--workers', type=int, default=available_cpus() * 2, help='Parallel file deletions')
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be removed without removing it')
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoints of an interrupted run')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        common = {'batch_size': options['batch_size'], 'dry_run': dry_run, 'workers': options['workers']}
+
+        with sweep_lock(f'{settings.SWEEP_STATE_FILE}.lock') as acquired:
+            if not acquired:
+                raise CommandError('Another sweep is running')
+            # Dry runs neither resume from nor move the checkpoints
+            state = SweepState(settings.SWEEP_STATE_FILE, enabled=not dry_run)
+            if options['restart']:
+                state.clear()
+
+            # Walks the whole media tree, so it's measured once and the quota phase works from it
+            usage = media_usage()
+            report = {'dry_run': dry_run, 'usage_mb_before': round(usage / 1e6, 1)}
+            if 'missing' in options['only']:
+                checked, removed = sweep_missing_files(options['batch_size'], dry_run, state=state,
+                                                       workers=options['workers'])
+                report['missing'] = {'checked': checked, 'uploads': removed}
+            if 'age' in options['only'] and options['max_age_days']:
+                report['age'] = self.totals(enforce_retention(options['max_age_days'], **common))
+            if 'quota' in options['only'] and options['quota_mb']:
+                usage -= report.get('age', {}).get('bytes', 0)
+                report['quota'] = self.totals(enforce_quota(options['quota_mb'] * 1e6, usage=usage, **common))
+            if 'orphans' in options['only']:
+                checked, files, freed = sweep_orphans(options['orphan_grace'], state=state, **common)
+                report['orphans'] = {'checked': checked, 'files': files, 'mb': round(freed / 1e6, 1)}
+            report['freed_mb'] = sum(report[phase]['mb'] for phase in ('age', 'quota', 'orphans') if phase in report)
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        verb = 'would be removed' if dry_run else 'removed'
+        if 'missing' in report:
+            self.stdout.write(f"Missing files: {report['missing']['checked']} uploads checked, "
+                              f"{report['missing']['uploads']} {verb}")
+        for phase, label in (('age', f"Older than {options['max_age_days']:g} days"),
+                             ('quota', f"Over the {options['quota_mb']:g} MB quota")):
+            if phase in report:
+                self.stdout.write(f"{label}: {report[phase]['uploads']} uploads, {report[phase]['files']} files, "
+                                  f"{report[phase]['mb']} MB {verb}")
+        if 'orphans' in report:
+            self.stdout.write(f"Orphaned files: {report['orphans']['checked']} checked, {report['orphans']['files']} "
+                              f"({report['orphans']['mb']} MB) {verb}")
+        self.stdout.write(self.style.SUCCESS(f"Media usage: {report['usage_mb_before']} MB before, "
+                                             f"{report['freed_mb']:.1f} MB {verb}"))
+
+    def totals(self, result):
+        uploads, files, freed = result
+        return {'uploads': uploads, 'files': files, 'mb': round(freed / 1e6, 1), 'bytes': freed}
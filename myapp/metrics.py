@@ -0,0 +1,423 @@
+"""
+Prometheus metrics
+
+A small in-process implementation of counters, gauges and histograms, cheap
+enough to leave on in production (one lock and a bisect per observation, no
+log lines), rendered in the Prometheus text format on /metrics.
+
+Uploads are processed by the run_inference_workers processes and requests
+are spread over several gunicorn workers, so a scrape of one process would
+only see a slice. Every process that records something therefore writes a
+snapshot to settings.METRICS_DIR every METRICS_FLUSH_INTERVAL seconds, and
+/metrics merges them: counters and histograms are summed over processes
+(including exited ones, so they never go backwards), gauges get a `pid`
+label and only count while their process is alive. Snapshots are named by
+pid and process start time, so a reused pid never overwrites an exited
+process's counts, and every minute the snapshots of exited processes are
+folded into one aggregate file and deleted.
+"""
+
+import os
+import json
+import time
+import uuid
+import fcntl
+import atexit
+import bisect
+import logging
+import tempfile
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from django.conf import settings
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Counters and histograms of exited processes, see MetricsRegistry.fold_exited()
+AGGREGATE_SNAPSHOT = 'aggregate.json'
+FOLD_INTERVAL = 60  # seconds
+
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels.get(name, '')) for name in labelnames)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def samples(self):
+        """{label values tuple: value} of this process"""
+        with self._lock:
+            return {key: (list(value) if isinstance(value, list) else value) for key, value in self._values.items()}
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        collector.touch()
+
+
+class Gauge(Metric):
+    """A value set directly, or read from `callback` (returning {label values tuple: value}) when collected"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None, per_process=True):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        # Shared state (e.g. the job queue in the database) is read once by the scraped process instead
+        self.per_process = per_process
+
+    def set(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = value
+        collector.touch()
+
+    def samples(self):
+        if self.callback is None:
+            return super().samples()
+        try:
+            return dict(self.callback())
+        except Exception as e:
+            logger.error(f"Metric {self.name} could not be collected: {str(e)}")
+            return {}
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=STAGE_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            # Per-bucket (not cumulative) counts, then sum and count
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+        collector.touch()
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+
+class MetricsRegistry:
+    """The metrics of this process, their periodic snapshot and the merged exposition"""
+
+    def __init__(self):
+        self.metrics = []
+        self._flusher = None
+        self._flusher_lock = threading.Lock()
+        self._identify()
+
+    def _identify(self):
+        # pid plus start time (a random id where /proc isn't available) names this process's snapshot
+        self.pid = os.getpid()
+        self.started = _process_start(self.pid)
+        self.snapshot_name = f'{self.pid}-{self.started if self.started is not None else uuid.uuid4().hex}.json'
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def touch(self):
+        # Start writing snapshots once this process has recorded something
+        if self._flusher is None and settings.METRICS_DIR:
+            self._start_flusher()
+
+    def _start_flusher(self):
+        with self._flusher_lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        last_fold = time.monotonic()
+        while True:
+            time.sleep(settings.METRICS_FLUSH_INTERVAL)
+            self.flush()
+            if time.monotonic() - last_fold >= FOLD_INTERVAL:
+                self.fold_exited()
+                last_fold = time.monotonic()
+
+    def snapshot(self):
+        metrics = {}
+        for metric in self.metrics:
+            if isinstance(metric, Gauge) and not metric.per_process:
+                continue
+            metrics[metric.name] = [[list(key), value] for key, value in metric.samples().items()]
+        return {'pid': self.pid, 'started': self.started, 'written_at': time.time(), 'metrics': metrics}
+
+    def flush(self):
+        """Write this process's snapshot for the other processes to merge"""
+        if not settings.METRICS_DIR:
+            return
+        try:
+            os.makedirs(settings.METRICS_DIR, exist_ok=True)
+            _write_snapshot(self.snapshot_name, self.snapshot())
+        except OSError as e:
+            logger.error(f"Could not write metrics snapshot: {str(e)}")
+
+    def after_fork(self):
+        """Children start from zero (the parent's counts are its own) and write their own snapshots"""
+        self._flusher = None
+        self._flusher_lock = threading.Lock()
+        self._identify()
+        for metric in self.metrics:
+            metric._lock = threading.Lock()
+            metric.reset()
+
+    def _other_snapshots(self):
+        """(file name, snapshot) of every other process, plus the aggregate of exited ones"""
+        if not settings.METRICS_DIR or not os.path.isdir(settings.METRICS_DIR):
+            return []
+        snapshots = []
+        for name in os.listdir(settings.METRICS_DIR):
+            if not name.endswith('.json') or name == self.snapshot_name:
+                continue
+            try:
+                with open(os.path.join(settings.METRICS_DIR, name)) as snapshot_file:
+                    snapshot = json.load(snapshot_file)
+            except (OSError, ValueError):
+                continue
+            snapshot['alive'] = name != AGGREGATE_SNAPSHOT and _process_alive(snapshot['pid'], snapshot.get('started'))
+            snapshots.append((name, snapshot))
+        return snapshots
+
+    def fold_exited(self):
+        """Add the counters and histograms of exited processes to the aggregate snapshot and delete theirs"""
+        if not settings.METRICS_DIR or not os.path.isdir(settings.METRICS_DIR):
+            return 0
+        try:
+            with open(os.path.join(settings.METRICS_DIR, '.fold.lock'), 'w') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Another process is folding right now
+                    return 0
+                return self._fold_exited()
+        except OSError as e:
+            logger.error(f"Could not fold metrics snapshots: {str(e)}")
+            return 0
+
+    def _fold_exited(self):
+        # Called with the fold lock held
+        snapshots = dict(self._other_snapshots())
+        aggregate = snapshots.pop(AGGREGATE_SNAPSHOT, None) or {'metrics': {}}
+        # Live processes rewrite theirs every flush, even one whose pid we can't see (another pid namespace)
+        stale = time.time() - 3 * settings.METRICS_FLUSH_INTERVAL
+        exited = [name for name, snapshot in snapshots.items()
+                  if not snapshot['alive'] and snapshot.get('written_at', 0) < stale]
+        if not exited:
+            return 0
+        # A fold interrupted after writing the aggregate has already counted these
+        counted = set(aggregate.get('folded', []))
+        gauges = {metric.name for metric in self.metrics if isinstance(metric, Gauge)}
+
+        totals = {}
+        for name in [AGGREGATE_SNAPSHOT] + [name for name in exited if name not in counted]:
+            source = aggregate if name == AGGREGATE_SNAPSHOT else snapshots[name]
+            for metric_name, samples in source['metrics'].items():
+                if metric_name in gauges:
+                    continue
+                merged = totals.setdefault(metric_name, {})
+                for key, value in samples:
+                    key = tuple(key)
+                    current = merged.get(key)
+                    if current is None:
+                        merged[key] = value
+                    elif isinstance(value, list):
+                        # Histograms whose buckets changed between releases can't be added up
+                        if len(value) == len(current):
+                            merged[key] = [a + b for a, b in zip(current, value)]
+                    else:
+                        merged[key] = current + value
+
+        _write_snapshot(AGGREGATE_SNAPSHOT, {
+            'pid': None,
+            'written_at': time.time(),
+            'folded': exited,
+            'metrics': {name: [[list(key), value] for key, value in merged.items()] for name, merged in totals.items()},
+        })
+        for name in exited:
+            try:
+                os.remove(os.path.join(settings.METRICS_DIR, name))
+            except FileNotFoundError:
+                pass
+        logger.info(f"Folded metrics of {len(exited)} exited process(es)")
+        return len(exited)
+
+    def render(self):
+        """Prometheus text exposition of all processes' metrics"""
+        own = {'pid': self.pid, 'alive': True,
+               'metrics': {metric.name: [[list(key), value] for key, value in metric.samples().items()]
+                           for metric in self.metrics}}
+        snapshots = [own] + [snapshot for _, snapshot in self._other_snapshots()]
+
+        lines = []
+        for metric in self.metrics:
+            merged = {}
+            for snapshot in snapshots:
+                for key, value in snapshot['metrics'].get(metric.name, []):
+                    key = tuple(key)
+                    if isinstance(metric, Gauge):
+                        if snapshot['alive']:
+                            merged[key + (str(snapshot['pid']),) if metric.per_process else key] = value
+                    elif isinstance(metric, Histogram):
+                        if len(value) != len(metric.buckets) + 3:
+                            continue
+                        current = merged.setdefault(key, [0] * len(value))
+                        merged[key] = [a + b for a, b in zip(current, value)]
+                    else:
+                        merged[key] = merged.get(key, 0) + value
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            labelnames = metric.labelnames + (('pid',) if isinstance(metric, Gauge) and metric.per_process else ())
+            for key, value in sorted(merged.items()):
+                pairs = list(zip(labelnames, key))
+                if isinstance(metric, Histogram):
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + (float('inf'),), value):
+                        cumulative += count
+                        lines.append(f'{metric.name}_bucket{_format_labels(pairs + [("le", _format_value(bound))])} {cumulative}')
+                    lines.append(f'{metric.name}_sum{_format_labels(pairs)} {_format_value(value[-2])}')
+                    lines.append(f'{metric.name}_count{_format_labels(pairs)} {value[-1]}')
+                else:
+                    lines.append(f'{metric.name}{_format_labels(pairs)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _write_snapshot(name, snapshot):
+    os.makedirs(settings.METRICS_DIR, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=settings.METRICS_DIR, suffix='.tmp', delete=False) as staged:
+        json.dump(snapshot, staged)
+    os.replace(staged.name, os.path.join(settings.METRICS_DIR, name))
+
+
+def _process_start(pid):
+    """Start time of a process in clock ticks since boot, None where /proc isn't available"""
+    try:
+        with open(f'/proc/{pid}/stat') as stat:
+            # Field 22; the command name in field 2 may contain spaces and parentheses
+            return int(stat.read().rsplit(')', 1)[1].split()[19])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def _process_alive(pid, started=None):
+    """Whether the process that wrote a snapshot still runs, and not just another one under the same pid"""
+    if not _pid_alive(pid):
+        return False
+    return started is None or _process_start(pid) == started
+
+
+collector = MetricsRegistry()
+os.register_at_fork(after_in_child=collector.after_fork)
+atexit.register(lambda: collector.flush() if collector._flusher is not None else None)
+
+
+# Application metrics
+
+REQUESTS = collector.counter('ppe_requests_total', 'HTTP requests by view and status code', ('view', 'status'))
+REQUEST_SECONDS = collector.histogram('ppe_request_seconds', 'Time to response (first byte for streams) by view', ('view',))
+STAGE_SECONDS = collector.histogram(
+    'ppe_stage_seconds',
+    'Time spent per processing stage (upload_read, enqueue, queue_wait, decode, inference, annotate, encode, '
+    'disk_write, thumbnail, db_save, webcam_inference, webcam_encode)',
+    ('stage',))
+DETECTIONS = collector.counter('ppe_detections_total', 'Objects detected by the model, by source and class',
+                               ('source', 'class'))
+UPLOAD_JOBS = collector.counter('ppe_upload_jobs_total', 'Finished upload jobs by outcome', ('status',))
+
+
+def stage(name):
+    """Context manager timing one processing stage"""
+    return STAGE_SECONDS.time(stage=name)
+
+
+def record_detections(detections, source):
+    for detection in detections:
+        DETECTIONS.inc(source=source, **{'class': detection['class']})
+
+
+def instrumented(view_name):
+    """View decorator counting requests by status code and timing them to the response"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            started = time.perf_counter()
+            status = 500
+            try:
+                response = view(request, *args, **kwargs)
+                status = response.status_code
+                return response
+            finally:
+                REQUESTS.inc(view=view_name, status=status)
+                REQUEST_SECONDS.observe(time.perf_counter() - started, view=view_name)
+        return wrapper
+    return decorator
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:04
+
+from django.db import migrations, models
+
+
+def mark_existing_images_done(apps, schema_editor):
+    # Rows created before the job queue existed were processed inline
+    UploadedImage = apps.get_model('myapp', 'UploadedImage')
+    unprocessed = UploadedImage.objects.filter(processed_image__isnull=True) | UploadedImage.objects.filter(processed_image='')
+    # Ones without an output failed back then; don't let the new workers re-run all of them after deploy
+    unprocessed.update(status='failed', error_message='Not processed before the job queue was introduced; upload it again')
+    UploadedImage.objects.exclude(processed_image__isnull=True).exclude(processed_image='').update(status='done')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0003_alter_uploadedimage_processed_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedimage',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='uploadedimage',
+            name='error_message',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='uploadedimage',
+            name='processed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadedimage',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadedimage',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='pending', max_length=16),
+        ),
+        migrations.RunPython(mark_existing_images_done, migrations.RunPython.noop),
+    ]
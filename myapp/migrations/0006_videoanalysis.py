@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0005_uploadedimage_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VideoAnalysis',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='pending', max_length=16)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('error_message', models.TextField(blank=True, default='')),
+                ('model_version', models.CharField(blank=True, default='', max_length=64)),
+                ('source_file', models.FileField(blank=True, null=True, upload_to='videos/')),
+                ('source_url', models.CharField(blank=True, default='', max_length=500)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('frame_stride', models.PositiveIntegerField(default=1)),
+                ('target_fps', models.FloatField(blank=True, null=True)),
+                ('max_seconds', models.FloatField(blank=True, null=True)),
+                ('source_fps', models.FloatField(blank=True, null=True)),
+                ('frames_decoded', models.PositiveIntegerField(default=0)),
+                ('frames_analyzed', models.PositiveIntegerField(default=0)),
+                ('detection_count', models.PositiveIntegerField(default=0)),
+                ('detections_file', models.CharField(blank=True, max_length=255, null=True)),
+                ('summary', models.JSONField(blank=True, null=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
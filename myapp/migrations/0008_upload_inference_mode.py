@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0007_job_model_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedimage',
+            name='inference_mode',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+    ]
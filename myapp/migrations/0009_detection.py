@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0008_upload_inference_mode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Detection',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('class_id', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('class_name', models.CharField(max_length=64)),
+                ('confidence', models.FloatField()),
+                ('x1', models.FloatField()),
+                ('y1', models.FloatField()),
+                ('x2', models.FloatField()),
+                ('y2', models.FloatField()),
+                ('uploaded_at', models.DateTimeField()),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='detections', to='myapp.uploadedimage')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='detection',
+            index=models.Index(fields=['class_name', 'confidence'], name='detection_class_confidence'),
+        ),
+        migrations.AddIndex(
+            model_name='detection',
+            index=models.Index(fields=['uploaded_at', 'class_name'], name='detection_uploaded_class'),
+        ),
+    ]
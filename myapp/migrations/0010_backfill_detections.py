@@ -0,0 +1,37 @@
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def backfill_detections(apps, schema_editor):
+    """Copy the detection_results list of every existing upload into Detection rows"""
+    UploadedImage = apps.get_model('myapp', 'UploadedImage')
+    Detection = apps.get_model('myapp', 'Detection')
+
+    rows = []
+    uploads = UploadedImage.objects.exclude(detection_results=None).only('id', 'uploaded_at', 'detection_results')
+    for upload in uploads.iterator(chunk_size=BATCH_SIZE):
+        for detection in upload.detection_results or []:
+            x1, y1, x2, y2 = detection['box'][:4]
+            rows.append(Detection(image_id=upload.id, class_id=detection.get('class_id'),
+                                  class_name=detection['class'], confidence=detection['confidence'],
+                                  x1=x1, y1=y1, x2=x2, y2=y2, uploaded_at=upload.uploaded_at))
+        if len(rows) >= BATCH_SIZE:
+            Detection.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+            rows = []
+    Detection.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+
+
+def remove_detections(apps, schema_editor):
+    apps.get_model('myapp', 'Detection').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0009_detection'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_detections, remove_detections),
+    ]
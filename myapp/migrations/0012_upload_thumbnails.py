@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0011_upload_gallery_order'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedimage',
+            name='thumbnails',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
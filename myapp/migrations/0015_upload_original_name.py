@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0014_upload_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedimage',
+            name='original_name',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
@@ -1,39 +1,197 @@
-from django.db import models
 import os
-from django.conf import settings
+from django.db import models, transaction
+from django.core.files.storage import default_storage
 
-class UploadedImage(models.Model):
+class InferenceJob(models.Model):
+    """Queue state shared by everything the inference workers process, see myapp/jobs.py"""
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSING = 'processing'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    started_at = models.DateTimeField(null=True, blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    error_message = models.TextField(blank=True, default='')
+    # Which registry model (settings.YOLO_MODELS, blank = default) and weights version produced the result
+    model_name = models.CharField(max_length=64, blank=True, default='')
+    model_version = models.CharField(max_length=64, blank=True, default='')
+
+    class Meta:
+        abstract = True
+
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_DONE, self.STATUS_FAILED)
+
+class UploadedImage(InferenceJob):
     original_image = models.ImageField(upload_to='uploads/')
+    # File name the client uploaded, as original_image is stored under its content hash
+    original_name = models.CharField(max_length=255, blank=True, default='')
     processed_image = models.CharField(max_length=255, null=True, blank=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    # Bumped by the worker's heartbeat while processing, so long jobs aren't mistaken for stale ones
+    updated_at = models.DateTimeField(auto_now=True)
     detection_results = models.JSONField(null=True, blank=True)
-    
+    # {width: media-relative path} of the gallery variants of processed_image, see myapp/thumbnails.py
+    thumbnails = models.JSONField(null=True, blank=True)
+
+    # Requested detection mode, see myapp/tiling.py (blank = settings.INFERENCE_TILE_MODE)
+    inference_mode = models.CharField(max_length=16, blank=True, default='')
+
+    # SHA-256 of the uploaded bytes, see myapp/cache.py
+    content_hash = models.CharField(max_length=64, blank=True, default='', db_index=True)
+
+    class Meta:
+        indexes = [
+            # Gallery keyset pagination and queue order, see myapp/gallery.py
+            models.Index(fields=['uploaded_at', 'id'], name='upload_gallery_order'),
+        ]
+
     @property
     def processed_image_url(self):
         if self.processed_image:
-            # Always join with MEDIA_URL and normalize slashes
-            url = settings.MEDIA_URL + self.processed_image.replace("\\", "/")
-            return url
+            # From the media storage: MEDIA_URL locally, a bucket or presigned URL on S3
+            return default_storage.url(self.processed_image.replace("\\", "/"))
         return None
 
+    @property
+    def thumbnail_url(self):
+        """Smallest gallery variant, or the processed image when there are none"""
+        if self.thumbnails:
+            return default_storage.url(self.thumbnails[min(self.thumbnails, key=int)])
+        return self.processed_image_url
+
+    @property
+    def thumbnail_srcset(self):
+        if not self.thumbnails:
+            return ''
+        return ', '.join(f'{default_storage.url(name)} {width}w'
+                         for width, name in sorted(self.thumbnails.items(), key=lambda item: int(item[0])))
+
     def __str__(self):
         return f"Image uploaded at {self.uploaded_at}"
-    
+
+    def save_detections(self):
+        """Replace this upload's Detection rows with its detection_results"""
+        with transaction.atomic():
+            self.detections.all().delete()
+            Detection.objects.bulk_create(
+                [Detection.from_result(self, detection) for detection in self.detection_results or []])
+
+    @property
+    def display_name(self):
+        """Name to show for the upload; older rows only have the stored file name"""
+        return self.original_name or os.path.basename(self.original_image.name)
+
+    @property
+    def media_names(self):
+        """Media-relative names of the stored files this upload refers to"""
+        names = [self.original_image.name if self.original_image else None, self.processed_image]
+        return [name for name in names + list((self.thumbnails or {}).values()) if name]
+
     def delete(self, *args, **kwargs):
-        # Delete the original image file
-        if self.original_image:
-            if os.path.isfile(self.original_image.path):
-                os.remove(self.original_image.path)
-        
-        # Delete the processed image directory
+        from .blobs import release
+        from .thumbnails import remove_thumbnails
+
+        # Content-addressed files (myapp/blobs.py) are reference counted; the rest predate that layout
+        untracked, _ = release(self.media_names)
+        others = UploadedImage.objects.exclude(pk=self.pk)
+
+        # Delete the original image file, unless a duplicate upload still shares it
+        if self.original_image and self.original_image.name in untracked and \
+                not others.filter(original_image=self.original_image.name).exists():
+            self.original_image.storage.delete(self.original_image.name)
+
+        # Delete the processed image, or the per-upload directory older uploads used
         if self.processed_image:
-            output_dir = os.path.join(settings.MEDIA_ROOT, 'outputs', str(self.id))
-            if os.path.exists(output_dir):
-                for root, dirs, files in os.walk(output_dir, topdown=False):
-                    for name in files:
-                        os.remove(os.path.join(root, name))
-                    for name in dirs:
-                        os.rmdir(os.path.join(root, name))
-                os.rmdir(output_dir)
-        
+            if self.processed_image in untracked and not others.filter(processed_image=self.processed_image).exists():
+                default_storage.delete(self.processed_image)
+                remove_thumbnails({width: name for width, name in (self.thumbnails or {}).items() if name in untracked})
+            default_storage.remove(f'outputs/{self.id}')
+
+        super().delete(*args, **kwargs)
+
+class Detection(models.Model):
+    """
+    One object detected in an upload, so filters and counts (class, confidence,
+    upload time) run in the database. UploadedImage.detection_results keeps
+    the same list for rendering.
+    """
+    image = models.ForeignKey(UploadedImage, on_delete=models.CASCADE, related_name='detections')
+    # Null for uploads stored before the class id was recorded; the name is always there
+    class_id = models.PositiveSmallIntegerField(null=True, blank=True)
+    class_name = models.CharField(max_length=64)
+    confidence = models.FloatField()
+    x1 = models.FloatField()
+    y1 = models.FloatField()
+    x2 = models.FloatField()
+    y2 = models.FloatField()
+    # Copy of image.uploaded_at, so time range filters use this table's index without a join
+    uploaded_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['class_name', 'confidence'], name='detection_class_confidence'),
+            models.Index(fields=['uploaded_at', 'class_name'], name='detection_uploaded_class'),
+        ]
+
+    @classmethod
+    def from_result(cls, image, detection):
+        """Unsaved row for one entry of a detection_results list"""
+        x1, y1, x2, y2 = detection['box'][:4]
+        return cls(image=image, class_id=detection.get('class_id'), class_name=detection['class'],
+                   confidence=detection['confidence'], x1=x1, y1=y1, x2=x2, y2=y2, uploaded_at=image.uploaded_at)
+
+    def __str__(self):
+        return f"{self.class_name} {self.confidence:.2f} in image {self.image_id}"
+
+class StoredFile(models.Model):
+    """A content-addressed media file and the number of uploads referring to it, see myapp/blobs.py"""
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField(default=0)
+    refs = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.refs} references)"
+
+class VideoAnalysis(InferenceJob):
+    """A video file or stream URL sampled and run through the detector, see myapp/video.py"""
+    source_file = models.FileField(upload_to='videos/', null=True, blank=True)
+    source_url = models.CharField(max_length=500, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Bumped by progress saves, so long videos aren't mistaken for stale jobs
+    updated_at = models.DateTimeField(auto_now=True)
+
+    # Sampling: every `frame_stride`-th frame, or derived from `target_fps` when set
+    frame_stride = models.PositiveIntegerField(default=1)
+    target_fps = models.FloatField(null=True, blank=True)
+    max_seconds = models.FloatField(null=True, blank=True)
+
+    source_fps = models.FloatField(null=True, blank=True)
+    frames_decoded = models.PositiveIntegerField(default=0)
+    frames_analyzed = models.PositiveIntegerField(default=0)
+    detection_count = models.PositiveIntegerField(default=0)
+    # Media-relative path of the packed per-frame detections (myapp.video.DETECTION_DTYPE records)
+    detections_file = models.CharField(max_length=255, null=True, blank=True)
+    summary = models.JSONField(null=True, blank=True)
+
+
+    def __str__(self):
+        return f"Video analysis {self.id} of {self.source_file.name if self.source_file else self.source_url}"
+
+    def delete(self, *args, **kwargs):
+        if self.source_file:
+            self.source_file.storage.delete(self.source_file.name)
+        if self.detections_file:
+            default_storage.delete(self.detections_file)
         super().delete(*args, **kwargs)
+
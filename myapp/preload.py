@@ -0,0 +1,40 @@
+"""
+Preload-and-fork serving
+
+The parent process (the gunicorn master with preload_app, or the
+run_inference_workers supervisor) loads the model weights once before
+forking. Children then share those pages copy-on-write instead of each
+holding a private copy, so memory per extra worker is mostly the worker's
+own activations and Python state.
+"""
+
+import os
+import gc
+import logging
+from django.db import connections
+from .registry import registry
+from .scheduler import apply_thread_budget
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+def preload_models():
+    """Load the configured torch models in the parent, before any worker is forked"""
+    preloaded = registry.preload()
+    # Keep the collector from touching (and so copying) every preloaded object in the children
+    gc.collect()
+    gc.freeze()
+    logger.info(f"Preloaded {len(preloaded)} model(s) for copy-on-write sharing: "
+                f"{', '.join(entry.name for entry in preloaded) or 'none'}")
+    return preloaded
+
+
+def init_worker_process(processes, warm_up=True):
+    """Per-child setup after fork: thread pools, database connections and (optionally) the default model engine"""
+    # Connections opened by the parent must not be shared between processes
+    connections.close_all()
+    threads = apply_thread_budget(processes)
+    logger.info(f"Worker {os.getpid()} using {threads} torch thread(s)")
+    if warm_up and registry.peek() is not None:
+        registry.get()
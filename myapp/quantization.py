@@ -0,0 +1,132 @@
+"""
+INT8 post-training quantization with an accuracy guardrail
+
+The FP32 weights are exported to an INT8 ONNX Runtime or OpenVINO model,
+calibrated on stored upload originals or a folder of images, and validated
+on a labelled dataset. The candidate is only promoted (moved to where the
+`onnx_int8` / `openvino_int8` backends load it from) when mAP and recall
+stay within a tolerance of the FP32 baseline, measured by validating the
+FP32 weights on the same dataset. The metrics recorded by training in
+runs/detect/train/results.csv can be used instead, but only for the
+weights that training run produced.
+"""
+
+import os
+import csv
+import json
+import shutil
+import logging
+from django.utils import timezone
+from ultralytics import YOLO
+from ultralytics.nn.tasks import torch_safe_load
+from .backends import exported_path
+from .bulk import IMAGE_EXTENSIONS
+from .models import UploadedImage
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Metrics that must not drop by more than the tolerance; recall is what catches missed violations
+GUARDED_METRICS = ('metrics/mAP50(B)', 'metrics/mAP50-95(B)', 'metrics/recall(B)')
+
+
+def checkpoint_metrics(weights_path):
+    """Validation metrics ultralytics stored in a training checkpoint, {} if it has none"""
+    checkpoint, _ = torch_safe_load(weights_path)
+    metrics = checkpoint.get('train_metrics') or {}
+    return {key: float(value) for key, value in metrics.items() if key.startswith('metrics/')}
+
+
+def read_recorded_metrics(results_csv, weights_path):
+    """Metrics results.csv recorded for the epoch `weights_path` was saved at, keyed like ultralytics' results_dict"""
+    stored = checkpoint_metrics(weights_path)
+    if not stored:
+        raise ValueError(f"{weights_path} has no training metrics to match against {results_csv}")
+    with open(results_csv, newline='') as results:
+        # Older ultralytics versions pad the column names with spaces
+        rows = [{key.strip(): value.strip() for key, value in row.items()} for row in csv.DictReader(results)]
+    for row in rows:
+        recorded = {key: float(value) for key, value in row.items() if key.startswith('metrics/')}
+        # The csv rounds to 5 decimals
+        if all(metric in recorded and abs(recorded[metric] - stored[metric]) < 1e-4
+               for metric in GUARDED_METRICS if metric in stored):
+            return recorded
+    raise ValueError(f"No epoch in {results_csv} matches the metrics stored in {weights_path}; "
+                     f"it was recorded for other weights")
+
+
+def build_calibration_set(directory, names, image_dir=None, limit=300):
+    """Collect calibration images into `directory` and write a dataset yaml for the exporter; returns (yaml, count)"""
+    images_dir = os.path.join(directory, 'images')
+    os.makedirs(images_dir, exist_ok=True)
+    count = 0
+    if image_dir:
+        for name in sorted(os.listdir(image_dir)):
+            if count >= limit:
+                break
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                shutil.copy2(os.path.join(image_dir, name), os.path.join(images_dir, f'{count:05d}_{name}'))
+                count += 1
+    else:
+        # Recent distinct uploads: the footage the model actually sees in production
+        seen = set()
+        uploads = UploadedImage.objects.filter(status=UploadedImage.STATUS_DONE).order_by('-id').iterator()
+        for uploaded_image in uploads:
+            if count >= limit:
+                break
+            key = uploaded_image.content_hash or uploaded_image.original_image.name
+            if key in seen:
+                continue
+            seen.add(key)
+            try:
+                with uploaded_image.original_image.open('rb') as original:
+                    data = original.read()
+            except (OSError, ValueError):
+                continue
+            extension = os.path.splitext(uploaded_image.original_image.name)[1] or '.jpg'
+            with open(os.path.join(images_dir, f'{count:05d}{extension}'), 'wb') as image_file:
+                image_file.write(data)
+            count += 1
+
+    data_yaml = os.path.join(directory, 'calibration.yaml')
+    with open(data_yaml, 'w') as dataset:
+        # JSON is valid YAML
+        json.dump({'path': directory, 'train': 'images', 'val': 'images', 'names': dict(names)}, dataset)
+    return data_yaml, count
+
+
+def quantize(weights_path, backend, calibration_yaml, staging_dir, imgsz=640):
+    """Export an INT8 model for `backend` (onnx or openvino) inside staging_dir and return its path"""
+    # Export from a copy so a rejected candidate never overwrites the promoted model
+    staged_weights = os.path.join(staging_dir, os.path.basename(weights_path))
+    shutil.copy2(weights_path, staged_weights)
+    logger.info(f"Quantizing {weights_path} to INT8 {backend}")
+    return YOLO(staged_weights).export(format=backend, int8=True, data=calibration_yaml, imgsz=imgsz,
+                                       dynamic=True, verbose=False)
+
+
+def validate(model_path, data, imgsz=640):
+    """mAP / precision / recall of a model on a labelled dataset yaml"""
+    metrics = YOLO(model_path, task='detect').val(data=data, imgsz=imgsz, batch=1, plots=False, verbose=False)
+    return {key: float(value) for key, value in metrics.results_dict.items() if key.startswith('metrics/')}
+
+
+def metric_drops(baseline, candidate):
+    return {metric: round(baseline[metric] - candidate.get(metric, 0.0), 5)
+            for metric in GUARDED_METRICS if metric in baseline}
+
+
+def promote(candidate_path, backend, weights_path, report):
+    """Move an accepted INT8 model to the path the `<backend>_int8` backend loads and record its report"""
+    target = exported_path(weights_path, f'{backend}_int8')
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    elif os.path.exists(target):
+        os.remove(target)
+    shutil.move(candidate_path, target)
+    report['promoted_to'] = target
+    report['promoted_at'] = timezone.now().isoformat()
+    with open(f'{os.path.splitext(weights_path)[0]}_int8_{backend}.json', 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    logger.info(f"Promoted INT8 {backend} model to {target}")
+    return target
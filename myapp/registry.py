@@ -0,0 +1,404 @@
+"""
+Model registry
+
+Every configured model (settings.YOLO_MODELS, e.g. one per site or PPE class
+set) is loaded on first use and kept resident, each with its own batching
+engine, under an LRU memory budget. The `default` model is never evicted.
+
+When the weights file behind a resident model changes (for example after
+`manage.py promote_model runs/detect/train/weights/best.pt`), the new
+version is loaded and warmed up next to the old one in the background and
+then swapped in atomically. Callers pin the version they use with
+`use(name)`, so in-flight requests finish on the old version, whose engine
+is closed once the last of them is done.
+
+For preload-and-fork serving (gunicorn.conf.py, run_inference_workers) the
+parent loads the torch weights once with `preload()` and the forked
+children share them copy-on-write. Threads and locks do not survive a fork,
+so each child starts its own batching engine on first use.
+"""
+
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+from django.conf import settings
+from ultralytics import YOLO
+from .backends import exported_path, load_backend
+from .batching import BatchingEngine
+from .metrics import collector
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = 'default'
+
+_fingerprints = {}
+
+
+def weights_fingerprint(path):
+    """Short SHA-256 of a weights file, recomputed only when its size or mtime changes"""
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    cached = _fingerprints.get(path)
+    if cached and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1]
+
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as weights:
+        for chunk in iter(lambda: weights.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    fingerprint = hasher.hexdigest()[:16]
+    _fingerprints[path] = ((stat.st_mtime_ns, stat.st_size), fingerprint)
+    return fingerprint
+
+
+def backend_version(fingerprint, backend):
+    """Model version string: exported backends get a suffix, since their outputs differ slightly from torch"""
+    if fingerprint is None or backend == 'torch':
+        return fingerprint
+    return f'{fingerprint}-{backend}'
+
+
+def disk_size(path):
+    """Bytes on disk of a model file or exported model directory"""
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def model_config(name):
+    """Weights path and backend of a configured model; raises KeyError for unknown names"""
+    config = settings.YOLO_MODELS[name or DEFAULT_MODEL]
+    return config['path'], config.get('backend', 'torch')
+
+
+def load_weights(path, backend):
+    """Load weights through a backend, falling back to torch and then to the default YOLOv8n weights"""
+    if os.path.exists(path):
+        logger.info(f"Loading YOLO model from: {path} ({backend} backend)")
+        try:
+            return load_backend(backend, path, export_missing=settings.YOLO_BACKEND_AUTO_EXPORT)
+        except Exception as backend_error:
+            if backend == 'torch':
+                raise
+            logger.error(f"Failed to load {backend} backend, falling back to torch: {str(backend_error)}")
+            return load_backend('torch', path)
+
+    logger.warning(f"YOLO model file not found at: {path}")
+    logger.info("Attempting to download default YOLOv8n model...")
+    started = time.monotonic()
+    model = YOLO('yolov8n.pt')  # This will download the model if not present
+    model.backend_name = 'torch'
+    model.weights_path = model.ckpt_path
+    model.load_seconds = time.monotonic() - started
+    return model
+
+
+def warmup_shapes():
+    """(height, width) of the synthetic warm-up inputs, from settings.INFERENCE_WARMUP_SHAPES ('640x640,480x640')"""
+    shapes = []
+    for shape in settings.INFERENCE_WARMUP_SHAPES.split(','):
+        height, _, width = shape.strip().partition('x')
+        shapes.append((int(height), int(width or height)))
+    return shapes
+
+
+class LoadedModel:
+    """One resident model version with its own batching engine"""
+
+    def __init__(self, name, model, start=True):
+        self.name = name
+        self.model = model
+        self.backend = model.backend_name
+        self.weights_path = model.weights_path
+        self.version = backend_version(weights_fingerprint(self.weights_path), self.backend)
+        # Approximate resident size: the served weights, which dominate the model's memory
+        self.size_bytes = disk_size(exported_path(self.weights_path, self.backend)) if self.weights_path else 0
+        self.loaded_at = time.time()
+        self.load_seconds = getattr(model, 'load_seconds', 0.0)
+        self.warmup_seconds = None
+        self.active = 0
+        self.retired = False
+        self.engine = None
+        self._start_lock = threading.Lock()
+        if start:
+            self.start()
+
+    @property
+    def names(self):
+        return self.model.names
+
+    def start(self):
+        """Warm up and start the batching engine in this process"""
+        with self._start_lock:
+            if self.engine is None:
+                self._warm_up()
+                self.engine = BatchingEngine(
+                    self.model,
+                    max_batch_size=settings.INFERENCE_MAX_BATCH_SIZE,
+                    max_wait=settings.INFERENCE_MAX_BATCH_WAIT_MS / 1000,
+                )
+        return self
+
+    def after_fork(self):
+        # The parent's batching thread does not exist in the child
+        self.engine = None
+        self._start_lock = threading.Lock()
+
+    def _warm_up(self):
+        # The first predictions at each input shape and batch size pay for lazy initialisation, memory
+        # allocation and operator selection; do that before any request sees this version
+        started = time.monotonic()
+        batch_sizes = sorted({1, settings.INFERENCE_MAX_BATCH_SIZE})
+        for height, width in warmup_shapes():
+            for batch_size in batch_sizes:
+                self.model.predict([np.zeros((height, width, 3), dtype=np.uint8)] * batch_size, verbose=False)
+        self.warmup_seconds = time.monotonic() - started
+        logger.info(f"Warmed up model {self.name} {self.version} in {self.warmup_seconds * 1000:.0f} ms "
+                    f"({settings.INFERENCE_WARMUP_SHAPES}, batch sizes {batch_sizes})")
+
+    def close(self):
+        if self.engine is not None:
+            self.engine.close()
+        logger.info(f"Unloaded model {self.name} {self.version}")
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'version': self.version,
+            'backend': self.backend,
+            'weights': self.weights_path,
+            'size_mb': round(self.size_bytes / (1024 * 1024), 1),
+            'active_requests': self.active,
+            'loaded_at': self.loaded_at,
+            'load_ms': round(self.load_seconds * 1000, 1),
+            'warmup_ms': round(self.warmup_seconds * 1000, 1) if self.warmup_seconds is not None else None,
+            'batching': self.engine.stats() if self.engine is not None else None,
+        }
+
+
+class ModelRegistry:
+    """Resident models by name, with background hot reload and an LRU memory budget"""
+
+    def __init__(self, memory_budget_mb=1024, reload_check_interval=10.0, load_retry_interval=60.0):
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.reload_check_interval = reload_check_interval
+        self.load_retry_interval = load_retry_interval
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._load_locks = {}
+        self._load_failed_at = {}
+        self._checked_at = {}
+        self._reloading = set()
+        self._rejected_versions = {}
+
+    def get(self, name=None):
+        """The current version of a model, loading it on first use; None if it can't be loaded"""
+        name = name or DEFAULT_MODEL
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                self._entries.move_to_end(name)
+        if entry is None:
+            return self._load(name)
+        if entry.engine is None:
+            # Preloaded in the parent process, first use in this one
+            entry.start()
+        self._maybe_reload(entry)
+        return entry
+
+    @contextmanager
+    def use(self, name=None):
+        """Pin the current version of a model for the duration of a request or job"""
+        while True:
+            entry = self.get(name)
+            if entry is None:
+                raise Exception("Model not loaded")
+            with self._lock:
+                # Lost a race with a swap: pin the version that replaced it instead
+                if not entry.retired:
+                    entry.active += 1
+                    break
+        try:
+            yield entry
+        finally:
+            with self._lock:
+                entry.active -= 1
+                close = entry.retired and entry.active == 0
+            if close:
+                entry.close()
+
+    def peek(self, name=None):
+        """The resident version of a model without loading it"""
+        with self._lock:
+            return self._entries.get(name or DEFAULT_MODEL)
+
+    def preload(self, names=None):
+        """
+        Load torch models without starting any threads, so they can be
+        shared copy-on-write by processes forked afterwards. Exported
+        backends (ONNX Runtime, OpenVINO) own native thread pools that are not
+        fork-safe and are left for each child to load.
+        """
+        preloaded = []
+        for name in names or settings.YOLO_MODELS:
+            path, backend = model_config(name)
+            if backend != 'torch' or name in self._entries:
+                continue
+            try:
+                model = load_weights(path, backend)
+                # Fuse conv+bn now; otherwise every child fuses on its first predict and writes private copies
+                model.fuse()
+                entry = LoadedModel(name, model, start=False)
+            except Exception as e:
+                logger.error(f"Failed to preload YOLO model {name}: {str(e)}")
+                continue
+            with self._lock:
+                self._entries[name] = entry
+            preloaded.append(entry)
+        return preloaded
+
+    def after_fork(self):
+        """Reset thread state inherited from the parent; registered with os.register_at_fork"""
+        self._lock = threading.RLock()
+        self._load_locks = {}
+        self._reloading = set()
+        for entry in self._entries.values():
+            entry.after_fork()
+
+    def _load(self, name):
+        path, backend = model_config(name)
+        with self._lock:
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(name)
+            if entry is not None:
+                return entry
+            # Don't retry a failed load on every request; callers get None quickly instead
+            failed_at = self._load_failed_at.get(name)
+            if failed_at is not None and time.monotonic() - failed_at < self.load_retry_interval:
+                return None
+            try:
+                entry = LoadedModel(name, load_weights(path, backend))
+            except Exception as e:
+                logger.error(f"Failed to load YOLO model {name}: {str(e)}")
+                self._load_failed_at[name] = time.monotonic()
+                return None
+            self._load_failed_at.pop(name, None)
+            self._checked_at[name] = time.monotonic()
+            logger.info("YOLO model loaded successfully")
+            with self._lock:
+                self._entries[name] = entry
+                self._evict(keep=name)
+            return entry
+
+    def _maybe_reload(self, entry):
+        # A cheap stat at most every reload_check_interval; hashing only happens when mtime/size changed
+        if not self.reload_check_interval or entry.name in self._reloading:
+            return
+        now = time.monotonic()
+        if now - self._checked_at.get(entry.name, 0) < self.reload_check_interval:
+            return
+        self._checked_at[entry.name] = now
+        path, backend = model_config(entry.name)
+        version = backend_version(weights_fingerprint(path), backend)
+        if version is None or version == entry.version or version == self._rejected_versions.get(entry.name):
+            return
+        self.reload(entry.name, background=True)
+
+    def reload(self, name=None, background=False):
+        """Load the configured weights for `name` next to the current version, warm them up and swap them in"""
+        name = name or DEFAULT_MODEL
+        with self._lock:
+            if name in self._reloading:
+                return False
+            self._reloading.add(name)
+        if background:
+            threading.Thread(target=self._reload, args=(name,), name=f'model-reload-{name}', daemon=True).start()
+            return True
+        return self._reload(name)
+
+    def _reload(self, name):
+        path, backend = model_config(name)
+        try:
+            logger.info(f"Loading new version of model {name} from {path}")
+            try:
+                entry = LoadedModel(name, load_backend(backend, path, export_missing=settings.YOLO_BACKEND_AUTO_EXPORT))
+            except Exception as e:
+                logger.error(f"Hot reload of model {name} failed, keeping the current version: {str(e)}")
+                self._rejected_versions[name] = backend_version(weights_fingerprint(path), backend)
+                return False
+            with self._lock:
+                previous = self._entries.get(name)
+                self._entries[name] = entry
+                self._entries.move_to_end(name)
+                if previous is not None:
+                    self._retire(previous)
+                self._evict(keep=name)
+            logger.info(f"Model {name} switched to version {entry.version}"
+                        + (f" (was {previous.version})" if previous is not None else ''))
+            return True
+        finally:
+            with self._lock:
+                self._reloading.discard(name)
+
+    def _retire(self, entry):
+        # Called with the lock held; the engine stays up until the last pinned request finishes
+        entry.retired = True
+        if entry.active == 0:
+            threading.Thread(target=entry.close, daemon=True).start()
+
+    def _evict(self, keep):
+        # Called with the lock held: drop least recently used models until within the memory budget
+        for name in list(self._entries):
+            if sum(entry.size_bytes for entry in self._entries.values()) <= self.memory_budget:
+                return
+            if name in (keep, DEFAULT_MODEL):
+                continue
+            entry = self._entries.pop(name)
+            logger.info(f"Evicting model {name} to stay within the {self.memory_budget // (1024 * 1024)} MB budget")
+            self._retire(entry)
+
+    def stats(self):
+        with self._lock:
+            entries = list(self._entries.values())
+        return {
+            'memory_budget_mb': self.memory_budget // (1024 * 1024),
+            'resident_mb': round(sum(entry.size_bytes for entry in entries) / (1024 * 1024), 1),
+            'models': [entry.stats() for entry in entries],
+        }
+
+
+registry = ModelRegistry(
+    memory_budget_mb=settings.MODEL_MEMORY_BUDGET_MB,
+    reload_check_interval=settings.MODEL_RELOAD_CHECK_INTERVAL,
+)
+os.register_at_fork(after_in_child=registry.after_fork)
+
+
+def _resident_models():
+    with registry._lock:
+        return list(registry._entries.values())
+
+
+collector.gauge('ppe_model_load_seconds', 'Time to load the resident model weights', ('model', 'version', 'backend'),
+                callback=lambda: {(entry.name, entry.version, entry.backend): entry.load_seconds
+                                  for entry in _resident_models()})
+collector.gauge('ppe_model_warmup_seconds', 'Time to warm up the resident model', ('model', 'version', 'backend'),
+                callback=lambda: {(entry.name, entry.version, entry.backend): entry.warmup_seconds
+                                  for entry in _resident_models() if entry.warmup_seconds is not None})
+collector.gauge('ppe_inference_queue_depth', 'Images waiting in the batching engine queue', ('model', 'priority'),
+                callback=lambda: {(entry.name, priority): depth
+                                  for entry in _resident_models() if entry.engine is not None
+                                  for priority, depth in entry.engine.queue_depths().items()})
@@ -0,0 +1,113 @@
+"""
+CPU-aware inference scheduling
+
+Torch intra-op threads, gunicorn workers, inference workers and webcam
+streams all run on the same cores. This module decides how many cores the
+process really has (CPU affinity and the cgroup CPU quota of the container,
+not the host's core count), splits them into per-process torch thread
+budgets, and defines the request priorities and queue-wait deadlines the
+batching engine (myapp/batching.py) schedules by.
+
+Work that would wait in the queue longer than its deadline is refused up
+front with `Overloaded`, which the views turn into a 503 with Retry-After,
+instead of piling up until the gunicorn timeout kills the worker.
+"""
+
+import os
+import math
+import logging
+from django.conf import settings
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Lower runs first
+PRIORITY_LIVE = 0         # webcam frames
+PRIORITY_INTERACTIVE = 1  # /api/detect, someone waiting on the response
+PRIORITY_BULK = 2         # bulk uploads, video analysis, queued upload jobs
+PRIORITY_NAMES = {PRIORITY_LIVE: 'live', PRIORITY_INTERACTIVE: 'interactive', PRIORITY_BULK: 'bulk'}
+
+
+class Overloaded(Exception):
+    """Raised instead of queueing work that would miss its deadline"""
+
+    def __init__(self, estimated_wait, priority=PRIORITY_INTERACTIVE):
+        self.estimated_wait = estimated_wait
+        self.priority = priority
+        super().__init__(f'Inference queue is full ({estimated_wait:.1f}s queue wait exceeds the deadline for '
+                         f'{PRIORITY_NAMES.get(priority, priority)} requests)')
+
+    @property
+    def retry_after(self):
+        """Whole seconds for the Retry-After header"""
+        return max(1, math.ceil(self.estimated_wait))
+
+
+def cgroup_cpu_limit(root='/sys/fs/cgroup'):
+    """CPUs allowed by the cgroup quota (v2 cpu.max, then v1 CFS quota); None when unlimited"""
+    try:
+        with open(os.path.join(root, 'cpu.max')) as cpu_max:
+            quota, period = cpu_max.read().split()[:2]
+        return int(quota) / int(period) if quota != 'max' else None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(os.path.join(root, 'cpu', 'cpu.cfs_quota_us')) as quota_file, \
+                open(os.path.join(root, 'cpu', 'cpu.cfs_period_us')) as period_file:
+            quota, period = int(quota_file.read()), int(period_file.read())
+        return quota / period if quota > 0 and period > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus():
+    """Cores this process may actually use: affinity mask capped by the container's CPU quota"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        # Rounded down: threads beyond the quota only get throttled
+        cpus = min(cpus, max(1, math.floor(limit)))
+    return max(1, cpus)
+
+
+def thread_budget(processes):
+    """Torch intra-op threads per process, so that all concurrent inference slots together use each core once"""
+    if settings.INFERENCE_TORCH_THREADS:
+        return settings.INFERENCE_TORCH_THREADS
+    slots = settings.INFERENCE_CPU_SLOTS or processes
+    return max(1, available_cpus() // max(1, slots))
+
+
+def apply_thread_budget(processes):
+    """Size the torch and OpenCV thread pools of this process; returns the thread count"""
+    import cv2
+    import torch
+
+    threads = thread_budget(processes)
+    torch.set_num_threads(threads)
+    cv2.setNumThreads(threads)
+    return threads
+
+
+def deadline_for(priority):
+    """Longest queue wait (seconds) a request of this priority accepts; None waits indefinitely"""
+    deadline = {
+        PRIORITY_LIVE: settings.INFERENCE_LIVE_DEADLINE,
+        PRIORITY_INTERACTIVE: settings.INFERENCE_INTERACTIVE_DEADLINE,
+        PRIORITY_BULK: settings.INFERENCE_BULK_DEADLINE,
+    }.get(priority)
+    return deadline or None
+
+
+def cpu_stats():
+    import torch
+
+    return {
+        'available_cpus': available_cpus(),
+        'cgroup_cpu_limit': cgroup_cpu_limit(),
+        'torch_threads': torch.get_num_threads(),
+        'deadlines_s': {name: deadline_for(priority) for priority, name in PRIORITY_NAMES.items()},
+    }
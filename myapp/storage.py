@@ -0,0 +1,373 @@
+"""
+Media storage backends
+
+All media (originals, annotated outputs, thumbnails, videos and their
+detections) is read and written through Django's default storage, chosen by
+settings.MEDIA_STORAGE:
+
+- local: LocalMediaStorage, files under MEDIA_ROOT (one host, or a volume
+  shared by all replicas)
+- s3: S3MediaStorage, objects in an S3-compatible bucket (AWS S3, MinIO,
+  Ceph RGW...), so web and inference replicas share no filesystem (boto3).
+
+Both stream: writes copy a file object in chunks (multipart uploads on S3)
+and reads spool to a temporary file, so memory per request stays bounded
+whatever the file size. On top of the Storage API they provide what the
+content-addressed layout (myapp/blobs.py) and the sweeps (myapp/sweeper.py)
+need: overwriting atomic writes, links or server-side copies, recursive
+sizes and removal, and a sorted listing that can resume after a checkpoint.
+"""
+
+import os
+import shutil
+import logging
+import tempfile
+import mimetypes
+import threading
+from contextlib import contextmanager
+from urllib.parse import quote
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, Storage
+from django.utils.deconstruct import deconstructible
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+# Downloads larger than this spool to disk instead of memory
+SPOOL_SIZE = 1024 * 1024
+
+
+def iter_chunks(content, chunk_size=CHUNK_SIZE):
+    """Chunks of a Django File (from the start) or a plain file object"""
+    if hasattr(content, 'chunks'):
+        yield from content.chunks(chunk_size)
+        return
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    for chunk in iter(lambda: content.read(chunk_size), b''):
+        yield chunk
+
+
+@deconstructible
+class LocalMediaStorage(FileSystemStorage):
+    """Media under MEDIA_ROOT on the local (or a shared) filesystem"""
+
+    def write(self, name, content):
+        """Store a file object at `name`, atomically replacing any file there; returns its size"""
+        path = self.path(name)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        size = 0
+        # Temporary file in the same directory, then rename, so readers never see a partial file
+        with tempfile.NamedTemporaryFile('wb', dir=directory, suffix='.tmp', delete=False) as staged:
+            for chunk in iter_chunks(content):
+                staged.write(chunk)
+                size += len(chunk)
+        os.chmod(staged.name, 0o644)
+        os.replace(staged.name, path)
+        return size
+
+    def link(self, source, name):
+        """Make the file at `source` also available at `name`, hard-linked where the filesystem allows"""
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        staged = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.link(self.path(source), staged)
+        except OSError:
+            shutil.copyfile(self.path(source), staged)
+        os.replace(staged, path)
+        return os.path.getsize(path)
+
+    def tree_size(self, name):
+        """Bytes of a file or directory tree, 0 if it's gone"""
+        path = self.path(name)
+        try:
+            if not os.path.isdir(path):
+                return os.path.getsize(path)
+        except OSError:
+            return 0
+        total = 0
+        for root, dirs, files in os.walk(path):
+            for filename in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, filename))
+                except OSError:
+                    pass
+        return total
+
+    def remove(self, name):
+        """Remove a file or directory tree; returns the bytes freed"""
+        path = self.path(name)
+        size = self.tree_size(name)
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            return 0
+        return size
+
+    def is_dir(self, name):
+        return os.path.isdir(self.path(name))
+
+    def rmdir(self, name):
+        """Remove an empty directory; False if it isn't one"""
+        try:
+            os.rmdir(self.path(name))
+            return True
+        except OSError:
+            return False
+
+    def walk(self, directory, after=None):
+        """
+        (name, size, modified timestamp) of the files under `directory` in
+        sorted path order, skipping everything up to and including `after`
+        """
+        after_parts = tuple(after.split('/')) if after else None
+        try:
+            entries = sorted(os.scandir(self.path(directory)), key=lambda entry: entry.name)
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            name = f'{directory}/{entry.name}'
+            parts = tuple(name.split('/'))
+            if entry.is_dir(follow_symlinks=False):
+                if after_parts is None or after_parts[:len(parts)] == parts:
+                    yield from self.walk(name, after)
+                elif parts > after_parts:
+                    yield from self.walk(name)
+            elif after_parts is None or parts > after_parts:
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                yield name, stat.st_size, stat.st_mtime
+
+    @contextmanager
+    def local_copy(self, name):
+        """A local path of the file, for libraries that only open paths (OpenCV video capture)"""
+        yield self.path(name)
+
+
+@deconstructible
+class S3MediaStorage(Storage):
+    """
+    Media as objects in an S3-compatible bucket (MEDIA_S3_* settings;
+    credentials come from the usual AWS_* environment variables or the
+    instance role). URLs are MEDIA_S3_PUBLIC_URL + key when the bucket or a
+    CDN in front of it is public, presigned GET URLs otherwise.
+    """
+
+    def __init__(self, bucket=None, endpoint_url=None, region=None, prefix=None, public_url=None, url_expiry=None):
+        self.bucket = bucket or settings.MEDIA_S3_BUCKET
+        self.endpoint_url = endpoint_url or settings.MEDIA_S3_ENDPOINT_URL
+        self.region = region or settings.MEDIA_S3_REGION
+        self.prefix = (prefix if prefix is not None else settings.MEDIA_S3_PREFIX).strip('/')
+        self.public_url = (public_url if public_url is not None else settings.MEDIA_S3_PUBLIC_URL).rstrip('/')
+        self.url_expiry = url_expiry or settings.MEDIA_S3_URL_EXPIRY
+        if not self.bucket:
+            raise ImproperlyConfigured('MEDIA_STORAGE=s3 needs MEDIA_S3_BUCKET')
+        self._client = None
+        self._client_pid = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        # boto3 clients are thread-safe but their connection pools must not cross a fork
+        if self._client is None or self._client_pid != os.getpid():
+            with self._client_lock:
+                if self._client is None or self._client_pid != os.getpid():
+                    self._client = self._connect()
+                    self._client_pid = os.getpid()
+        return self._client
+
+    def _connect(self):
+        try:
+            import boto3
+            from botocore.config import Config
+        except ImportError as e:
+            raise ImproperlyConfigured('MEDIA_STORAGE=s3 needs boto3 (pip install boto3)') from e
+        return boto3.client('s3', endpoint_url=self.endpoint_url, region_name=self.region,
+                            config=Config(max_pool_connections=32, retries={'mode': 'standard'}))
+
+    @property
+    def transfer_config(self):
+        from boto3.s3.transfer import TransferConfig
+        # Multipart above 8 MB with at most 2 parts in flight, so a transfer holds no more than 16 MB
+        return TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024,
+                              max_concurrency=2)
+
+    def key(self, name):
+        name = name.replace('\\', '/').lstrip('/')
+        return f'{self.prefix}/{name}' if self.prefix else name
+
+    def name_of(self, key):
+        return key[len(self.prefix) + 1:] if self.prefix else key
+
+    def _missing(self, error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def _head(self, name):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as e:
+            if self._missing(e):
+                return None
+            raise
+
+    def _open(self, name, mode='rb'):
+        from botocore.exceptions import ClientError
+        if 'w' in mode or 'a' in mode:
+            raise ValueError('S3 media is written with save() or write(), not opened for writing')
+        spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        try:
+            self.client.download_fileobj(self.bucket, self.key(name), spooled, Config=self.transfer_config)
+        except ClientError as e:
+            spooled.close()
+            if self._missing(e):
+                raise FileNotFoundError(f'{name} is not in bucket {self.bucket}') from e
+            raise
+        spooled.seek(0)
+        return File(spooled, name)
+
+    def _save(self, name, content):
+        self.write(name, content)
+        return name
+
+    def write(self, name, content):
+        """Upload a file object to `name` (multipart for large files), replacing any object there; returns its size"""
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        size = getattr(content, 'size', None)
+        extra = {'ContentType': mimetypes.guess_type(name)[0] or 'application/octet-stream'}
+        self.client.upload_fileobj(_Unclosable(content), self.bucket, self.key(name), ExtraArgs=extra,
+                                   Config=self.transfer_config)
+        return size if size is not None else self.size(name)
+
+    def link(self, source, name):
+        """Server-side copy of `source` to `name`; the bytes never pass through this process"""
+        self.client.copy({'Bucket': self.bucket, 'Key': self.key(source)}, self.bucket, self.key(name),
+                         Config=self.transfer_config)
+        return self.size(name)
+
+    def exists(self, name):
+        return self._head(name) is not None
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def size(self, name):
+        head = self._head(name)
+        if head is None:
+            raise FileNotFoundError(name)
+        return head['ContentLength']
+
+    def get_modified_time(self, name):
+        head = self._head(name)
+        if head is None:
+            raise FileNotFoundError(name)
+        return head['LastModified']
+
+    def url(self, name):
+        if self.public_url:
+            return f'{self.public_url}/{quote(self.key(name))}'
+        return self.client.generate_presigned_url('get_object', Params={'Bucket': self.bucket, 'Key': self.key(name)},
+                                                  ExpiresIn=self.url_expiry)
+
+    def _objects(self, prefix, after=None):
+        """(key, size, modified) of the objects under a key prefix, in key order"""
+        paginator = self.client.get_paginator('list_objects_v2')
+        params = {'Bucket': self.bucket, 'Prefix': prefix}
+        if after:
+            params['StartAfter'] = after
+        for page in paginator.paginate(**params):
+            for item in page.get('Contents', []):
+                yield item['Key'], item['Size'], item['LastModified']
+
+    def listdir(self, path):
+        prefix = self.key(path).rstrip('/') + '/' if path else (f'{self.prefix}/' if self.prefix else '')
+        directories, files = [], []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, Delimiter='/'):
+            directories += [item['Prefix'][len(prefix):].rstrip('/') for item in page.get('CommonPrefixes', [])]
+            files += [item['Key'][len(prefix):] for item in page.get('Contents', [])]
+        return directories, files
+
+    def tree_size(self, name):
+        """Bytes of an object or of everything under a prefix, 0 if there's nothing"""
+        head = self._head(name)
+        if head is not None:
+            return head['ContentLength']
+        return sum(size for _, size, _ in self._objects(self.key(name).rstrip('/') + '/'))
+
+    def remove(self, name):
+        """Remove an object or everything under a prefix; returns the bytes freed"""
+        head = self._head(name)
+        if head is not None:
+            self.delete(name)
+            return head['ContentLength']
+        freed = 0
+        batch = []
+        for key, size, _ in self._objects(self.key(name).rstrip('/') + '/'):
+            batch.append({'Key': key})
+            freed += size
+            if len(batch) == 1000:
+                self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': batch, 'Quiet': True})
+                batch = []
+        if batch:
+            self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': batch, 'Quiet': True})
+        return freed
+
+    def is_dir(self, name):
+        page = self.client.list_objects_v2(Bucket=self.bucket, Prefix=self.key(name).rstrip('/') + '/', MaxKeys=1)
+        return page.get('KeyCount', 0) > 0
+
+    def rmdir(self, name):
+        # Prefixes don't exist without objects under them
+        return False
+
+    def walk(self, directory, after=None):
+        """(name, size, modified timestamp) of the objects under `directory` in key order, after `after`"""
+        start = self.key(after) if after else None
+        for key, size, modified in self._objects(self.key(directory).rstrip('/') + '/', start):
+            yield self.name_of(key), size, modified.timestamp()
+
+    @contextmanager
+    def local_copy(self, name):
+        """Download to a temporary file for libraries that only open paths (OpenCV video capture)"""
+        staged = tempfile.NamedTemporaryFile(suffix=os.path.splitext(name)[1], dir=settings.FILE_UPLOAD_TEMP_DIR,
+                                             delete=False)
+        try:
+            with staged:
+                self.client.download_fileobj(self.bucket, self.key(name), staged, Config=self.transfer_config)
+            yield staged.name
+        finally:
+            os.remove(staged.name)
+
+
+class _Unclosable:
+    """Passes reads and seeks through but not close(): boto3 closes the file objects it uploads"""
+
+    def __init__(self, content):
+        self.content = content
+
+    def read(self, size=-1):
+        return self.content.read(size)
+
+    def seek(self, offset, whence=0):
+        return self.content.seek(offset, whence)
+
+    def tell(self):
+        return self.content.tell()
+
+    def seekable(self):
+        return hasattr(self.content, 'seek')
+
+    def close(self):
+        pass
@@ -0,0 +1,476 @@
+"""
+Pipelined webcam processing
+
+Capture, inference and encoding run in their own threads joined by bounded
+buffers, so a slow model never stalls the camera. The capture stage keeps
+only the newest frame (older ones are dropped), the inference stage always
+works on the freshest frame available, and the encode stage draws the boxes
+and produces the MJPEG part served to the browser. The full detector only
+runs every few frames; a tracker (myapp/tracking.py) carries the boxes and
+the per-person helmet verdict across the frames in between.
+
+Each camera has a single shared pipeline per process: every viewer
+subscribes to the same encoded frames, and the camera is released when the
+last viewer leaves. A per-camera file lock in WEBCAM_LOCK_DIR lets only one
+process on the host open a device; that process also publishes each encoded
+frame to a file next to the lock, and viewers that land on another gunicorn
+worker relay those frames instead. When the owner's last viewer leaves, a
+relaying process takes the lock over and opens the camera itself.
+"""
+
+import os
+import time
+import fcntl
+import queue
+import hashlib
+import logging
+import threading
+from collections import deque
+import cv2
+from django.conf import settings
+from .batching import summarize
+from .inference import get_inference_engine, use_model, extract_detections, draw_detections, encode_jpeg
+from .tracking import tracker_from_settings
+from .scheduler import PRIORITY_LIVE, Overloaded, deadline_for
+from .metrics import collector, stage, record_detections
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Shared camera pipelines by source key
+_shared_cameras = {}
+# Cameras whose last viewer left and that are still being released
+_closing_cameras = {}
+_shared_cameras_lock = threading.Lock()
+
+
+def mjpeg_part(jpeg):
+    return (b'--frame\r\n'
+            b'Content-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n')
+
+
+class LatestSlot:
+    """Single-item buffer that always holds the newest value; readers wait for one they haven't seen"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._item = None
+        self._sequence = 0
+        self._unread = False
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, item):
+        with self._condition:
+            if self._unread:
+                self.dropped += 1
+            self._item = item
+            self._sequence += 1
+            self._unread = True
+            self._condition.notify_all()
+
+    def get(self, after_sequence=0, timeout=None):
+        """Return (sequence, item) for the newest item newer than `after_sequence`, or None on timeout/close"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._sequence > after_sequence or self.closed, timeout=timeout)
+            if self._sequence <= after_sequence:
+                return None
+            self._unread = False
+            return self._sequence, self._item
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+def put_dropping_oldest(buffer, item):
+    """Put into a bounded queue, discarding the oldest entry when it is full; returns True if one was dropped"""
+    dropped = False
+    while True:
+        try:
+            buffer.put_nowait(item)
+            return dropped
+        except queue.Full:
+            try:
+                buffer.get_nowait()
+                dropped = True
+            except queue.Empty:
+                pass
+
+
+class StageStats:
+    """Throughput of one pipeline stage over a sliding window"""
+
+    def __init__(self, window=2.0):
+        self.window = window
+        self.frames = 0
+        self.dropped = 0
+        self.shed = 0
+        self._timestamps = deque()
+        self._lock = threading.Lock()
+
+    def tick(self):
+        now = time.monotonic()
+        with self._lock:
+            self.frames += 1
+            self._timestamps.append(now)
+            while self._timestamps and now - self._timestamps[0] > self.window:
+                self._timestamps.popleft()
+
+    def fps(self):
+        with self._lock:
+            if len(self._timestamps) < 2:
+                return 0.0
+            span = self._timestamps[-1] - self._timestamps[0]
+            return round((len(self._timestamps) - 1) / span, 2) if span > 0 else 0.0
+
+    def as_dict(self):
+        return {'fps': self.fps(), 'frames': self.frames, 'dropped': self.dropped, 'shed': self.shed}
+
+
+class WebcamPipeline:
+    """Capture -> inference -> encode stages for one opened cv2.VideoCapture"""
+
+    def __init__(self, video_capture, model_name=None, tracker=None, queue_size=2, jpeg_quality=80):
+        self.video_capture = video_capture
+        self.model_name = model_name
+        self.tracker = tracker
+        self.jpeg_quality = jpeg_quality
+
+        self._stop = threading.Event()
+        self._captured = LatestSlot()
+        self._inferred = queue.Queue(maxsize=queue_size)
+        self._encoded = LatestSlot()
+        self._latencies = deque(maxlen=256)
+
+        self.capture_stats = StageStats()
+        self.inference_stats = StageStats()
+        self.encode_stats = StageStats()
+        self._threads = [
+            threading.Thread(target=self._capture_loop, name='webcam-capture', daemon=True),
+            threading.Thread(target=self._inference_loop, name='webcam-inference', daemon=True),
+            threading.Thread(target=self._encode_loop, name='webcam-encode', daemon=True),
+        ]
+        self._last_report = time.monotonic()
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._captured.close()
+        self._encoded.close()
+        for thread in self._threads:
+            thread.join(timeout=5)
+
+    @property
+    def running(self):
+        return not self._stop.is_set() and not self._encoded.closed
+
+    def _capture_loop(self):
+        while not self._stop.is_set():
+            success, frame = self.video_capture.read()
+            if not success:
+                logger.error("Failed to read frame from webcam")
+                break
+            # Overwrites any frame the inference stage has not picked up yet
+            self._captured.put((frame, time.monotonic()))
+            self.capture_stats.tick()
+        # Lets the later stages drain and finish
+        self._captured.close()
+
+    def _inference_loop(self):
+        sequence = 0
+        while not self._stop.is_set():
+            latest = self._captured.get(after_sequence=sequence, timeout=1)
+            if latest is None:
+                if self._captured.closed:
+                    break
+                continue
+            sequence, (frame, captured_at) = latest
+            try:
+                if get_inference_engine(self.model_name) is None:
+                    detections = None
+                elif self.tracker is not None and not self.tracker.needs_detection(frame):
+                    # Cheap frame: move the tracked boxes instead of running the model
+                    detections = self.tracker.propagate(frame)
+                else:
+                    # Looked up per frame, so a hot-reloaded model takes over without restarting the stream
+                    with use_model(self.model_name) as loaded, stage('webcam_inference'):
+                        result = loaded.engine.predict(frame, priority=PRIORITY_LIVE, deadline=deadline_for(PRIORITY_LIVE))
+                        detections = extract_detections(result, loaded.names)
+                    record_detections(detections, 'webcam')
+                    if self.tracker is not None:
+                        detections = self.tracker.update(frame, detections)
+            except Overloaded:
+                # The detector is backed up: keep the stream moving on tracked boxes and try again next frame
+                self.inference_stats.shed += 1
+                detections = self.tracker.propagate(frame) if self.tracker is not None else []
+            except Exception as e:
+                logger.error(f"Error processing frame: {str(e)}")
+                continue
+            if put_dropping_oldest(self._inferred, (frame, detections, captured_at)):
+                self.inference_stats.dropped += 1
+            self.inference_stats.tick()
+        put_dropping_oldest(self._inferred, None)
+
+    def _encode_loop(self):
+        while not self._stop.is_set():
+            try:
+                item = self._inferred.get(timeout=1)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            frame, detections, captured_at = item
+            if detections is None:
+                # Add text indicating model not loaded
+                cv2.putText(frame, "YOLO Model Not Loaded", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
+            else:
+                draw_detections(frame, detections)
+            # Encoded once, then shared by every subscriber
+            with stage('webcam_encode'):
+                part = mjpeg_part(encode_jpeg(frame, self.jpeg_quality))
+            self._encoded.put(part)
+            self._latencies.append(time.monotonic() - captured_at)
+            self.encode_stats.tick()
+            self._report()
+        self._encoded.close()
+
+    def _report(self):
+        # Periodic summary instead of a log line per frame
+        if time.monotonic() - self._last_report >= 30:
+            self._last_report = time.monotonic()
+            logger.info(f"Webcam pipeline stats: {self.stats()}")
+
+    def frames(self, timeout=5):
+        """
+        Yield the newest MJPEG part whenever a new one is ready, until the pipeline stops.
+
+        Each caller tracks its own position, so any number of subscribers can
+        read concurrently; a slow one simply skips to the newest frame.
+        """
+        sequence = 0
+        while not self._stop.is_set():
+            latest = self._encoded.get(after_sequence=sequence, timeout=timeout)
+            if latest is None:
+                if self._encoded.closed:
+                    break
+                continue
+            sequence, part = latest
+            yield part
+
+    def stats(self):
+        self.capture_stats.dropped = self._captured.dropped
+        stats = {
+            'capture': self.capture_stats.as_dict(),
+            'inference': self.inference_stats.as_dict(),
+            'encode': self.encode_stats.as_dict(),
+            'latency_ms': summarize(list(self._latencies)),
+        }
+        if self.tracker is not None:
+            stats['tracking'] = self.tracker.stats()
+        return stats
+
+
+def camera_path(key, suffix):
+    """File in WEBCAM_LOCK_DIR for camera `key`: its lock ('lock') or its latest published frame ('frame')"""
+    name = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(settings.WEBCAM_LOCK_DIR, f'camera-{name}.{suffix}')
+
+
+def lock_camera(key):
+    """
+    Open file holding an exclusive lock on camera `key` for this process;
+    None when locking is off, BlockingIOError if another process has it
+    """
+    if not settings.WEBCAM_LOCK_DIR:
+        return None
+    os.makedirs(settings.WEBCAM_LOCK_DIR, exist_ok=True)
+    lock_file = open(camera_path(key, 'lock'), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        raise
+    return lock_file
+
+
+class SharedCamera:
+    """One capture + inference pipeline shared by all viewers of a camera"""
+
+    def __init__(self, key, video_capture, pipeline, lock_file=None):
+        self.key = key
+        self.video_capture = video_capture
+        self.pipeline = pipeline
+        self.lock_file = lock_file
+        self.subscribers = 0
+        self.released = threading.Event()
+        self._publisher = None
+        if lock_file is not None:
+            self._publisher = threading.Thread(target=self._publish_loop, name='webcam-publish', daemon=True)
+            self._publisher.start()
+
+    def frames(self):
+        return self.pipeline.frames()
+
+    def _publish_loop(self):
+        # The latest frame for the viewers other processes relay (RelayedCamera)
+        path = camera_path(self.key, 'frame')
+        staged = f'{path}.{os.getpid()}.tmp'
+        for part in self.pipeline.frames():
+            try:
+                with open(staged, 'wb') as frame_file:
+                    frame_file.write(part)
+                os.replace(staged, path)
+            except OSError as e:
+                logger.error(f"Failed to publish a frame of camera {self.key}: {str(e)}")
+
+    def close(self):
+        try:
+            self.pipeline.stop()
+            self.video_capture.release()
+        finally:
+            if self.lock_file is not None:
+                self._publisher.join(timeout=5)
+                try:
+                    os.remove(camera_path(self.key, 'frame'))
+                except OSError:
+                    pass
+                # Closing the file drops the lock for the other processes
+                self.lock_file.close()
+        logger.info(f"Released camera {self.key}")
+
+
+class RelayedCamera:
+    """A camera another process on the host has open: its viewers here get the frames that process publishes"""
+
+    def __init__(self, key, poll_interval=0.02, probe_interval=1.0):
+        self.key = key
+        self.path = camera_path(key, 'frame')
+        self.poll_interval = poll_interval
+        self.probe_interval = probe_interval
+
+    def _read(self):
+        with open(self.path, 'rb') as frame_file:
+            return frame_file.read()
+
+    def frames(self):
+        """
+        Yield each newly published frame. Stops once the owning process has
+        let go of the camera, so the caller can acquire it again and open it
+        itself.
+        """
+        last = None
+        idle_since = probed_at = time.monotonic()
+        while True:
+            try:
+                stat = os.stat(self.path)
+                version = (stat.st_ino, stat.st_mtime_ns)
+                # Frames are replaced, never rewritten in place, so a read sees one whole frame
+                part = self._read() if version != last else None
+            except FileNotFoundError:
+                part = None
+            now = time.monotonic()
+            if part is not None:
+                last = version
+                idle_since = now
+                yield part
+                continue
+            if now - idle_since >= self.probe_interval and now - probed_at >= self.probe_interval:
+                # No new frame for a while: is the owner gone?
+                probed_at = now
+                try:
+                    lock_camera(self.key).close()
+                    return
+                except BlockingIOError:
+                    pass
+            time.sleep(self.poll_interval)
+
+
+def acquire_camera(key, open_source):
+    """
+    Subscribe to the shared pipeline for `key`, opening the camera for the
+    first viewer; a RelayedCamera if another process has it open, None if
+    it can't be opened
+    """
+    while True:
+        with _shared_cameras_lock:
+            closing = _closing_cameras.get(key)
+            if closing is None:
+                return _subscribe(key, open_source)
+        # The last viewer just left; the device can't be opened again until it has been released
+        closing.released.wait()
+
+
+def _subscribe(key, open_source):
+    # Called with _shared_cameras_lock held
+    camera = _shared_cameras.get(key)
+    if camera is not None and not camera.pipeline.running:
+        # The previous source ended (e.g. camera unplugged); start over
+        del _shared_cameras[key]
+        camera.close()
+        camera = None
+    if camera is None:
+        try:
+            lock_file = lock_camera(key)
+        except BlockingIOError:
+            logger.info(f"Camera {key} is open in another process, relaying its frames")
+            return RelayedCamera(key)
+        video_capture = open_source()
+        if video_capture is None:
+            if lock_file is not None:
+                lock_file.close()
+            return None
+        pipeline = WebcamPipeline(video_capture, tracker=tracker_from_settings())
+        camera = SharedCamera(key, video_capture, pipeline.start(), lock_file)
+        _shared_cameras[key] = camera
+    camera.subscribers += 1
+    logger.info(f"Camera {key} now has {camera.subscribers} viewer(s)")
+    return camera
+
+
+def release_camera(camera):
+    """Drop a subscription; the last viewer leaving stops the pipeline and releases the camera"""
+    if isinstance(camera, RelayedCamera):
+        return
+    with _shared_cameras_lock:
+        camera.subscribers -= 1
+        if camera.subscribers > 0:
+            return
+        if _shared_cameras.get(camera.key) is not camera:
+            # Already replaced and closed by acquire_camera
+            return
+        del _shared_cameras[camera.key]
+        _closing_cameras[camera.key] = camera
+    try:
+        camera.close()
+    finally:
+        with _shared_cameras_lock:
+            del _closing_cameras[camera.key]
+        camera.released.set()
+
+
+def camera_stats():
+    with _shared_cameras_lock:
+        cameras = list(_shared_cameras.values())
+    return [{'camera': camera.key, 'subscribers': camera.subscribers, **camera.pipeline.stats()} for camera in cameras]
+
+
+def _camera_fps():
+    with _shared_cameras_lock:
+        cameras = list(_shared_cameras.values())
+    return {(camera.key, name): stage_stats.fps()
+            for camera in cameras
+            for name, stage_stats in (('capture', camera.pipeline.capture_stats),
+                                      ('inference', camera.pipeline.inference_stats),
+                                      ('encode', camera.pipeline.encode_stats))}
+
+
+collector.gauge('ppe_webcam_fps', 'Frames per second of each webcam pipeline stage', ('camera', 'stage'),
+                callback=_camera_fps)
+collector.gauge('ppe_webcam_viewers', 'Viewers subscribed to each shared webcam pipeline', ('camera',),
+                callback=lambda: {(camera['camera'],): camera['subscribers'] for camera in camera_stats()})
@@ -0,0 +1,427 @@
+"""
+Storage sweeps: missing files, retention, quota and orphans
+
+Everything here runs outside the request path, in batches:
+
+- missing: uploads whose original file is gone (deleted by hand, lost
+  volume) are removed with their outputs. The inference worker pool checks
+  up to INTEGRITY_SWEEP_ROWS uploads every INTEGRITY_SWEEP_INTERVAL seconds,
+  carrying on from where the previous pass stopped.
+- age: finished uploads older than RETENTION_DAYS are removed.
+- quota: the oldest finished uploads are removed until the upload media
+  (UPLOAD_DIRS) fits in MEDIA_QUOTA_MB.
+- orphans: files under SWEPT_DIRS that no row refers to (left behind by
+  crashes, manual edits or migrate_media_layout) and content-addressed
+  files whose references are all gone are removed once they are older
+  than ORPHAN_GRACE_SECONDS.
+
+Rows are deleted a batch at a time with one query per table, then the files
+no remaining row shares are removed in parallel; a crash in between only
+leaves orphans for the next sweep. The long scans checkpoint their position
+in SWEEP_STATE_FILE, so an interrupted run (a CronJob hitting its deadline)
+resumes where it stopped. Sweeps hold a flock next to that file and, on
+PostgreSQL, an advisory lock, so one sweep runs at a time across the cron job
+and every worker replica. The sweep_storage management command runs them.
+"""
+
+import os
+import json
+import math
+import time
+import zlib
+import fcntl
+import signal
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connection, connections
+from django.db.models import Q
+from django.utils import timezone
+from .models import UploadedImage, VideoAnalysis, StoredFile
+from .blobs import LAYOUT_DIRS, ORIGINALS, release, collect
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Media subdirectories the sweeps manage; anything else in media storage is left alone
+UPLOAD_DIRS = LAYOUT_DIRS + ('uploads', 'outputs')
+SWEPT_DIRS = UPLOAD_DIRS + ('videos',)
+
+FINISHED = (UploadedImage.STATUS_DONE, UploadedImage.STATUS_FAILED)
+
+# PostgreSQL advisory lock shared by every process that sweeps
+SWEEP_LOCK_KEY = zlib.crc32(b'myapp.sweeper')
+
+
+class SweepState:
+    """Per-phase checkpoints of resumable sweeps, kept in a small JSON file"""
+
+    def __init__(self, path, enabled=True):
+        self.path = path
+        self.enabled = enabled
+        self.checkpoints = {}
+        if enabled and os.path.isfile(path):
+            try:
+                with open(path) as state_file:
+                    self.checkpoints = json.load(state_file)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable sweep state {path}: {str(e)}")
+
+    def get(self, phase):
+        return self.checkpoints.get(phase)
+
+    def set(self, phase, checkpoint):
+        if checkpoint is None:
+            self.checkpoints.pop(phase, None)
+        else:
+            self.checkpoints[phase] = checkpoint
+        if not self.enabled:
+            return
+        staged = f'{self.path}.tmp'
+        with open(staged, 'w') as state_file:
+            json.dump(self.checkpoints, state_file)
+        os.replace(staged, self.path)
+
+    def clear(self):
+        for phase in list(self.checkpoints):
+            self.set(phase, None)
+
+
+@contextmanager
+def sweep_lock(path):
+    """
+    Exclusive lock so overlapping sweeps don't run at the same time; yields
+    False if it's taken. The flock covers one host (or a shared volume); on
+    PostgreSQL an advisory lock also keeps other replicas out.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            if not _database_lock(True):
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                _database_lock(False)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _database_lock(acquire):
+    """Take (without waiting) or release the sweep's advisory lock; always succeeds off PostgreSQL"""
+    if connection.vendor != 'postgresql':
+        return True
+    function = 'pg_try_advisory_lock' if acquire else 'pg_advisory_unlock'
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT {function}(%s)', [SWEEP_LOCK_KEY])
+        return cursor.fetchone()[0]
+
+
+def path_size(name):
+    """Bytes of a media file or directory tree, 0 if it's gone"""
+    return default_storage.tree_size(name)
+
+
+def remove_path(name):
+    """Remove a media file or directory tree; returns the bytes freed"""
+    return default_storage.remove(name)
+
+
+def upload_files(uploaded_image):
+    """Media-relative files and directories that belong to an upload"""
+    files = {}
+    if uploaded_image.original_image:
+        files[uploaded_image.original_image.name] = 'original'
+    if uploaded_image.processed_image:
+        files[uploaded_image.processed_image] = 'processed'
+        for name in (uploaded_image.thumbnails or {}).values():
+            files[name] = uploaded_image.processed_image
+    # Per-upload output directory older versions wrote
+    legacy_dir = f'outputs/{uploaded_image.id}'
+    if default_storage.is_dir(legacy_dir):
+        # Removed as a whole, including a processed image stored inside it
+        files = {name: kind for name, kind in files.items() if not name.startswith(f'{legacy_dir}/')}
+        files[legacy_dir] = 'legacy'
+    return files
+
+
+def delete_uploads(uploads, executor, dry_run=False, deleted=Q(pk__in=[])):
+    """
+    Delete a batch of uploads, then remove the files no other upload still
+    uses. `deleted` matches uploads a dry run pretends are already gone.
+    Returns (rows, files, bytes freed).
+    """
+    if not uploads:
+        return 0, 0, 0
+    ids = [uploaded_image.id for uploaded_image in uploads]
+    files = {}
+    references = []
+    for uploaded_image in uploads:
+        files.update(upload_files(uploaded_image))
+        references += uploaded_image.media_names
+
+    removed = []
+    if not dry_run:
+        UploadedImage.objects.filter(id__in=ids).delete()
+        # Reference-counted files (myapp/blobs.py) go once their last upload is gone
+        untracked, removed = release(references)
+        files = {name: kind for name, kind in files.items() if name in untracked or kind == 'legacy'}
+    remaining = UploadedImage.objects.exclude(deleted | Q(id__in=ids))
+    originals = [name for name, kind in files.items() if kind == 'original']
+    processed = [name for name, kind in files.items() if kind == 'processed']
+    # Duplicate uploads share one original, processed image and its thumbnails
+    shared = set(remaining.filter(original_image__in=originals).values_list('original_image', flat=True))
+    shared |= set(remaining.filter(processed_image__in=processed).values_list('processed_image', flat=True))
+    unused = [name for name, kind in files.items() if name not in shared and kind not in shared]
+
+    if dry_run:
+        freed = sum(executor.map(path_size, unused))
+    else:
+        freed = sum(executor.map(remove_path, unused))
+    return len(ids), len(unused) + len(removed), freed + sum(removed)
+
+
+def sweep_missing_files(batch_size=500, dry_run=False, stop_event=None, state=None, workers=4, max_rows=0):
+    """
+    Delete uploads whose original file is missing, walking the table in id
+    order one batch at a time. Uploads younger than a minute are skipped, as
+    their file may still be being written. With `max_rows` the sweep stops
+    after about that many uploads and the next one carries on from the
+    checkpoint. Returns (checked, removed).
+    """
+    state = state or SweepState(settings.SWEEP_STATE_FILE, enabled=False)
+    cutoff = timezone.now() - timedelta(minutes=1)
+    checked = removed = 0
+    last_id = state.get('missing') or 0
+    if last_id:
+        logger.info(f"Resuming missing file sweep after upload {last_id}")
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        while (stop_event is None or not stop_event.is_set()) and not (max_rows and checked >= max_rows):
+            limit = min(batch_size, max_rows - checked) if max_rows else batch_size
+            batch = list(UploadedImage.objects.filter(id__gt=last_id, uploaded_at__lt=cutoff)
+                         .only('id', 'original_image', 'processed_image', 'thumbnails').order_by('id')[:limit])
+            if not batch:
+                state.set('missing', None)
+                break
+            last_id = batch[-1].id
+            checked += len(batch)
+            missing = [uploaded_image for uploaded_image, exists in zip(batch, executor.map(original_exists, batch))
+                       if not exists]
+            for uploaded_image in missing:
+                logger.warning(f"Original file of upload {uploaded_image.id} is missing"
+                               f"{'' if dry_run else ', removing it'}")
+            removed += delete_uploads(missing, executor, dry_run)[0]
+            if not dry_run:
+                state.set('missing', last_id)
+    logger.info(f"Missing file sweep: {checked} uploads checked, {removed} {'missing' if dry_run else 'removed'}")
+    return checked, removed
+
+
+def original_exists(uploaded_image):
+    original = uploaded_image.original_image
+    try:
+        return bool(original) and original.storage.exists(original.name)
+    except Exception as e:
+        # Unknown is not missing
+        logger.error(f"Error checking image {uploaded_image.id}: {str(e)}")
+        return True
+
+
+def _oldest_finished(batch_size, after=None):
+    uploads = UploadedImage.objects.filter(status__in=FINISHED)
+    if after is not None:
+        uploaded_at, pk = after
+        uploads = uploads.filter(Q(uploaded_at__gt=uploaded_at) | Q(uploaded_at=uploaded_at, id__gt=pk))
+    return list(uploads.only('id', 'uploaded_at', 'original_image', 'processed_image', 'thumbnails')
+                .order_by('uploaded_at', 'id')[:batch_size])
+
+
+def _up_to(cursor):
+    """Finished uploads at or before a (uploaded_at, id) cursor: the ones a dry run has already 'deleted'"""
+    if cursor is None:
+        return Q(pk__in=[])
+    uploaded_at, pk = cursor
+    return Q(status__in=FINISHED) & (Q(uploaded_at__lt=uploaded_at) | Q(uploaded_at=uploaded_at, id__lte=pk))
+
+
+def enforce_retention(max_age_days, batch_size=500, dry_run=False, workers=4, stop_event=None):
+    """Delete finished uploads older than `max_age_days`, oldest first. Returns (rows, files, bytes)"""
+    cutoff = timezone.now() - timedelta(days=max_age_days)
+    totals = [0, 0, 0]
+    cursor = None
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        while stop_event is None or not stop_event.is_set():
+            batch = [uploaded_image for uploaded_image in _oldest_finished(batch_size, cursor)
+                     if uploaded_image.uploaded_at < cutoff]
+            if not batch:
+                break
+            result = delete_uploads(batch, executor, dry_run, _up_to(cursor))
+            cursor = (batch[-1].uploaded_at, batch[-1].id)
+            totals = [total + value for total, value in zip(totals, result)]
+    logger.info(f"Retention ({max_age_days} days): {totals[0]} uploads, {totals[1]} files, "
+                f"{totals[2] / 1e6:.1f} MB {'would be ' if dry_run else ''}removed")
+    return tuple(totals)
+
+
+def media_usage(directories=UPLOAD_DIRS):
+    return sum(path_size(directory) for directory in directories)
+
+
+def enforce_quota(max_bytes, batch_size=500, dry_run=False, workers=4, stop_event=None, usage=None):
+    """
+    Delete the oldest finished uploads until the stored media fit in
+    `max_bytes`. Pass `usage` if media_usage() is already known, as it walks
+    the whole tree. Returns (rows, files, bytes)
+    """
+    if usage is None:
+        usage = media_usage()
+    # Batches sized from the average upload, so the sweep doesn't overshoot the quota by a whole batch
+    average = usage / max(1, UploadedImage.objects.count())
+    totals = [0, 0, 0]
+    cursor = None
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        while usage > max_bytes and (stop_event is None or not stop_event.is_set()):
+            limit = min(batch_size, max(1, math.ceil((usage - max_bytes) / max(1.0, average))))
+            batch = _oldest_finished(limit, cursor)
+            if not batch:
+                logger.warning(f"Media usage {usage / 1e6:.1f} MB stays over the quota with no finished uploads left")
+                break
+            result = delete_uploads(batch, executor, dry_run, _up_to(cursor))
+            cursor = (batch[-1].uploaded_at, batch[-1].id)
+            usage -= result[2]
+            totals = [total + value for total, value in zip(totals, result)]
+    logger.info(f"Quota ({max_bytes / 1e6:.0f} MB): {totals[0]} uploads, {totals[1]} files, "
+                f"{totals[2] / 1e6:.1f} MB {'would be ' if dry_run else ''}removed, {usage / 1e6:.1f} MB left")
+    return tuple(totals)
+
+
+def referenced(names):
+    """The subset of media-relative file names that some row still refers to"""
+    # Content-addressed files are tracked; unreferenced ones are left to collect() and its grace period
+    found = set(StoredFile.objects.filter(name__in=names).values_list('name', flat=True))
+    groups = {'original': [], 'processed': [], 'thumbnail': {}, 'video': [], 'detections': []}
+    for name in names:
+        parts = name.split('/')
+        if parts[0] in LAYOUT_DIRS:
+            groups['original' if parts[0] == ORIGINALS else 'processed'].append(name)
+        elif parts[0] == 'uploads':
+            groups['original'].append(name)
+        elif parts[0] == 'outputs' and len(parts) > 2 and parts[-2] == 'thumbs':
+            # outputs/thumbs/12_320.webp belongs to outputs/12.jpg
+            stem = os.path.splitext(parts[-1])[0].rpartition('_')[0]
+            groups['thumbnail'].setdefault('/'.join(parts[:-2] + [stem]), []).append(name)
+        elif parts[0] == 'outputs':
+            groups['processed'].append(name)
+        elif parts[0] == 'videos' and len(parts) > 2 and parts[1] == 'detections':
+            groups['detections'].append(name)
+        elif parts[0] == 'videos':
+            groups['video'].append(name)
+
+    uploads = UploadedImage.objects
+    found |= set(uploads.filter(original_image__in=groups['original']).values_list('original_image', flat=True))
+    found |= set(uploads.filter(processed_image__in=groups['processed']).values_list('processed_image', flat=True))
+    if groups['thumbnail']:
+        prefixes = Q()
+        for stem in groups['thumbnail']:
+            prefixes |= Q(processed_image__startswith=f'{stem}.')
+        for processed in uploads.filter(prefixes).values_list('processed_image', flat=True):
+            found.update(groups['thumbnail'].get(os.path.splitext(processed)[0], []))
+    videos = VideoAnalysis.objects
+    found |= set(videos.filter(source_file__in=groups['video']).values_list('source_file', flat=True))
+    found |= set(videos.filter(detections_file__in=groups['detections']).values_list('detections_file', flat=True))
+    return found
+
+
+def prune_legacy_dirs(names):
+    """Remove the per-upload outputs/<id>/ directories older versions wrote once they are empty"""
+    for name in names:
+        parts = name.split('/')
+        if parts[0] != 'outputs' or len(parts) < 3 or not parts[1].isdigit():
+            continue
+        for depth in range(len(parts) - 1, 1, -1):
+            if not default_storage.rmdir('/'.join(parts[:depth])):
+                break
+
+
+def sweep_orphans(grace_seconds, batch_size=500, dry_run=False, workers=4, stop_event=None, state=None):
+    """Remove files no row refers to, once older than `grace_seconds`. Returns (checked, files, bytes)"""
+    state = state or SweepState(settings.SWEEP_STATE_FILE, enabled=False)
+    checkpoint = state.get('orphans')
+    if checkpoint:
+        logger.info(f"Resuming orphan sweep after {checkpoint}")
+    cutoff = time.time() - grace_seconds
+    checked = orphans = freed = 0
+
+    def check_batch(executor, batch):
+        nonlocal orphans, freed
+        used = referenced([name for name, _, _ in batch])
+        unused = [(name, size) for name, size, modified in batch if name not in used and modified < cutoff]
+        if dry_run:
+            freed += sum(size for _, size in unused)
+        else:
+            names = [name for name, _ in unused]
+            freed += sum(executor.map(remove_path, names))
+            prune_legacy_dirs(names)
+            state.set('orphans', batch[-1][0])
+        orphans += len(unused)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        # Resume in the directory of the checkpoint, after the checkpointed file
+        start = SWEPT_DIRS.index(checkpoint.split('/')[0]) if checkpoint else 0
+        for directory in SWEPT_DIRS[start:]:
+            batch = []
+            for item in default_storage.walk(directory, checkpoint if directory == SWEPT_DIRS[start] else None):
+                if stop_event is not None and stop_event.is_set():
+                    break
+                batch.append(item)
+                checked += 1
+                if len(batch) >= batch_size:
+                    check_batch(executor, batch)
+                    batch = []
+            if batch:
+                check_batch(executor, batch)
+            if stop_event is not None and stop_event.is_set():
+                break
+        else:
+            state.set('orphans', None)
+        if not dry_run and (stop_event is None or not stop_event.is_set()):
+            # Stored files whose references all went away without being collected (e.g. a crash mid-delete)
+            removed = collect(older_than=timezone.now() - timedelta(seconds=grace_seconds))
+            orphans += len(removed)
+            freed += sum(removed)
+    logger.info(f"Orphan sweep: {checked} files checked, {orphans} orphans ({freed / 1e6:.1f} MB) "
+                f"{'found' if dry_run else 'removed'}")
+    return checked, orphans, freed
+
+
+def sweeper_main(interval):
+    """Entry point of the sweeper process of the inference worker pool"""
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    logger.info(f"Storage sweeper {os.getpid()} started, checking up to {settings.INTEGRITY_SWEEP_ROWS or 'all'} "
+                f"uploads every {interval:.0f}s")
+    while not stop_event.is_set():
+        started = time.monotonic()
+        try:
+            with sweep_lock(f'{settings.SWEEP_STATE_FILE}.lock') as acquired:
+                if acquired:
+                    # Re-read every pass: sweep_storage shares the checkpoint
+                    state = SweepState(settings.SWEEP_STATE_FILE)
+                    sweep_missing_files(stop_event=stop_event, state=state, max_rows=settings.INTEGRITY_SWEEP_ROWS)
+                else:
+                    logger.info("Another sweep is running, skipping this one")
+        except Exception as e:
+            logger.error(f"Missing file sweep failed: {str(e)}")
+        finally:
+            connections.close_all()
+        stop_event.wait(max(0.0, interval - (time.monotonic() - started)))
@@ -1,3 +1,1264 @@
-from django.test import TestCase
+import gc
+import io
+import os
+import json
+import time
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
+from urllib.parse import quote
 
-# Create your tests here.
+import cv2
+import numpy as np
+from botocore.exceptions import ClientError
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from . import jobs
+from .backends import compare_backends, detection_agreement
+from .batching import BatchingEngine
+from .blobs import ORIGINALS, PROCESSED, THUMBNAILS, acquire, collect, put, release, sharded_name
+from .cache import ResultCache, lookup_result, result_cache
+from .gallery import decode_cursor, encode_cursor, gallery_page
+from .inference import decode_image, encode_jpeg, run_detection
+from .metrics import AGGREGATE_SNAPSHOT, MetricsRegistry
+from .models import StoredFile, UploadedImage, VideoAnalysis
+from .preload import init_worker_process, preload_models
+from .registry import ModelRegistry
+from .scheduler import PRIORITY_BULK, Overloaded, available_cpus, cgroup_cpu_limit, thread_budget
+from .storage import S3MediaStorage
+from .streaming import camera_path, lock_camera
+from .thumbnails import write_thumbnails
+from .sweeper import SweepState, sweep_lock, sweep_missing_files
+from .tiling import merge_detections, plan_tiles
+from .tracking import DetectionTracker
+from .views import gen_frames
+
+
+class JobQueueTests(TestCase):
+    def make_job(self, **fields):
+        return UploadedImage.objects.create(original_image='uploads/test.jpg', **fields)
+
+    def test_claim_takes_oldest_pending_job(self):
+        first = self.make_job()
+        second = self.make_job()
+        self.make_job(status=UploadedImage.STATUS_DONE)
+
+        claimed = jobs.claim_next_job()
+        self.assertEqual(claimed.id, first.id)
+        self.assertEqual(claimed.status, UploadedImage.STATUS_PROCESSING)
+        self.assertEqual(claimed.attempts, 1)
+        self.assertIsNotNone(claimed.started_at)
+
+        self.assertEqual(jobs.claim_next_job().id, second.id)
+        self.assertIsNone(jobs.claim_next_job())
+
+    def test_claim_skips_job_taken_by_another_worker(self):
+        contested = self.make_job()
+        other = self.make_job()
+        real_now = timezone.now
+        raced = []
+
+        def now():
+            # Another worker claims the job between our read and our update
+            if not raced:
+                raced.append(True)
+                UploadedImage.objects.filter(id=contested.id).update(status=UploadedImage.STATUS_PROCESSING)
+            return real_now()
+
+        with mock.patch('myapp.jobs.timezone.now', side_effect=now):
+            claimed = jobs.claim_next_job()
+
+        self.assertEqual(claimed.id, other.id)
+        contested.refresh_from_db()
+        self.assertEqual(contested.attempts, 0)
+
+    @override_settings(INFERENCE_JOB_TIMEOUT=60, INFERENCE_MAX_ATTEMPTS=2)
+    def test_requeue_stale_jobs(self):
+        stale = self.make_job(status=UploadedImage.STATUS_PROCESSING, attempts=1)
+        exhausted = self.make_job(status=UploadedImage.STATUS_PROCESSING, attempts=2)
+        alive = self.make_job(status=UploadedImage.STATUS_PROCESSING, attempts=1)
+        UploadedImage.objects.filter(id__in=[stale.id, exhausted.id]).update(
+            updated_at=timezone.now() - timedelta(seconds=120))
+
+        self.assertEqual(jobs.requeue_stale_jobs(), (1, 1))
+        for job in (stale, exhausted, alive):
+            job.refresh_from_db()
+        self.assertEqual(stale.status, UploadedImage.STATUS_PENDING)
+        self.assertEqual(exhausted.status, UploadedImage.STATUS_FAILED)
+        self.assertEqual(exhausted.error_message, 'Inference timed out')
+        self.assertEqual(alive.status, UploadedImage.STATUS_PROCESSING)
+
+    def test_process_job_records_failure(self):
+        job = self.make_job(status=UploadedImage.STATUS_PROCESSING, attempts=1)
+
+        with mock.patch('myapp.inference.use_model', side_effect=RuntimeError('model missing')):
+            self.assertFalse(jobs.process_job(job))
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, UploadedImage.STATUS_FAILED)
+        self.assertEqual(job.error_message, 'model missing')
+        self.assertIsNotNone(job.processed_at)
+
+    def test_process_job_retry_after_failure_succeeds(self):
+        job = self.make_job()
+        claimed = jobs.claim_next_job()
+
+        @contextmanager
+        def use_model(name=None):
+            yield SimpleNamespace(version='v2')
+
+        def run_detection(uploaded_image, loaded=None):
+            if uploaded_image.attempts == 1:
+                raise RuntimeError('out of memory')
+            uploaded_image.detection_results = [{'class': 'helmet', 'class_id': 0, 'confidence': 0.9,
+                                                 'box': [1, 2, 3, 4]}]
+            uploaded_image.processed_image = 'outputs/test.jpg'
+
+        with mock.patch('myapp.inference.use_model', use_model), \
+                mock.patch('myapp.inference.run_detection', run_detection), \
+                mock.patch('myapp.cache.lookup_result', return_value=None), \
+                mock.patch('myapp.cache.remember_result'):
+            self.assertFalse(jobs.process_job(claimed))
+
+            # A failed job can be queued again and succeeds on the next attempt
+            UploadedImage.objects.filter(id=job.id).update(status=UploadedImage.STATUS_PENDING)
+            retried = jobs.claim_next_job()
+            self.assertEqual(retried.attempts, 2)
+            self.assertTrue(jobs.process_job(retried))
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, UploadedImage.STATUS_DONE)
+        self.assertEqual(job.error_message, '')
+        self.assertEqual(job.model_version, 'v2')
+        self.assertEqual(list(job.detections.values_list('class_name', flat=True)), ['helmet'])
+
+
+class MigrationTests(TransactionTestCase):
+    def migrate(self, target):
+        """Migrate myapp to `target` and return the historical models at that point"""
+        executor = MigrationExecutor(connection)
+        executor.migrate([('myapp', target)])
+        return executor.loader.project_state([('myapp', target)]).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_job_status_marks_inline_processed_rows_done_and_the_rest_failed(self):
+        apps = self.migrate('0003_alter_uploadedimage_processed_image')
+        UploadedImage = apps.get_model('myapp', 'UploadedImage')
+        processed = UploadedImage.objects.create(original_image='uploads/a.jpg', processed_image='outputs/a.jpg')
+        unprocessed = UploadedImage.objects.create(original_image='uploads/b.jpg')
+
+        apps = self.migrate('0004_uploadedimage_job_status')
+        UploadedImage = apps.get_model('myapp', 'UploadedImage')
+        self.assertEqual(UploadedImage.objects.get(id=processed.id).status, 'done')
+        unprocessed = UploadedImage.objects.get(id=unprocessed.id)
+        self.assertEqual(unprocessed.status, 'failed')
+        self.assertTrue(unprocessed.error_message)
+
+    def test_backfill_builds_detection_rows_from_results(self):
+        apps = self.migrate('0009_detection')
+        UploadedImage = apps.get_model('myapp', 'UploadedImage')
+        upload = UploadedImage.objects.create(original_image='uploads/a.jpg', detection_results=[
+            {'class': 'helmet', 'class_id': 0, 'confidence': 0.9, 'box': [1, 2, 3, 4]},
+            # Stored before the class id was recorded
+            {'class': 'no-vest', 'confidence': 0.4, 'box': [5, 6, 7, 8]},
+        ])
+        UploadedImage.objects.create(original_image='uploads/b.jpg', detection_results=None)
+
+        apps = self.migrate('0010_backfill_detections')
+        rows = apps.get_model('myapp', 'Detection').objects.order_by('id')
+        self.assertEqual([(row.image_id, row.class_id, row.class_name, row.confidence, row.x2) for row in rows],
+                         [(upload.id, 0, 'helmet', 0.9, 3), (upload.id, None, 'no-vest', 0.4, 7)])
+        self.assertTrue(all(row.uploaded_at == upload.uploaded_at for row in rows))
+
+
+class HeartbeatTests(TransactionTestCase):
+    # The heartbeat writes from its own thread, which needs committed rows
+    def test_heartbeat_keeps_job_alive(self):
+        job = UploadedImage.objects.create(original_image='uploads/test.jpg', status=UploadedImage.STATUS_PROCESSING)
+        UploadedImage.objects.filter(id=job.id).update(updated_at=timezone.now() - timedelta(days=1))
+
+        with jobs.heartbeat(job, interval=0.01):
+            deadline = timezone.now() + timedelta(seconds=5)
+            while UploadedImage.objects.get(id=job.id).updated_at < timezone.now() - timedelta(hours=1):
+                self.assertLess(timezone.now(), deadline)
+                # Don't starve the heartbeat's write of the SQLite lock
+                time.sleep(0.01)
+
+
+class BlobRefcountTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.media_root = directory.name
+        self.enterContext(override_settings(MEDIA_ROOT=self.media_root))
+
+    def stored(self, name):
+        return os.path.exists(os.path.join(self.media_root, name))
+
+    def test_identical_bytes_share_one_file(self):
+        name = put(b'image bytes', ORIGINALS, '.jpg')
+        self.assertEqual(put(b'image bytes', ORIGINALS, '.jpg'), name)
+        self.assertTrue(name.startswith(f'{ORIGINALS}/'))
+        self.assertEqual(name, sharded_name(ORIGINALS, name.split('/')[-1][:-4], '.jpg'))
+        self.assertTrue(self.stored(name))
+        self.assertEqual(StoredFile.objects.get(name=name).refs, 2)
+
+    def test_file_is_removed_with_its_last_reference(self):
+        name = put(b'image bytes', ORIGINALS, '.jpg')
+        acquire([name])
+        self.assertEqual(release([name]), ([], []))
+        self.assertTrue(self.stored(name))
+
+        # Legacy names have no row and are handed back to the caller
+        untracked, removed = release([name, 'uploads/old.jpg'])
+        self.assertEqual(untracked, ['uploads/old.jpg'])
+        self.assertEqual(removed, [len(b'image bytes')])
+        self.assertFalse(self.stored(name))
+        self.assertFalse(StoredFile.objects.filter(name=name).exists())
+
+    def test_release_counts_repeated_names(self):
+        name = put(b'image bytes', ORIGINALS, '.jpg', refs=2)
+        # An upload whose original and processed image are the same file drops both references
+        self.assertEqual(release([name, name])[1], [len(b'image bytes')])
+        self.assertEqual(release([name]), ([name], []))
+
+    def test_collect_respects_grace_period_and_new_references(self):
+        name = put(b'image bytes', ORIGINALS, '.jpg')
+        StoredFile.objects.filter(name=name).update(refs=0)
+        self.assertEqual(collect(older_than=timezone.now() - timedelta(hours=1)), [])
+        self.assertTrue(self.stored(name))
+
+        # A put of the same bytes before collection keeps the file
+        put(b'image bytes', ORIGINALS, '.jpg')
+        self.assertEqual(collect(), [])
+        StoredFile.objects.filter(name=name).update(refs=0)
+        self.assertEqual(collect(), [len(b'image bytes')])
+        self.assertFalse(self.stored(name))
+
+    def test_put_rewrites_a_file_lost_after_its_row(self):
+        name = put(b'image bytes', ORIGINALS, '.jpg')
+        os.remove(os.path.join(self.media_root, name))
+        put(b'image bytes', ORIGINALS, '.jpg')
+        self.assertTrue(self.stored(name))
+        self.assertEqual(StoredFile.objects.get(name=name).refs, 2)
+
+
+class FakeS3Client:
+    """In-memory stand-in for the boto3 S3 client calls S3MediaStorage makes (one bucket)"""
+
+    def __init__(self):
+        self.objects = {}
+        self.content_types = {}
+
+    def missing(self, operation):
+        return ClientError({'Error': {'Code': '404'}}, operation)
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.missing('HeadObject')
+        data, modified = self.objects[Key]
+        return {'ContentLength': len(data), 'LastModified': modified}
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None, Config=None):
+        self.objects[key] = (fileobj.read(), timezone.now())
+        self.content_types[key] = (ExtraArgs or {}).get('ContentType')
+
+    def download_fileobj(self, bucket, key, fileobj, Config=None):
+        if key not in self.objects:
+            raise self.missing('GetObject')
+        fileobj.write(self.objects[key][0])
+
+    def copy(self, source, bucket, key, Config=None):
+        self.objects[key] = self.objects[source['Key']]
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def delete_objects(self, Bucket, Delete):
+        for item in Delete['Objects']:
+            self.objects.pop(item['Key'], None)
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        return f"https://s3.test/{Params['Bucket']}/{Params['Key']}?expires={ExpiresIn}"
+
+    def list_objects_v2(self, Bucket, Prefix='', StartAfter='', Delimiter=None, MaxKeys=1000):
+        contents, prefixes = [], []
+        for key in sorted(key for key in self.objects if key.startswith(Prefix) and key > StartAfter):
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                prefix = Prefix + rest.split(Delimiter)[0] + Delimiter
+                if prefix not in prefixes:
+                    prefixes.append(prefix)
+            else:
+                data, modified = self.objects[key]
+                contents.append({'Key': key, 'Size': len(data), 'LastModified': modified})
+        contents = contents[:MaxKeys]
+        return {'KeyCount': len(contents), 'Contents': contents, 'CommonPrefixes': [{'Prefix': p} for p in prefixes]}
+
+    def get_paginator(self, operation):
+        return SimpleNamespace(paginate=lambda **params: [self.list_objects_v2(**params)])
+
+
+@override_settings(MEDIA_S3_BUCKET='media', MEDIA_S3_PREFIX='', MEDIA_S3_PUBLIC_URL='')
+class S3MediaStorageTests(TestCase):
+    def setUp(self):
+        self.client = FakeS3Client()
+        self.enterContext(mock.patch.object(S3MediaStorage, '_connect', return_value=self.client))
+        self.storage = S3MediaStorage(prefix='ppe')
+
+    def test_save_open_exists_delete(self):
+        name = self.storage.save('uploads/site photo.jpg', ContentFile(b'jpeg bytes'))
+        self.assertEqual(name, 'uploads/site photo.jpg')
+        self.assertEqual(self.client.content_types['ppe/uploads/site photo.jpg'], 'image/jpeg')
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual(self.storage.size(name), 10)
+        with self.storage.open(name) as stored:
+            self.assertEqual(stored.read(), b'jpeg bytes')
+
+        self.storage.delete(name)
+        self.assertFalse(self.storage.exists(name))
+        with self.assertRaises(FileNotFoundError):
+            self.storage.open(name)
+
+    def test_urls(self):
+        self.assertEqual(self.storage.url('outputs/a b.jpg'), 'https://s3.test/media/ppe/outputs/a b.jpg?expires=3600')
+        public = S3MediaStorage(prefix='ppe', public_url='https://cdn.example/')
+        self.assertEqual(public.url('outputs/a b.jpg'), 'https://cdn.example/ppe/outputs/a%20b.jpg')
+
+    def test_prefix_listing_size_and_removal(self):
+        for name in ('outputs/7/a.jpg', 'outputs/7/thumbs/a_320.webp', 'outputs/8.jpg'):
+            self.storage.write(name, ContentFile(b'1234'))
+        self.assertEqual(self.storage.listdir('outputs'), (['7'], ['8.jpg']))
+        self.assertTrue(self.storage.is_dir('outputs/7'))
+        self.assertEqual(self.storage.tree_size('outputs'), 12)
+        # Walks resume after a checkpoint, in key order
+        self.assertEqual([name for name, _, _ in self.storage.walk('outputs', after='outputs/7/a.jpg')],
+                         ['outputs/7/thumbs/a_320.webp', 'outputs/8.jpg'])
+        self.assertEqual(self.storage.remove('outputs/7'), 8)
+        self.assertEqual(sorted(self.client.objects), ['ppe/outputs/8.jpg'])
+
+    def test_blobs_go_to_sharded_keys_through_the_backend_switch(self):
+        backends = {'default': {'BACKEND': settings.MEDIA_STORAGE_BACKENDS['s3']},
+                    'staticfiles': settings.STORAGES['staticfiles']}
+        with override_settings(STORAGES=backends):
+            self.assertIsInstance(default_storage, S3MediaStorage)
+            name = put(b'image bytes', ORIGINALS, '.jpg')
+            self.assertRegex(name, r'^originals/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$')
+            self.assertEqual(self.client.objects[name][0], b'image bytes')
+            self.assertEqual(release([name]), ([], [len(b'image bytes')]))
+            self.assertNotIn(name, self.client.objects)
+
+
+class ResultCacheTests(TestCase):
+    def setUp(self):
+        result_cache.clear()
+
+    def test_hit_and_miss(self):
+        cache = ResultCache(max_size=2)
+        cache.put('a', 'v1', {'n': 1})
+        self.assertEqual(cache.get('a', 'v1'), {'n': 1})
+        self.assertIsNone(cache.get('b', 'v1'))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ResultCache(max_size=2)
+        cache.put('a', 'v1', {'n': 1})
+        cache.put('b', 'v1', {'n': 2})
+        cache.get('a', 'v1')
+        cache.put('c', 'v1', {'n': 3})
+        self.assertIsNone(cache.get('b', 'v1'))
+        self.assertIsNotNone(cache.get('a', 'v1'))
+
+    def test_versions_are_cached_separately(self):
+        cache = ResultCache(max_size=4)
+        cache.put('a', 'v1', {'n': 1})
+        # Other weights miss, without dropping what the first version cached
+        self.assertIsNone(cache.get('a', 'v2'))
+        cache.put('a', 'v2', {'n': 2})
+        self.assertEqual(cache.get('a', 'v1'), {'n': 1})
+        self.assertEqual(cache.get('a', 'v2'), {'n': 2})
+
+    def test_lookup_falls_back_to_database(self):
+        UploadedImage.objects.create(original_image='uploads/a.jpg', processed_image='outputs/a.jpg',
+                                     content_hash='abc', model_version='v1', status=UploadedImage.STATUS_DONE,
+                                     detection_results=[])
+        hits, misses = result_cache.hits, result_cache.misses
+
+        with mock.patch('myapp.cache.default_storage.exists', return_value=True):
+            self.assertIsNone(lookup_result('abc', 'v2'))
+            entry = lookup_result('abc', 'v1')
+        self.assertEqual(entry['processed_image'], 'outputs/a.jpg')
+        # Now served from the LRU
+        self.assertIs(lookup_result('abc', 'v1'), entry)
+        self.assertEqual((result_cache.hits - hits, result_cache.misses - misses), (2, 1))
+
+
+class InMemoryPipelineTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=directory.name))
+
+    def test_upload_is_decoded_annotated_and_encoded_once(self):
+        original = cv2.imencode('.png', np.zeros((64, 64, 3), dtype=np.uint8))[1].tobytes()
+        uploaded_image = UploadedImage.objects.create(original_image=put(original, ORIGINALS, '.png'),
+                                                      inference_mode='full')
+        boxes = SimpleNamespace(xyxy=np.array([[8.0, 8.0, 40.0, 40.0]]), conf=np.array([0.5]), cls=np.array([0.0]))
+        engine = mock.Mock(predict=mock.Mock(return_value=SimpleNamespace(boxes=boxes)))
+        loaded = SimpleNamespace(engine=engine, names={0: 'helmet'})
+
+        with mock.patch('myapp.inference.encode_jpeg', wraps=encode_jpeg) as encode:
+            detections = run_detection(uploaded_image, loaded)
+
+        self.assertEqual(detections, [{'class_id': 0, 'class': 'helmet', 'confidence': 0.5,
+                                       'box': [8.0, 8.0, 40.0, 40.0]}])
+        self.assertEqual(uploaded_image.detection_results, detections)
+        # The model gets the decoded pixels and the annotated frame is encoded exactly once
+        self.assertEqual(engine.predict.call_args.args[0].shape, (64, 64, 3))
+        encode.assert_called_once()
+        with default_storage.open(uploaded_image.processed_image, 'rb') as processed:
+            annotated = decode_image(processed.read())
+        blue, green, red = annotated[24, 8]
+        self.assertGreater(green, 200)
+        self.assertLess(max(blue, red), 80)
+
+    def test_undecodable_bytes_are_rejected(self):
+        with self.assertRaises(ValueError):
+            decode_image(b'not an image')
+
+
+class BackendAgreementTests(TestCase):
+    def fake_backend(self, box, class_id=0):
+        boxes = SimpleNamespace(xyxy=np.array([box]), conf=np.array([0.8]), cls=np.array([float(class_id)]))
+        return mock.Mock(names={0: 'helmet', 1: 'no_helmet'},
+                         predict=mock.Mock(return_value=[SimpleNamespace(boxes=boxes)]))
+
+    def compare(self, models):
+        def load(backend, weights_path, **kwargs):
+            if isinstance(models[backend], Exception):
+                raise models[backend]
+            return models[backend]
+
+        images = [np.zeros((64, 64, 3), dtype=np.uint8)] * 2
+        with mock.patch('myapp.backends.load_backend', side_effect=load):
+            return compare_backends('/models/ppe.pt', list(models), images, runs=2)['backends']
+
+    def test_agreement_is_measured_against_the_first_backend(self):
+        report = self.compare({
+            'torch': self.fake_backend([10.0, 10.0, 50.0, 50.0]),
+            # Slightly shifted box, same class: still the same detection
+            'onnx': self.fake_backend([11.0, 10.0, 51.0, 50.0]),
+            'openvino': self.fake_backend([10.0, 10.0, 50.0, 50.0], class_id=1),
+        })
+        self.assertEqual(report['torch']['detections'], 2)
+        self.assertNotIn('agreement', report['torch'])
+        self.assertEqual((report['onnx']['agreement_with'], report['onnx']['agreement']), ('torch', 1.0))
+        self.assertEqual(report['openvino']['agreement'], 0.0)
+        self.assertEqual(report['openvino']['path'], '/models/ppe_openvino_model')
+
+    def test_unavailable_backend_is_reported_and_skipped(self):
+        report = self.compare({
+            'torch': self.fake_backend([10.0, 10.0, 50.0, 50.0]),
+            'openvino': ModuleNotFoundError("No module named 'openvino'"),
+            'onnx': self.fake_backend([10.0, 10.0, 50.0, 50.0]),
+        })
+        self.assertEqual(report['openvino'], {'error': "No module named 'openvino'"})
+        self.assertEqual(report['onnx']['agreement'], 1.0)
+
+    def test_agreement_is_an_f1_score(self):
+        helmet = {'class_id': 0, 'box': [0, 0, 10, 10]}
+        other = {'class_id': 0, 'box': [20, 20, 30, 30]}
+        self.assertEqual(detection_agreement([], []), 1.0)
+        self.assertEqual(detection_agreement([helmet], []), 0.0)
+        self.assertAlmostEqual(detection_agreement([helmet, other], [helmet]), 2 / 3)
+
+
+class FakeModel:
+    """Returns each image back as its result, optionally holding the first call until released"""
+
+    def __init__(self, hold_first=False, fail_with=None):
+        self.batches = []
+        self.fail_with = fail_with
+        self.started = threading.Event()
+        self.release = threading.Event()
+        if not hold_first:
+            self.release.set()
+
+    def predict(self, images, **kwargs):
+        self.batches.append(list(images))
+        self.started.set()
+        self.release.wait(5)
+        if self.fail_with is not None:
+            error, self.fail_with = self.fail_with, None
+            raise error
+        return list(images)
+
+
+class BatchingEngineTests(TestCase):
+    def make_engine(self, model, **kwargs):
+        engine = BatchingEngine(model, **{'max_batch_size': 4, 'max_wait': 0.05, **kwargs})
+        self.addCleanup(engine.close)
+        self.addCleanup(model.release.set)
+        return engine
+
+    def test_concurrent_requests_share_a_batch(self):
+        model = FakeModel(hold_first=True)
+        engine = self.make_engine(model)
+        first = engine.submit('a')
+        self.assertTrue(model.started.wait(5))
+        queued = [engine.submit(image) for image in 'bcd']
+        model.release.set()
+
+        self.assertEqual(first.result(5), 'a')
+        self.assertEqual([future.result(5) for future in queued], ['b', 'c', 'd'])
+        self.assertEqual(model.batches, [['a'], ['b', 'c', 'd']])
+        self.assertEqual(engine.stats()['items'], 4)
+
+    def test_request_past_its_deadline_is_failed(self):
+        model = FakeModel(hold_first=True)
+        engine = self.make_engine(model)
+        engine.submit('a')
+        self.assertTrue(model.started.wait(5))
+        late = engine.submit('b', PRIORITY_BULK, deadline=0.01)
+        on_time = engine.submit('c', PRIORITY_BULK)
+        threading.Event().wait(0.05)
+        model.release.set()
+
+        with self.assertRaises(Overloaded):
+            late.result(5)
+        self.assertEqual(on_time.result(5), 'c')
+        self.assertEqual(engine.stats()['shed'], {'bulk': 1})
+
+    def test_submit_refuses_work_that_would_miss_its_deadline(self):
+        model = FakeModel(hold_first=True)
+        engine = self.make_engine(model)
+        engine._batch_time = 1.0
+        engine.submit('a')
+        self.assertTrue(model.started.wait(5))
+
+        with self.assertRaises(Overloaded):
+            engine.submit('b', deadline=0.5)
+        accepted = engine.submit('c', deadline=2.0)
+        model.release.set()
+        self.assertEqual(accepted.result(5), 'c')
+
+    def test_failed_batch_does_not_stop_the_engine(self):
+        model = FakeModel(fail_with=RuntimeError('boom'))
+        engine = self.make_engine(model)
+
+        with self.assertRaises(RuntimeError):
+            engine.predict('a', timeout=5)
+        self.assertEqual(engine.predict('b', timeout=5), 'b')
+        self.assertEqual(engine.stats()['errors'], 1)
+
+    def test_short_result_list_fails_the_batch(self):
+        model = FakeModel()
+        model.predict = lambda images, **kwargs: []
+        engine = self.make_engine(model)
+
+        with self.assertRaises(RuntimeError):
+            engine.predict('a', timeout=5)
+        self.assertTrue(engine._thread.is_alive())
+
+    def test_dead_dispatcher_is_restarted(self):
+        model = FakeModel()
+        engine = self.make_engine(model)
+        engine._queue.put((float('inf'), -1, None))
+        engine._thread.join(5)
+
+        self.assertEqual(engine.predict('a', timeout=5), 'a')
+
+
+@override_settings(INFERENCE_WARMUP_SHAPES='32x32', INFERENCE_MAX_BATCH_SIZE=2)
+class ModelRegistryTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.paths = {name: os.path.join(directory.name, f'{name}.pt') for name in ('default', 'a', 'b')}
+        self.write_weights('default', b'default v1')
+        # Each extra model takes 0.6 MB of a 1 MB budget, so only one of them fits at a time
+        self.write_weights('a', b'a' * 600 * 1024)
+        self.write_weights('b', b'b' * 600 * 1024)
+        self.enterContext(override_settings(YOLO_MODELS={name: {'path': path, 'backend': 'torch'}
+                                                         for name, path in self.paths.items()}))
+        self.enterContext(mock.patch('myapp.registry.load_weights', side_effect=self.load))
+        self.enterContext(mock.patch('myapp.registry.load_backend', side_effect=lambda backend, path, **kwargs:
+                                     self.load(path, backend)))
+        self.registry = ModelRegistry(memory_budget_mb=1, reload_check_interval=0)
+        self.addCleanup(lambda: [entry.close() for entry in self.registry._entries.values()])
+
+    def write_weights(self, name, data):
+        with open(self.paths[name], 'wb') as weights:
+            weights.write(data)
+
+    def load(self, path, backend):
+        model = FakeModel()
+        model.backend_name = backend
+        model.weights_path = path
+        model.names = {0: 'helmet'}
+        return model
+
+    def test_swap_keeps_pinned_version_until_released(self):
+        with self.registry.use() as old:
+            self.write_weights('default', b'default v2')
+            self.assertTrue(self.registry.reload())
+            new = self.registry.get()
+            self.assertNotEqual(new.version, old.version)
+            # The request that pinned the old version still has a working engine
+            self.assertTrue(old.retired)
+            self.assertFalse(old.engine._closed)
+            self.assertEqual(old.engine.submit(np.zeros((4, 4, 3), dtype=np.uint8)).result(5).shape, (4, 4, 3))
+            with self.registry.use() as pinned:
+                self.assertIs(pinned, new)
+        self.assertTrue(old.engine._closed)
+        self.assertFalse(new.engine._closed)
+
+    def test_lru_eviction_waits_for_pinned_model(self):
+        with self.registry.use('a') as a:
+            self.registry.get('b')
+            # 'a' no longer fits next to 'b'; it leaves the registry but stays usable while pinned
+            self.assertIsNone(self.registry.peek('a'))
+            self.assertTrue(a.retired)
+            self.assertFalse(a.engine._closed)
+        self.assertTrue(a.engine._closed)
+        self.assertIsNotNone(self.registry.peek('b'))
+
+    def test_default_model_is_never_evicted(self):
+        default = self.registry.get()
+        self.registry.get('a')
+        self.registry.get('b')
+        self.assertIs(self.registry.peek(), default)
+        self.assertFalse(default.retired)
+        self.assertEqual([entry.name for entry in self.registry._entries.values()], ['default', 'b'])
+
+
+@override_settings(INFERENCE_WARMUP_SHAPES='32x32', INFERENCE_MAX_BATCH_SIZE=2)
+class PreloadTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        paths = {name: os.path.join(directory.name, f'{name}.pt') for name in ('default', 'exported')}
+        for path in paths.values():
+            with open(path, 'wb') as weights:
+                weights.write(b'weights')
+        self.enterContext(override_settings(YOLO_MODELS={
+            'default': {'path': paths['default'], 'backend': 'torch'},
+            'exported': {'path': paths['exported'], 'backend': 'onnx'},
+        }))
+        self.enterContext(mock.patch('myapp.registry.load_weights', side_effect=self.load))
+        self.registry = ModelRegistry(reload_check_interval=0)
+        self.enterContext(mock.patch('myapp.preload.registry', self.registry))
+        self.thread_budget = self.enterContext(mock.patch('myapp.preload.apply_thread_budget', return_value=2))
+        self.addCleanup(lambda: [entry.close() for entry in self.registry._entries.values()])
+        self.addCleanup(gc.unfreeze)
+
+    def load(self, path, backend):
+        model = FakeModel()
+        model.backend_name = backend
+        model.weights_path = path
+        model.names = {0: 'helmet'}
+        model.fuse = mock.Mock()
+        return model
+
+    def test_parent_loads_torch_weights_without_starting_engines(self):
+        preloaded = preload_models()
+        self.assertEqual([entry.name for entry in preloaded], ['default'])
+        entry = self.registry.peek()
+        entry.model.fuse.assert_called_once()
+        # No batching thread and no warm-up before the fork
+        self.assertIsNone(entry.engine)
+        self.assertEqual(entry.model.batches, [])
+        self.assertIsNone(self.registry.peek('exported'))
+
+    def test_worker_sizes_threads_and_warms_up_the_preloaded_model(self):
+        preload_models()
+        model = self.registry.peek().model
+        init_worker_process(4)
+        self.thread_budget.assert_called_once_with(4)
+        self.assertIsNotNone(self.registry.peek().engine)
+        self.assertIs(self.registry.peek().model, model)
+        self.assertEqual(len(model.batches), 2)
+
+    def test_worker_can_skip_the_warm_up(self):
+        preload_models()
+        init_worker_process(4, warm_up=False)
+        self.assertIsNone(self.registry.peek().engine)
+
+
+class HealthTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=directory.name))
+        self.registry = self.enterContext(mock.patch('myapp.health.registry'))
+        self.registry.peek.return_value = None
+        self.warm_up = self.enterContext(mock.patch('myapp.health.warm_up_in_background'))
+
+    def warmed_up(self):
+        return SimpleNamespace(name='default', version='v1', backend='torch', engine=object(),
+                               load_seconds=0.5, warmup_seconds=0.25)
+
+    def test_liveness_does_not_touch_the_model(self):
+        response = Client().get('/health/live/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['status'], 'alive')
+        self.assertEqual(self.registry.mock_calls, [])
+
+    def test_not_ready_until_the_model_is_warmed_up(self):
+        response = Client().get('/health/ready/')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(json.loads(response.content)['status'], 'not ready')
+        self.warm_up.assert_called_once()
+
+        self.registry.peek.return_value = self.warmed_up()
+        response = Client().get('/health/ready/')
+        self.assertEqual(response.status_code, 200)
+        report = json.loads(response.content)
+        self.assertEqual((report['database'], report['model']['warmed_up']), ('ok', True))
+        self.warm_up.assert_called_once()
+
+    def test_check_system_loads_the_model(self):
+        self.registry.get.return_value = self.warmed_up()
+        out = io.StringIO()
+        call_command('check_system', stdout=out)
+        self.assertIn('Database: ok', out.getvalue())
+        self.assertIn('Model: default v1 (torch backend)', out.getvalue())
+        self.assertIn('System ready', out.getvalue())
+        self.registry.get.assert_called_once_with()
+
+    def test_check_system_fails_without_a_model(self):
+        self.registry.get.return_value = None
+        with self.assertRaises(CommandError):
+            call_command('check_system', stdout=io.StringIO())
+        call_command('check_system', '--skip-model', stdout=io.StringIO())
+
+
+class SchedulerTests(TestCase):
+    def cgroup(self, files):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for name, content in files.items():
+            os.makedirs(os.path.dirname(os.path.join(directory.name, name)), exist_ok=True)
+            with open(os.path.join(directory.name, name), 'w') as cgroup_file:
+                cgroup_file.write(content)
+        return directory.name
+
+    def test_cgroup_v2_quota(self):
+        self.assertEqual(cgroup_cpu_limit(self.cgroup({'cpu.max': '250000 100000\n'})), 2.5)
+        self.assertIsNone(cgroup_cpu_limit(self.cgroup({'cpu.max': 'max 100000\n'})))
+
+    def test_cgroup_v1_quota(self):
+        root = self.cgroup({'cpu/cpu.cfs_quota_us': '150000\n', 'cpu/cpu.cfs_period_us': '100000\n'})
+        self.assertEqual(cgroup_cpu_limit(root), 1.5)
+        root = self.cgroup({'cpu/cpu.cfs_quota_us': '-1\n', 'cpu/cpu.cfs_period_us': '100000\n'})
+        self.assertIsNone(cgroup_cpu_limit(root))
+        self.assertIsNone(cgroup_cpu_limit(self.cgroup({})))
+
+    @override_settings(INFERENCE_TORCH_THREADS=0, INFERENCE_CPU_SLOTS=0)
+    def test_thread_budget_splits_the_quota(self):
+        with mock.patch('os.sched_getaffinity', return_value=set(range(16))), \
+                mock.patch('myapp.scheduler.cgroup_cpu_limit', return_value=4.5):
+            # 16 visible cores but a 4.5 CPU quota: 4 usable, shared by the processes
+            self.assertEqual(available_cpus(), 4)
+            self.assertEqual(thread_budget(2), 2)
+            self.assertEqual(thread_budget(8), 1)
+            with self.settings(INFERENCE_CPU_SLOTS=1):
+                self.assertEqual(thread_budget(8), 4)
+            with self.settings(INFERENCE_TORCH_THREADS=3):
+                self.assertEqual(thread_budget(8), 3)
+
+
+class EarlyShedTests(TestCase):
+    # An overloaded server answers 503 before it reads (and spools) the request body
+    def setUp(self):
+        engine = mock.Mock()
+        engine.admit.side_effect = Overloaded(2.5)
+        self.enterContext(mock.patch('myapp.views.get_inference_engine', return_value=engine))
+
+    def assert_shed(self, response):
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '3')
+        self.assertFalse(hasattr(response.wsgi_request, '_files'))
+
+    def test_api_detect_reads_mode_from_query_string(self):
+        image = SimpleUploadedFile('site.jpg', b'\xff\xd8\xff' + b'\0' * 1024, content_type='image/jpeg')
+        self.assert_shed(Client().post('/api/detect', {'file': image, 'mode': 'full'}))
+        response = Client().post('/api/detect?mode=sideways', {'file': image})
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_upload_is_refused_before_the_files_are_read(self):
+        files = [SimpleUploadedFile(f'{index}.jpg', b'\xff\xd8\xff' + b'\0' * 1024, content_type='image/jpeg')
+                 for index in range(3)]
+        response = Client().post('/upload/bulk/', {'files': files, 'model': 'site-a'})
+        self.assert_shed(response)
+        self.assertIn('Inference queue is full', json.loads(response.content)['error'])
+
+
+class ApiDetectTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=directory.name))
+        self.enterContext(mock.patch('myapp.views.get_inference_engine'))
+        loaded = SimpleNamespace(name='default', version='v1')
+        self.enterContext(mock.patch('myapp.views.use_model', return_value=mock.MagicMock(
+            __enter__=mock.Mock(return_value=loaded), __exit__=mock.Mock(return_value=False))))
+        self.enterContext(mock.patch('myapp.views.detect_image', return_value=([], {'mode': 'full', 'tiles': 1})))
+        self.enterContext(mock.patch('myapp.views.save_detection'))
+
+    def test_raw_upload_is_stored_under_its_sniffed_format(self):
+        png = cv2.imencode('.png', np.zeros((8, 8, 3), dtype=np.uint8))[1].tobytes()
+        response = Client().post('/api/detect?persist=1', png, content_type='application/octet-stream')
+        self.assertEqual(response.status_code, 200)
+        uploaded_image = UploadedImage.objects.get(id=json.loads(response.content)['id'])
+        self.assertTrue(uploaded_image.original_image.name.endswith('.png'))
+        self.assertEqual(uploaded_image.original_name, 'api.png')
+
+
+class BulkUploadTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=directory.name))
+
+        def submit(image, priority, deadline):
+            future = Future()
+            future.set_result([])
+            return future
+
+        engine = mock.Mock(submit=mock.Mock(side_effect=submit))
+        loaded = SimpleNamespace(engine=engine, names={0: 'helmet'}, version='v1')
+        self.enterContext(mock.patch('myapp.views.get_inference_engine', return_value=engine))
+        self.enterContext(mock.patch('myapp.bulk.use_model', return_value=mock.MagicMock(
+            __enter__=mock.Mock(return_value=loaded), __exit__=mock.Mock(return_value=False))))
+        self.enterContext(mock.patch('myapp.bulk.save_detection'))
+        self.enterContext(mock.patch('myapp.bulk.extract_detections', return_value=[]))
+
+    def jpeg(self, value):
+        return cv2.imencode('.jpg', np.full((8, 8, 3), value, dtype=np.uint8))[1].tobytes()
+
+    def post_zip(self, members):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            for name, data in members:
+                zip_file.writestr(name, data)
+        upload = SimpleUploadedFile('photos.zip', archive.getvalue(), content_type='application/zip')
+        response = Client().post('/upload/bulk/', {'files': [upload]})
+        self.assertEqual(response.status_code, 200)
+        return [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    def test_zip_members_are_reported_one_line_each(self):
+        lines = self.post_zip([('a.jpg', self.jpeg(0)), ('notes.txt', b'hello'), ('b.jpg', b'not a jpeg')])
+        self.assertEqual([(line['name'], line['status']) for line in lines[:3]],
+                         [('a.jpg', 'done'), ('notes.txt', 'failed'), ('b.jpg', 'failed')])
+        self.assertEqual(lines[3]['summary']['done'], 1)
+        self.assertEqual(lines[3]['summary']['failed'], 2)
+        self.assertEqual(UploadedImage.objects.get().original_name, 'a.jpg')
+
+    def test_storage_error_fails_only_that_image(self):
+        def put_failing_first(data, *args, **kwargs):
+            if put_mock.call_count == 1:
+                raise OSError('disk full')
+            return put(data, *args, **kwargs)
+
+        with mock.patch('myapp.bulk.put', side_effect=put_failing_first) as put_mock:
+            lines = self.post_zip([('a.jpg', self.jpeg(0)), ('b.jpg', self.jpeg(255))])
+        self.assertEqual(lines[0], {'name': 'a.jpg', 'status': 'failed', 'error': 'disk full', 'index': 0})
+        self.assertEqual(lines[1]['status'], 'done')
+        self.assertEqual(lines[2]['summary']['total'], 2)
+
+
+@override_settings(VIDEO_API_TOKEN='secret', VIDEO_ALLOWED_HOSTS=['.cameras.example'])
+class VideoUploadTests(TestCase):
+    def setUp(self):
+        self.client = Client(enforce_csrf_checks=True)
+
+    def post_url(self, url, **headers):
+        return self.client.post('/videos/', {'url': url}, **headers)
+
+    def test_requires_csrf_token_or_api_token(self):
+        self.assertEqual(self.post_url('rtsp://gate.cameras.example/live').status_code, 403)
+        self.assertEqual(self.post_url('rtsp://gate.cameras.example/live', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        response = self.post_url('rtsp://gate.cameras.example/live', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(VideoAnalysis.objects.get().source_url, 'rtsp://gate.cameras.example/live')
+
+    def test_rejects_hosts_outside_the_allowlist(self):
+        for url in ('http://169.254.169.254/latest/meta-data', 'rtsp://cameras.example.evil.com/live',
+                    'http://localhost:8000/'):
+            self.assertEqual(self.post_url(url, HTTP_AUTHORIZATION='Bearer secret').status_code, 400, url)
+        self.assertFalse(VideoAnalysis.objects.exists())
+
+
+class FakeCapture:
+    def __init__(self):
+        self.released = False
+
+    def read(self):
+        time.sleep(0.01)
+        return True, np.zeros((48, 64, 3), dtype=np.uint8)
+
+    def release(self):
+        self.released = True
+
+
+class CameraRelayTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(WEBCAM_LOCK_DIR=directory.name))
+        self.enterContext(mock.patch('myapp.streaming.get_inference_engine', return_value=None))
+
+    def test_other_workers_relay_then_take_over(self):
+        # Another process has the camera open and publishes its frames
+        owner_lock = lock_camera('camera')
+        with open(camera_path('camera', 'frame'), 'wb') as frame_file:
+            frame_file.write(b'owner frame')
+        capture = FakeCapture()
+        frames = gen_frames(open_source=lambda: capture)
+        self.assertEqual(next(frames), b'owner frame')
+
+        # It lets go: this worker opens the camera itself instead of showing "No Camera Available"
+        os.remove(camera_path('camera', 'frame'))
+        owner_lock.close()
+        self.assertTrue(next(frames).startswith(b'--frame\r\nContent-Type: image/jpeg'))
+        # ... and publishes for the other workers in turn
+        deadline = time.monotonic() + 5
+        while not os.path.exists(camera_path('camera', 'frame')):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        frames.close()
+        self.assertTrue(capture.released)
+        self.assertFalse(os.path.exists(camera_path('camera', 'frame')))
+
+
+def detection(class_name, box, confidence=0.9):
+    return {'class': class_name, 'class_id': 0, 'confidence': confidence, 'box': list(box)}
+
+
+class DetectionTrackerTests(TestCase):
+    frame = np.zeros((120, 160, 3), dtype=np.uint8)
+
+    def make_tracker(self, **kwargs):
+        return DetectionTracker(**{'motion_threshold': 0, 'smoothing': 1.0, **kwargs})
+
+    def test_moving_object_keeps_its_track_id(self):
+        tracker = self.make_tracker()
+        first = tracker.update(self.frame, [detection('helmet', (10, 10, 40, 40)), detection('vest', (80, 10, 110, 60))])
+        second = tracker.update(self.frame, [detection('vest', (84, 12, 114, 62)), detection('helmet', (14, 10, 44, 40))])
+
+        ids = {item['class']: item['track_id'] for item in first}
+        self.assertEqual({item['class']: item['track_id'] for item in second}, ids)
+        self.assertEqual(len(set(ids.values())), 2)
+
+    def test_helmet_and_no_helmet_are_the_same_track(self):
+        tracker = self.make_tracker()
+        [first] = tracker.update(self.frame, [detection('helmet', (10, 10, 40, 40))])
+        [second] = tracker.update(self.frame, [detection('no helmet', (11, 10, 41, 40))])
+        self.assertEqual(second['track_id'], first['track_id'])
+
+    def test_unmatched_detection_starts_a_track_and_lost_tracks_expire(self):
+        tracker = self.make_tracker(max_missed=1)
+        [first] = tracker.update(self.frame, [detection('vest', (10, 10, 40, 40))])
+        [second] = tracker.update(self.frame, [detection('vest', (100, 60, 130, 100))])
+        self.assertNotEqual(second['track_id'], first['track_id'])
+
+        tracker.update(self.frame, [])
+        self.assertEqual(len(tracker.tracks), 1)
+        tracker.update(self.frame, [])
+        self.assertEqual(tracker.tracks, [])
+
+    def test_helmet_verdict_has_hysteresis(self):
+        tracker = self.make_tracker(helmet_threshold=0.7, helmet_margin=0.05)
+        verdicts = []
+        for confidence in (0.8, 0.68, 0.6, 0.72, 0.8):
+            [item] = tracker.update(self.frame, [detection('helmet', (10, 10, 40, 40), confidence)])
+            verdicts.append(item['class'])
+        self.assertEqual(verdicts, ['helmet', 'helmet', 'no helmet', 'no helmet', 'helmet'])
+
+    def test_detector_runs_every_interval(self):
+        tracker = self.make_tracker(detect_interval=3)
+        self.assertTrue(tracker.needs_detection(self.frame))
+        tracker.update(self.frame, [detection('vest', (10, 10, 40, 40))])
+
+        runs = []
+        for _ in range(6):
+            if tracker.needs_detection(self.frame):
+                runs.append(True)
+                tracker.update(self.frame, [detection('vest', (10, 10, 40, 40))])
+            else:
+                runs.append(False)
+                tracker.propagate(self.frame)
+        self.assertEqual(runs, [False, False, True, False, False, True])
+
+
+class DetectionSearchTests(TestCase):
+    def setUp(self):
+        start = timezone.now() - timedelta(days=3)
+        self.uploads = []
+        for day, results in enumerate([[('helmet', 0.9), ('no-helmet', 0.85)], [('no-helmet', 0.6)],
+                                       [('no-helmet', 0.95), ('vest', 0.7)]]):
+            upload = UploadedImage.objects.create(original_image=f'uploads/{day}.jpg', detection_results=[
+                detection(class_name, (0, 0, 10, 10), confidence) for class_name, confidence in results])
+            UploadedImage.objects.filter(id=upload.id).update(uploaded_at=start + timedelta(days=day))
+            upload.refresh_from_db()
+            upload.save_detections()
+            self.uploads.append(upload)
+
+    def search(self, query):
+        response = Client().get(f'/api/detections?{query}')
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_filters_by_class_and_confidence(self):
+        result = self.search('class=no-helmet&min_confidence=0.8')
+        self.assertEqual((result['detections'], result['images']), (2, 2))
+        self.assertEqual(result['by_class'], {'no-helmet': 2})
+        self.assertEqual(result['image_ids'], [self.uploads[2].id, self.uploads[0].id])
+
+        result = self.search('class=helmet&class=vest')
+        self.assertEqual(result['by_class'], {'helmet': 1, 'vest': 1})
+
+    def test_filters_by_time_range(self):
+        since = (self.uploads[1].uploaded_at - timedelta(hours=1)).isoformat()
+        until = (self.uploads[2].uploaded_at - timedelta(hours=1)).isoformat()
+        result = self.search(f'since={quote(since)}&until={quote(until)}')
+        self.assertEqual(result['image_ids'], [self.uploads[1].id])
+        self.assertEqual(self.search(f'since={quote(since)}')['detections'], 3)
+
+    def test_limit_pages_the_newest_images(self):
+        result = self.search('limit=2')
+        # Counts cover every match; only the image id list is cut
+        self.assertEqual((result['detections'], result['images']), (5, 3))
+        self.assertEqual(result['image_ids'], [self.uploads[2].id, self.uploads[1].id])
+
+    def test_rejects_invalid_parameters(self):
+        for query in ('min_confidence=high', 'since=yesterday', 'limit=many'):
+            self.assertEqual(Client().get(f'/api/detections?{query}').status_code, 400, query)
+
+
+class TilingTests(TestCase):
+    def test_tiles_cover_the_image_with_overlap(self):
+        tiles = plan_tiles(1500, 1000, tile=640, overlap=0.2)
+        self.assertEqual(tiles[0], (0, 0, 640, 640))
+        # The last row and column are aligned to the image edge
+        self.assertEqual(tiles[-1], (860, 360, 1500, 1000))
+        self.assertTrue(all(x2 - x1 == 640 and y2 - y1 == 640 for x1, y1, x2, y2 in tiles))
+
+        xs = sorted({x1 for x1, _, _, _ in tiles})
+        self.assertTrue(all(next_x < x + 640 for x, next_x in zip(xs, xs[1:])))
+        covered = np.zeros((1000, 1500), dtype=bool)
+        for x1, y1, x2, y2 in tiles:
+            covered[y1:y2, x1:x2] = True
+        self.assertTrue(covered.all())
+
+    def test_small_image_is_a_single_tile(self):
+        self.assertEqual(plan_tiles(500, 300, tile=640, overlap=0.2), [(0, 0, 500, 300)])
+
+    def test_merge_drops_duplicates_and_cut_off_halves(self):
+        detections = [
+            detection('helmet', (100, 100, 200, 200), 0.9),
+            # Same helmet seen by the neighbouring tile
+            detection('helmet', (102, 101, 201, 202), 0.8),
+            # Half of it, cut off by a tile border
+            detection('helmet', (150, 100, 200, 200), 0.7),
+            detection('helmet', (400, 100, 500, 200), 0.6),
+            {**detection('vest', (100, 100, 200, 200), 0.5), 'class_id': 1},
+        ]
+        merged = merge_detections(detections, iou_threshold=0.5)
+        self.assertEqual([(item['class'], item['confidence']) for item in merged],
+                         [('helmet', 0.9), ('helmet', 0.6), ('vest', 0.5)])
+
+
+class MetricsSnapshotTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.enterContext(override_settings(METRICS_DIR=self.directory, METRICS_FLUSH_INTERVAL=5))
+        self.registry = MetricsRegistry()
+        self.requests = self.registry.counter('test_requests_total', 'Requests', ('view',))
+        self.registry.gauge('test_viewers', 'Viewers')
+
+    def write_exited(self, name, requests, viewers=1, pid=2 ** 22 + 1):
+        # A process that is gone (no such pid, or a different start time) and stopped writing long ago
+        with open(os.path.join(self.directory, name), 'w') as snapshot:
+            json.dump({'pid': pid, 'started': 1, 'written_at': 0,
+                       'metrics': {'test_requests_total': [[['home'], requests]], 'test_viewers': [[[], viewers]]}},
+                      snapshot)
+
+    def test_exited_processes_are_folded_without_losing_counts(self):
+        self.requests.inc(view='home')
+        self.write_exited('1-100.json', 5)
+        self.write_exited('1-200.json', 7)
+        self.assertIn('test_requests_total{view="home"} 13', self.registry.render())
+
+        self.assertEqual(self.registry.fold_exited(), 2)
+        self.assertEqual([name for name in os.listdir(self.directory) if name.endswith('.json')], [AGGREGATE_SNAPSHOT])
+        rendered = self.registry.render()
+        self.assertIn('test_requests_total{view="home"} 13', rendered)
+        # Gauges of exited processes are not kept
+        self.assertNotIn('test_viewers{', rendered)
+
+        self.write_exited('2-300.json', 1)
+        self.registry.fold_exited()
+        self.assertIn('test_requests_total{view="home"} 14', self.registry.render())
+
+    def test_snapshot_is_named_by_pid_and_start_time(self):
+        self.requests.inc(view='home')
+        self.registry.flush()
+        [name] = [name for name in os.listdir(self.directory) if name.endswith('.json')]
+        self.assertEqual(name, self.registry.snapshot_name)
+        self.assertTrue(name.startswith(f'{os.getpid()}-'))
+
+        # Another process that had this pid before us is not mistaken for this one
+        self.write_exited(f'{os.getpid()}-1.json', 5, pid=os.getpid())
+        self.assertEqual(self.registry.fold_exited(), 1)
+        self.assertIn('test_requests_total{view="home"} 6', self.registry.render())
+
+
+@override_settings(THUMBNAIL_WIDTHS=[320, 960], THUMBNAIL_FORMAT='jpeg')
+class ThumbnailTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=directory.name))
+
+    def test_variants_are_named_after_the_processed_image(self):
+        processed = sharded_name(PROCESSED, 'ab' * 32, '.jpg')
+        thumbnails = write_thumbnails(processed, np.zeros((600, 1200, 3), dtype=np.uint8))
+        self.assertEqual(thumbnails, {
+            '320': sharded_name(THUMBNAILS, 'ab' * 32, '_320.jpg'),
+            '960': sharded_name(THUMBNAILS, 'ab' * 32, '_960.jpg'),
+        })
+        with default_storage.open(thumbnails['320'], 'rb') as variant:
+            self.assertEqual(decode_image(variant.read()).shape, (160, 320, 3))
+        self.assertEqual(StoredFile.objects.get(name=thumbnails['960']).refs, 1)
+
+    def test_widths_at_or_above_the_image_are_skipped(self):
+        self.assertEqual(list(write_thumbnails('outputs/12.jpg', np.zeros((300, 500, 3), dtype=np.uint8))), ['320'])
+        self.assertEqual(write_thumbnails('outputs/13.jpg', np.zeros((100, 320, 3), dtype=np.uint8)), {})
+
+    def test_gallery_offers_the_variants_through_srcset(self):
+        UploadedImage.objects.create(original_image='uploads/a.jpg', processed_image='outputs/a.jpg',
+                                     thumbnails={'960': 'outputs/thumbs/a_960.jpg', '320': 'outputs/thumbs/a_320.jpg'})
+        UploadedImage.objects.create(original_image='uploads/b.jpg', processed_image='outputs/b.jpg')
+        response = Client().get('/files/')
+        self.assertContains(response, 'src="/media/outputs/thumbs/a_320.jpg" '
+                                      'srcset="/media/outputs/thumbs/a_320.jpg 320w, /media/outputs/thumbs/a_960.jpg 960w"')
+        # Uploads without variants fall back to the full processed image
+        self.assertContains(response, 'src="/media/outputs/b.jpg" alt=')
+
+
+class GalleryPaginationTests(TestCase):
+    def setUp(self):
+        start = timezone.now() - timedelta(hours=1)
+        self.uploads = [UploadedImage.objects.create(original_image=f'uploads/{index}.jpg') for index in range(7)]
+        for index, upload in enumerate(self.uploads):
+            # Pairs share a timestamp, so the id has to break the tie
+            UploadedImage.objects.filter(id=upload.id).update(uploaded_at=start + timedelta(minutes=index // 2))
+        self.newest_first = [upload.id for upload in reversed(self.uploads)]
+
+    def test_cursor_round_trip(self):
+        upload = UploadedImage.objects.get(id=self.uploads[3].id)
+        self.assertEqual(decode_cursor(encode_cursor(upload)), (upload.uploaded_at, upload.id))
+        with self.assertRaises(ValueError):
+            decode_cursor('not-a-cursor')
+
+    def test_gallery_shows_client_file_names(self):
+        UploadedImage.objects.filter(id=self.uploads[6].id).update(original_name=jobs.client_name('C:\\site\\crew.jpg'))
+        response = Client().get('/files/')
+        self.assertContains(response, 'crew.jpg')
+        # Older rows fall back to the stored file name
+        self.assertContains(response, '5.jpg')
+        self.assertNotContains(response, 'C:')
+
+    def test_pages_forward_and_back(self):
+        pages, older = [], None
+        while True:
+            rows, older, newer = gallery_page(3, before=older)
+            pages.append(([row.id for row in rows], newer))
+            if older is None:
+                break
+        self.assertEqual([ids for ids, _ in pages],
+                         [self.newest_first[:3], self.newest_first[3:6], self.newest_first[6:]])
+        self.assertIsNone(pages[0][1])
+
+        # Walking back from the last page gives the same pages
+        rows, older, newer = gallery_page(3, after=pages[2][1])
+        self.assertEqual([row.id for row in rows], self.newest_first[3:6])
+        rows, older, newer = gallery_page(3, after=newer)
+        self.assertEqual([row.id for row in rows], self.newest_first[:3])
+        self.assertIsNone(newer)
+        self.assertIsNotNone(older)
+
+
+class SweeperTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.state_file = os.path.join(directory.name, 'sweep_state.json')
+        self.uploads = [UploadedImage.objects.create(original_image=f'uploads/sweep-{index}.jpg') for index in range(5)]
+        UploadedImage.objects.update(uploaded_at=timezone.now() - timedelta(hours=1))
+        self.missing = {self.uploads[1].id, self.uploads[3].id}
+        self.enterContext(mock.patch('myapp.sweeper.original_exists',
+                                     side_effect=lambda upload: upload.id not in self.missing))
+
+    def test_state_is_persisted(self):
+        SweepState(self.state_file).set('missing', 42)
+        self.assertEqual(SweepState(self.state_file).get('missing'), 42)
+        # Dry runs don't move the checkpoint on disk
+        SweepState(self.state_file, enabled=False).set('missing', 7)
+        self.assertEqual(SweepState(self.state_file).get('missing'), 42)
+        SweepState(self.state_file).clear()
+        self.assertIsNone(SweepState(self.state_file).get('missing'))
+
+    def test_sweep_resumes_from_checkpoint(self):
+        self.assertEqual(sweep_missing_files(batch_size=2, state=SweepState(self.state_file), max_rows=2), (2, 1))
+        self.assertEqual(SweepState(self.state_file).get('missing'), self.uploads[1].id)
+
+        # The next pass carries on after the checkpoint and clears it at the end of the table
+        self.assertEqual(sweep_missing_files(batch_size=2, state=SweepState(self.state_file)), (3, 1))
+        self.assertIsNone(SweepState(self.state_file).get('missing'))
+        self.assertEqual(set(UploadedImage.objects.values_list('id', flat=True)),
+                         {upload.id for upload in self.uploads} - self.missing)
+
+    def test_stop_event_keeps_checkpoint(self):
+        stop_event = threading.Event()
+        state = SweepState(self.state_file)
+        original_set = state.set
+
+        def stop_after_first_batch(phase, checkpoint):
+            original_set(phase, checkpoint)
+            stop_event.set()
+
+        with mock.patch.object(state, 'set', side_effect=stop_after_first_batch):
+            self.assertEqual(sweep_missing_files(batch_size=2, stop_event=stop_event, state=state), (2, 1))
+        self.assertEqual(SweepState(self.state_file).get('missing'), self.uploads[1].id)
+
+    def test_dry_run_removes_nothing(self):
+        self.assertEqual(sweep_missing_files(dry_run=True, state=SweepState(self.state_file, enabled=False)), (5, 2))
+        self.assertEqual(UploadedImage.objects.count(), 5)
+
+    def test_one_sweep_at_a_time(self):
+        with sweep_lock(f'{self.state_file}.lock') as acquired:
+            self.assertTrue(acquired)
+            with sweep_lock(f'{self.state_file}.lock') as again:
+                self.assertFalse(again)
@@ -0,0 +1,89 @@
+"""
+Gallery thumbnails
+
+When an upload finishes, the annotated image (still decoded in memory) is
+also written at THUMBNAIL_WIDTHS (320px and 960px by default) as WebP, or
+JPEG where OpenCV has no WebP encoder, next to the outputs. The gallery
+offers them through `srcset`, so a page downloads small variants instead of
+full-resolution annotated photos. Variants are named after the processed
+image, so duplicate uploads that share an output also share its thumbnails.
+Variants are content-addressed files like the outputs (myapp/blobs.py).
+The generate_thumbnails management command backfills older uploads.
+"""
+
+import os
+import logging
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+def thumbnail_extension():
+    if settings.THUMBNAIL_FORMAT == 'webp' and cv2.haveImageWriter('thumbnail.webp'):
+        return 'webp'
+    return 'jpg'
+
+
+def thumbnail_name(processed_image, width, extension):
+    """
+    Media-relative path of one variant: thumbnails/7c/02/<digest>_320.webp
+    for processed/7c/02/<digest>.jpg, outputs/thumbs/12_320.webp for an
+    older outputs/12.jpg
+    """
+    from .blobs import PROCESSED, THUMBNAILS
+
+    directory, filename = os.path.split(processed_image)
+    stem = os.path.splitext(filename)[0]
+    if directory.startswith(f'{PROCESSED}/'):
+        return f'{THUMBNAILS}/{directory[len(PROCESSED) + 1:]}/{stem}_{width}.{extension}'
+    return os.path.join(directory, 'thumbs', f'{stem}_{width}.{extension}').replace('\\', '/')
+
+
+def encode_thumbnail(image, width, extension):
+    height = round(image.shape[0] * width / image.shape[1])
+    resized = cv2.resize(image, (width, max(1, height)), interpolation=cv2.INTER_AREA)
+    if extension == 'webp':
+        params = [cv2.IMWRITE_WEBP_QUALITY, settings.THUMBNAIL_QUALITY]
+    else:
+        params = [cv2.IMWRITE_JPEG_QUALITY, settings.THUMBNAIL_QUALITY]
+    ok, buffer = cv2.imencode(f'.{extension}', resized, params)
+    if not ok:
+        raise Exception(f"Failed to encode {width}px thumbnail")
+    return buffer.tobytes()
+
+
+def write_thumbnails(processed_image, image, refs=1):
+    """
+    Store the variants of a decoded (annotated) BGR image with `refs`
+    references each and return {width: media-relative path} for the
+    UploadedImage.thumbnails field. Widths at or above the image's own
+    width are skipped; the processed image is already that small.
+    """
+    from .blobs import put_named
+
+    extension = thumbnail_extension()
+    thumbnails = {}
+    for width in sorted(settings.THUMBNAIL_WIDTHS):
+        if width >= image.shape[1]:
+            break
+        name = thumbnail_name(processed_image, width, extension)
+        thumbnails[str(width)] = put_named(encode_thumbnail(image, width, extension), name, refs)
+    return thumbnails
+
+
+def thumbnails_from_file(processed_image, refs=1):
+    """Variants of an already stored processed image (backfill)"""
+    with default_storage.open(processed_image, 'rb') as stored:
+        image = cv2.imdecode(np.frombuffer(stored.read(), dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Could not read {processed_image}")
+    return write_thumbnails(processed_image, image, refs)
+
+
+def remove_thumbnails(thumbnails):
+    for name in (thumbnails or {}).values():
+        default_storage.delete(name)
@@ -0,0 +1,154 @@
+"""
+Adaptive full-frame / downscaled / tiled inference
+
+The model sees a 640px input, so on 4000px site photos a distant worker's
+helmet shrinks to a few pixels. `detect_image` picks a mode from the image
+size (or the one requested):
+
+- full:       small images go to the model as they are
+- downscaled: medium images are resized once with INTER_AREA before the model
+- tiled:      large images are cut into overlapping tiles that are batched
+              through the engine together with one downscaled full-frame
+              pass (for objects larger than a tile), and the detections are
+              merged with class-wise cross-tile NMS
+"""
+
+import logging
+import cv2
+import numpy as np
+from django.conf import settings
+from .scheduler import PRIORITY_INTERACTIVE
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+MODE_AUTO = 'auto'
+MODE_FULL = 'full'
+MODE_DOWNSCALED = 'downscaled'
+MODE_TILED = 'tiled'
+MODES = (MODE_AUTO, MODE_FULL, MODE_DOWNSCALED, MODE_TILED)
+
+
+def choose_mode(width, height, requested=None):
+    """Resolve a requested mode (blank or 'auto' = settings.INFERENCE_TILE_MODE) for an image size"""
+    mode = requested or settings.INFERENCE_TILE_MODE
+    if mode != MODE_AUTO:
+        return mode
+    long_side = max(width, height)
+    if long_side <= settings.INFERENCE_IMGSZ:
+        return MODE_FULL
+    if long_side <= settings.INFERENCE_TILE_THRESHOLD:
+        return MODE_DOWNSCALED
+    return MODE_TILED
+
+
+def tile_offsets(length, tile, overlap):
+    """Start offsets along one axis; the last tile is aligned to the edge instead of running past it"""
+    if length <= tile:
+        return [0]
+    step = max(1, int(tile * (1 - overlap)))
+    offsets = list(range(0, length - tile, step))
+    offsets.append(length - tile)
+    return offsets
+
+
+def plan_tiles(width, height, tile=None, overlap=None):
+    """(x1, y1, x2, y2) windows covering the image with the configured overlap"""
+    tile = tile or settings.INFERENCE_TILE_SIZE
+    overlap = settings.INFERENCE_TILE_OVERLAP if overlap is None else overlap
+    return [(x, y, min(x + tile, width), min(y + tile, height))
+            for y in tile_offsets(height, tile, overlap)
+            for x in tile_offsets(width, tile, overlap)]
+
+
+def downscale(image, long_side):
+    height, width = image.shape[:2]
+    scale = long_side / max(width, height)
+    if scale >= 1:
+        return image, 1.0
+    resized = cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    return resized, scale
+
+
+def merge_detections(detections, iou_threshold=None, containment=0.8):
+    """
+    Greedy class-wise NMS over detections from overlapping tiles. Besides
+    the usual IoU test, a box mostly contained in a higher-scoring box of
+    the same class is dropped too: that is the half of an object a tile
+    border cut off.
+    """
+    iou_threshold = settings.INFERENCE_TILE_NMS_IOU if iou_threshold is None else iou_threshold
+    kept = []
+    for class_id in sorted({detection['class_id'] for detection in detections}):
+        candidates = sorted((d for d in detections if d['class_id'] == class_id), key=lambda d: d['confidence'], reverse=True)
+        boxes = np.array([d['box'][:4] for d in candidates], dtype=np.float32)
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        suppressed = np.zeros(len(candidates), dtype=bool)
+        for index in range(len(candidates)):
+            if suppressed[index]:
+                continue
+            kept.append(candidates[index])
+            rest = np.arange(index + 1, len(candidates))
+            rest = rest[~suppressed[rest]]
+            if not len(rest):
+                continue
+            x1 = np.maximum(boxes[index, 0], boxes[rest, 0])
+            y1 = np.maximum(boxes[index, 1], boxes[rest, 1])
+            x2 = np.minimum(boxes[index, 2], boxes[rest, 2])
+            y2 = np.minimum(boxes[index, 3], boxes[rest, 3])
+            intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+            union = areas[index] + areas[rest] - intersection
+            iou = intersection / np.maximum(union, 1e-6)
+            smaller = np.maximum(np.minimum(areas[index], areas[rest]), 1e-6)
+            suppressed[rest[(iou >= iou_threshold) | (intersection / smaller >= containment)]] = True
+    return sorted(kept, key=lambda d: d['confidence'], reverse=True)
+
+
+def offset_detections(detections, dx=0.0, dy=0.0, scale=1.0):
+    """Map detections from a tile / resized image back to original image coordinates"""
+    for detection in detections:
+        x1, y1, x2, y2 = detection['box'][:4]
+        detection['box'] = [x1 / scale + dx, y1 / scale + dy, x2 / scale + dx, y2 / scale + dy]
+    return detections
+
+
+def detect_image(image, loaded, mode=None, priority=PRIORITY_INTERACTIVE, deadline=None):
+    """Run detection in the requested (or adaptively chosen) mode; returns (detections, info)"""
+    from .inference import extract_detections
+
+    height, width = image.shape[:2]
+    mode = choose_mode(width, height, mode)
+    imgsz = settings.INFERENCE_IMGSZ
+
+    if mode == MODE_FULL:
+        detections = extract_detections(loaded.engine.predict(image, priority=priority, deadline=deadline), loaded.names)
+        return detections, {'mode': mode, 'tiles': 1}
+
+    if mode == MODE_DOWNSCALED:
+        resized, scale = downscale(image, imgsz)
+        detections = extract_detections(loaded.engine.predict(resized, priority=priority, deadline=deadline), loaded.names)
+        return offset_detections(detections, scale=scale), {'mode': mode, 'tiles': 1}
+
+    # Submit everything first so the engine batches the tiles together
+    windows = plan_tiles(width, height)
+    resized, scale = downscale(image, imgsz)
+    inputs = [(x1, y1, 1.0, np.ascontiguousarray(image[y1:y2, x1:x2])) for x1, y1, x2, y2 in windows]
+    if len(windows) > 1:
+        inputs.append((0, 0, scale, resized))
+    futures = []
+    try:
+        for dx, dy, tile_scale, tile in inputs:
+            futures.append((dx, dy, tile_scale, loaded.engine.submit(tile, priority, deadline)))
+    except Exception:
+        # Shed part-way through: don't leave the tiles already queued to run for nobody
+        for _, _, _, future in futures:
+            future.cancel()
+        raise
+
+    detections = []
+    for dx, dy, tile_scale, future in futures:
+        detections.extend(offset_detections(extract_detections(future.result(), loaded.names), dx, dy, tile_scale))
+    merged = merge_detections(detections)
+    logger.info(f"Tiled inference over {len(windows)} tile(s) of {width}x{height}: "
+                f"{len(detections)} raw, {len(merged)} merged detections")
+    return merged, {'mode': mode, 'tiles': len(futures)}
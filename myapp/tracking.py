@@ -0,0 +1,260 @@
+"""
+Lightweight tracking between detector runs
+
+The webcam pipeline runs the detector only every `detect_interval` frames,
+or sooner when the scene changes (frame-difference motion) or a track's
+helmet decision is ambiguous. In between, tracked boxes are propagated with
+a constant-velocity model, optionally corrected by sparse optical flow.
+
+Detections are associated to tracks by greedy IoU matching, which gives each
+person a stable track id. The helmet / no-helmet decision is made per track
+from an exponential moving average of the helmet confidence (with a small
+hysteresis band), instead of per frame, so labels no longer flicker.
+"""
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+HELMET_CLASS = 'helmet'
+NO_HELMET_CLASSES = ('no helmet', 'no-helmet', 'no_helmet', 'nohelmet')
+
+
+def iou(box_a, box_b):
+    x1, y1 = max(box_a[0], box_b[0]), max(box_a[1], box_b[1])
+    x2, y2 = min(box_a[2], box_b[2]), min(box_a[3], box_b[3])
+    intersection = max(0.0, x2 - x1) * max(0.0, y2 - y1)
+    if intersection <= 0:
+        return 0.0
+    area_a = (box_a[2] - box_a[0]) * (box_a[3] - box_a[1])
+    area_b = (box_b[2] - box_b[0]) * (box_b[3] - box_b[1])
+    return intersection / (area_a + area_b - intersection)
+
+
+def is_helmet_class(class_name):
+    return class_name == HELMET_CLASS or class_name in NO_HELMET_CLASSES
+
+
+def association_group(class_name):
+    # helmet / no helmet are the same object with a different verdict
+    return HELMET_CLASS if is_helmet_class(class_name) else class_name
+
+
+class Track:
+    """One tracked object: box, velocity per frame and smoothed class evidence"""
+
+    def __init__(self, track_id, detection, smoothing):
+        self.track_id = track_id
+        self.box = np.asarray(detection['box'][:4], dtype=np.float32)
+        self.velocity = np.zeros(4, dtype=np.float32)
+        self.class_id = detection['class_id']
+        self.class_name = detection['class']
+        self.group = association_group(detection['class'])
+        self.confidence = detection['confidence']
+        self.smoothing = smoothing
+        self.helmet_score = self._helmet_evidence(detection)
+        self.has_helmet = None
+        self.hits = 1
+        self.missed = 0
+        self.frames_since_update = 0
+
+    @staticmethod
+    def _helmet_evidence(detection):
+        if detection['class'] == HELMET_CLASS:
+            return detection['confidence']
+        if detection['class'] in NO_HELMET_CLASSES:
+            return 1.0 - detection['confidence']
+        return None
+
+    def predict(self, shift=None):
+        """Advance one frame: by the optical-flow shift when given, else by the estimated velocity"""
+        if shift is not None:
+            self.box = self.box + np.array([shift[0], shift[1], shift[0], shift[1]], dtype=np.float32)
+        else:
+            self.box = self.box + self.velocity
+        self.frames_since_update += 1
+
+    def update(self, detection):
+        box = np.asarray(detection['box'][:4], dtype=np.float32)
+        if self.frames_since_update:
+            observed = (box - self.box + self.velocity * self.frames_since_update) / self.frames_since_update
+            self.velocity = 0.5 * self.velocity + 0.5 * observed
+        self.box = box
+        self.class_id = detection['class_id']
+        self.class_name = detection['class']
+        a = self.smoothing
+        self.confidence = a * detection['confidence'] + (1 - a) * self.confidence
+        evidence = self._helmet_evidence(detection)
+        if evidence is not None:
+            self.helmet_score = evidence if self.helmet_score is None else a * evidence + (1 - a) * self.helmet_score
+        self.hits += 1
+        self.missed = 0
+        self.frames_since_update = 0
+
+    def helmet_verdict(self, threshold, margin):
+        """Smoothed helmet decision; only flips once the score leaves the hysteresis band"""
+        if self.helmet_score is None:
+            return None
+        if self.has_helmet is None:
+            self.has_helmet = self.helmet_score >= threshold
+        elif self.has_helmet and self.helmet_score < threshold - margin:
+            self.has_helmet = False
+        elif not self.has_helmet and self.helmet_score >= threshold + margin:
+            self.has_helmet = True
+        return self.has_helmet
+
+    def is_uncertain(self, threshold, margin):
+        return self.helmet_score is not None and abs(self.helmet_score - threshold) < margin
+
+
+class DetectionTracker:
+    """Decide when to run the detector and keep tracks alive between runs"""
+
+    def __init__(self, detect_interval=5, iou_threshold=0.3, motion_threshold=12.0, max_missed=2,
+                 helmet_threshold=0.7, helmet_margin=0.05, smoothing=0.3, optical_flow=False):
+        self.detect_interval = max(1, detect_interval)
+        self.iou_threshold = iou_threshold
+        self.motion_threshold = motion_threshold
+        self.max_missed = max_missed
+        self.helmet_threshold = helmet_threshold
+        self.helmet_margin = helmet_margin
+        self.smoothing = smoothing
+        self.optical_flow = optical_flow
+
+        self.tracks = []
+        self._next_id = 1
+        self._frames_since_detection = None
+        self._reference = None
+        self._previous_gray = None
+        self.detections_run = 0
+        self.frames_propagated = 0
+
+    @staticmethod
+    def _thumbnail(frame):
+        return cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (64, 48), interpolation=cv2.INTER_AREA)
+
+    def needs_detection(self, frame):
+        """True when the next frame should go through the detector"""
+        if self._frames_since_detection is None or self._frames_since_detection + 1 >= self.detect_interval:
+            return True
+        if self.motion_threshold and self._reference is not None:
+            motion = float(np.mean(cv2.absdiff(self._thumbnail(frame), self._reference)))
+            if motion >= self.motion_threshold:
+                return True
+        # Re-check ambiguous helmet verdicts twice as often
+        if self._frames_since_detection + 1 >= max(1, self.detect_interval // 2):
+            return any(track.is_uncertain(self.helmet_threshold, self.helmet_margin) for track in self.tracks)
+        return False
+
+    def update(self, frame, detections):
+        """Associate fresh detections with the tracks and return the tracked detections to draw"""
+        for track in self.tracks:
+            track.predict()
+
+        candidates = []
+        for t, track in enumerate(self.tracks):
+            for d, detection in enumerate(detections):
+                if association_group(detection['class']) != track.group:
+                    continue
+                overlap = iou(track.box, detection['box'])
+                if overlap >= self.iou_threshold:
+                    candidates.append((overlap, t, d))
+
+        matched_tracks, matched_detections = set(), set()
+        for overlap, t, d in sorted(candidates, reverse=True):
+            if t in matched_tracks or d in matched_detections:
+                continue
+            self.tracks[t].update(detections[d])
+            matched_tracks.add(t)
+            matched_detections.add(d)
+
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                track.missed += 1
+        self.tracks = [track for track in self.tracks if track.missed <= self.max_missed]
+        for d, detection in enumerate(detections):
+            if d not in matched_detections:
+                self.tracks.append(Track(self._next_id, detection, self.smoothing))
+                self._next_id += 1
+
+        self._frames_since_detection = 0
+        self._reference = self._thumbnail(frame)
+        self._previous_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if self.optical_flow else None
+        self.detections_run += 1
+        return self.current()
+
+    def propagate(self, frame):
+        """Move the tracks onto a frame the detector skipped and return the tracked detections"""
+        shifts = self._flow_shifts(frame) if self.optical_flow else {}
+        for track in self.tracks:
+            track.predict(shifts.get(track.track_id))
+        # Before the first detection (e.g. it was shed under load) there is nothing to count from
+        if self._frames_since_detection is not None:
+            self._frames_since_detection += 1
+        self.frames_propagated += 1
+        return self.current()
+
+    def _flow_shifts(self, frame):
+        """Median Lucas-Kanade displacement of corner features inside each live track"""
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        previous, self._previous_gray = self._previous_gray, gray
+        shifts = {}
+        if previous is None:
+            return shifts
+        height, width = gray.shape
+        for track in self.tracks:
+            if track.missed:
+                continue
+            x1, y1, x2, y2 = np.clip(track.box, 0, [width - 1, height - 1, width - 1, height - 1]).astype(int)
+            if x2 - x1 < 8 or y2 - y1 < 8:
+                continue
+            mask = np.zeros_like(previous)
+            mask[y1:y2, x1:x2] = 255
+            points = cv2.goodFeaturesToTrack(previous, maxCorners=20, qualityLevel=0.01, minDistance=3, mask=mask)
+            if points is None:
+                continue
+            moved, status, _ = cv2.calcOpticalFlowPyrLK(previous, gray, points, None)
+            good = status.reshape(-1) == 1
+            if good.any():
+                shifts[track.track_id] = np.median((moved - points).reshape(-1, 2)[good], axis=0)
+        return shifts
+
+    def current(self):
+        """Tracks confirmed by the latest detector run, in the detection_results format plus a track_id"""
+        detections = []
+        for track in self.tracks:
+            if track.missed:
+                continue
+            class_name = track.class_name
+            verdict = track.helmet_verdict(self.helmet_threshold, self.helmet_margin)
+            if verdict is not None:
+                class_name = HELMET_CLASS if verdict else 'no helmet'
+            detections.append({
+                'track_id': track.track_id,
+                'class_id': track.class_id,
+                'class': class_name,
+                'confidence': float(track.confidence),
+                'box': track.box.tolist(),
+            })
+        return detections
+
+    def stats(self):
+        total = self.detections_run + self.frames_propagated
+        return {
+            'tracks': sum(1 for track in self.tracks if not track.missed),
+            'detect_interval': self.detect_interval,
+            'detector_runs': self.detections_run,
+            'frames_propagated': self.frames_propagated,
+            'detector_ratio': round(self.detections_run / total, 3) if total else 0.0,
+        }
+
+
+def tracker_from_settings():
+    return DetectionTracker(
+        detect_interval=settings.WEBCAM_DETECT_INTERVAL,
+        iou_threshold=settings.WEBCAM_TRACKER_IOU_THRESHOLD,
+        motion_threshold=settings.WEBCAM_MOTION_THRESHOLD,
+        helmet_threshold=settings.HELMET_CONFIDENCE_THRESHOLD,
+        smoothing=settings.WEBCAM_TRACKER_SMOOTHING,
+        optical_flow=settings.WEBCAM_TRACKER_OPTICAL_FLOW,
+    )
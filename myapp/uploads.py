@@ -0,0 +1,95 @@
+import hashlib
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler
+
+# Leading bytes of the image formats OpenCV decodes for us
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+)
+
+
+def size_limit_message():
+    return f'File size exceeds {settings.UPLOAD_MAX_IMAGE_SIZE // (1024 * 1024)}MB limit'
+
+
+def sniff_image(head):
+    """Image format of a file from its first bytes, '' if it isn't one we accept"""
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    for signature, image_format in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return image_format
+    return ''
+
+
+class ContentHashUploadHandler(FileUploadHandler):
+    """
+    Compute a SHA-256 of every uploaded file and check it while it streams in.
+
+    The handler passes each chunk on unchanged to the next handler, so the
+    file is still stored by Django's memory/temporary-file handlers (only
+    uploads under FILE_UPLOAD_MAX_MEMORY_SIZE stay in memory). Digests are
+    collected on `request.upload_content_hashes` and the formats sniffed
+    from the first chunk on `request.upload_image_formats`, as lists per
+    field in the same order as `request.FILES.getlist(field_name)`. Files
+    declared as images stop being passed on once they exceed
+    UPLOAD_MAX_IMAGE_SIZE, so an oversized upload costs neither memory nor
+    disk; its size still shows it's over the limit.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.hasher = hashlib.sha256()
+        self.image_format = None
+        self.received = 0
+        self.limit = settings.UPLOAD_MAX_IMAGE_SIZE if (self.content_type or '').startswith('image/') else None
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.image_format is None:
+            self.image_format = sniff_image(raw_data[:16])
+        if self.limit is not None and self.received > self.limit:
+            # Already rejected; drop the rest instead of buffering it
+            return None
+        self.received += len(raw_data)
+        self.hasher.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        if not hasattr(self.request, 'upload_content_hashes'):
+            self.request.upload_content_hashes = {}
+            self.request.upload_image_formats = {}
+        self.request.upload_content_hashes.setdefault(self.field_name, []).append(self.hasher.hexdigest())
+        self.request.upload_image_formats.setdefault(self.field_name, []).append(self.image_format or '')
+        # Let the next handler build the actual UploadedFile
+        return None
+
+
+def get_content_hash(request, field_name, uploaded_file, index=0):
+    """Return the streamed SHA-256 of an uploaded file, hashing its chunks if the handler was not installed"""
+    hashes = getattr(request, 'upload_content_hashes', {}).get(field_name, [])
+    if index < len(hashes):
+        return hashes[index]
+
+    hasher = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        hasher.update(chunk)
+    uploaded_file.seek(0)
+    return hasher.hexdigest()
+
+
+def get_image_format(request, field_name, uploaded_file, index=0):
+    """Format sniffed from an uploaded file's first bytes ('' if it isn't an image we accept)"""
+    image_formats = getattr(request, 'upload_image_formats', {}).get(field_name, [])
+    if index < len(image_formats):
+        return image_formats[index]
+
+    uploaded_file.seek(0)
+    head = uploaded_file.read(16)
+    uploaded_file.seek(0)
+    return sniff_image(head)
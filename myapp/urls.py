@@ -7,4 +7,14 @@ urlpatterns = [
     path('webcam/', views.webcam_view, name='webcam_view'),
     path('webcam_feed/', views.webcam_prediction, name='webcam_prediction'),
     path('upload/', views.upload_file, name='upload_file'),
+    path('upload/bulk/', views.bulk_upload, name='bulk_upload'),
+    path('jobs/<int:pk>/', views.job_status, name='job_status'),
+    path('videos/', views.video_upload, name='video_upload'),
+    path('videos/<int:pk>/', views.video_status, name='video_status'),
+    path('api/detect', views.api_detect, name='api_detect'),
+    path('api/detections', views.api_detections, name='api_detections'),
+    path('inference/stats/', views.inference_stats, name='inference_stats'),
+    path('metrics', views.metrics, name='metrics'),
+    path('health/live/', views.health_live, name='health_live'),
+    path('health/ready/', views.health_ready, name='health_ready'),
 ]
@@ -0,0 +1,251 @@
+"""
+Video file and stream (RTSP/HTTP) ingestion
+
+Sources are decoded as a stream and only every `stride`-th frame is decoded
+and analysed (skipped frames are just grabbed). Sampled frames go through the
+shared batching engine with a bounded number in flight, and detections are
+appended to a packed binary file of DETECTION_DTYPE records instead of one
+JSON blob per frame, so memory stays bounded for hour-long footage.
+"""
+
+import time
+import logging
+import tempfile
+from collections import Counter, deque
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from .inference import use_model, extract_detections
+from .models import VideoAnalysis
+from .scheduler import PRIORITY_BULK
+from .metrics import record_detections
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# One record per detection; load with load_detections() or numpy.frombuffer(data, DETECTION_DTYPE)
+DETECTION_DTYPE = np.dtype([
+    ('frame', '<u4'),
+    ('time_ms', '<u4'),
+    ('class_id', '<u2'),
+    ('confidence', '<f4'),
+    ('x1', '<f4'),
+    ('y1', '<f4'),
+    ('x2', '<f4'),
+    ('y2', '<f4'),
+])
+
+STREAM_SCHEMES = ('rtsp://', 'rtsps://', 'http://', 'https://')
+
+
+def stream_url_allowed(url):
+    """Whether a stream URL points at a host in VIDEO_ALLOWED_HOSTS ('.example.com' also matches subdomains)"""
+    try:
+        host = (urlsplit(url).hostname or '').lower()
+    except ValueError:
+        return False
+    for allowed in settings.VIDEO_ALLOWED_HOSTS:
+        allowed = allowed.lower()
+        if allowed == '*' or host == allowed or (allowed.startswith('.') and (host.endswith(allowed) or host == allowed[1:])):
+            return True
+    return False
+
+
+def sampling_stride(source_fps, frame_stride=1, target_fps=None):
+    """Frames to advance per analysed frame: from target_fps when the source rate is known, else frame_stride"""
+    if target_fps and source_fps:
+        return max(1, round(source_fps / target_fps))
+    return max(1, int(frame_stride or 1))
+
+
+class FrameSampler:
+    """Iterate every `stride`-th frame of an opened capture, grabbing (not decoding) the frames in between"""
+
+    def __init__(self, video_capture, stride, source_fps=None, max_frames=None):
+        self.video_capture = video_capture
+        self.stride = stride
+        self.source_fps = source_fps
+        self.max_frames = max_frames
+        self.frames_read = 0
+
+    def __iter__(self):
+        while self.max_frames is None or self.frames_read < self.max_frames:
+            index = self.frames_read
+            if index % self.stride:
+                if not self.video_capture.grab():
+                    return
+                self.frames_read += 1
+                continue
+
+            success, frame = self.video_capture.read()
+            if not success:
+                return
+            self.frames_read += 1
+            time_ms = self.video_capture.get(cv2.CAP_PROP_POS_MSEC)
+            if not time_ms and self.source_fps:
+                # Streams often don't report a position
+                time_ms = index / self.source_fps * 1000
+            yield index, int(time_ms or 0), frame
+
+
+class DetectionWriter:
+    """
+    Append detections as packed DETECTION_DTYPE records and keep running
+    per-class totals. Records go to a local temporary file; store() copies
+    it to media storage.
+    """
+
+    def __init__(self):
+        self._file = tempfile.NamedTemporaryFile('w+b', suffix='.bin', dir=settings.FILE_UPLOAD_TEMP_DIR)
+        self.count = 0
+        self.frames_with_detections = 0
+        self.class_counts = Counter()
+
+    def write(self, frame_index, time_ms, detections):
+        if not detections:
+            return
+        records = np.empty(len(detections), dtype=DETECTION_DTYPE)
+        records['frame'] = frame_index
+        records['time_ms'] = time_ms
+        records['class_id'] = [detection['class_id'] for detection in detections]
+        records['confidence'] = [detection['confidence'] for detection in detections]
+        boxes = np.asarray([detection['box'] for detection in detections], dtype=np.float32)
+        records['x1'], records['y1'], records['x2'], records['y2'] = boxes.T
+        records.tofile(self._file)
+
+        self.count += len(detections)
+        self.frames_with_detections += 1
+        self.class_counts.update(detection['class'] for detection in detections)
+
+    def store(self, name):
+        """Write the records to media storage as `name`"""
+        self._file.flush()
+        default_storage.write(name, File(self._file))
+
+    def close(self):
+        self._file.close()
+
+
+def load_detections(video_analysis):
+    """Read the stored detections of an analysis as a numpy structured array"""
+    if not video_analysis.detections_file:
+        return np.empty(0, dtype=DETECTION_DTYPE)
+    with default_storage.open(video_analysis.detections_file, 'rb') as stored:
+        return np.frombuffer(stored.read(), dtype=DETECTION_DTYPE)
+
+
+@contextmanager
+def video_source(video_analysis):
+    """What OpenCV opens: a stream URL, or a local path of the uploaded file (downloaded from object storage)"""
+    if not video_analysis.source_file:
+        yield video_analysis.source_url
+        return
+    with video_analysis.source_file.storage.local_copy(video_analysis.source_file.name) as path:
+        yield path
+
+
+def analyze_capture(video_capture, sampler, writer, engine, names, on_progress=None):
+    """Run sampled frames through the batching engine, writing detections in frame order"""
+    in_flight = deque()
+    analyzed = 0
+    last_progress = time.monotonic()
+
+    def finish_oldest():
+        frame_index, time_ms, future = in_flight.popleft()
+        detections = extract_detections(future.result(), names)
+        record_detections(detections, 'video')
+        writer.write(frame_index, time_ms, detections)
+
+    for frame_index, time_ms, frame in sampler:
+        in_flight.append((frame_index, time_ms, engine.submit(frame, PRIORITY_BULK)))
+        analyzed += 1
+        # Enough frames in flight to fill batches, without buffering the video
+        while in_flight and (len(in_flight) >= settings.VIDEO_MAX_IN_FLIGHT or in_flight[0][2].done()):
+            finish_oldest()
+
+        if on_progress and time.monotonic() - last_progress >= settings.VIDEO_PROGRESS_INTERVAL:
+            on_progress(sampler.frames_read, analyzed)
+            last_progress = time.monotonic()
+
+    while in_flight:
+        finish_oldest()
+    return analyzed
+
+
+def process_video(video_analysis):
+    """Analyse a claimed VideoAnalysis job and record the outcome"""
+    video_capture = None
+    writer = None
+    started = time.monotonic()
+    try:
+        # The whole video is analysed by one pinned model version
+        with use_model(video_analysis.model_name or None) as loaded, video_source(video_analysis) as source:
+            if '://' in source:
+                # A stalled stream fails the read instead of blocking the worker forever
+                timeout_ms = int(settings.VIDEO_STREAM_TIMEOUT * 1000)
+                video_capture = cv2.VideoCapture(source, cv2.CAP_FFMPEG, [
+                    cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, timeout_ms, cv2.CAP_PROP_READ_TIMEOUT_MSEC, timeout_ms])
+            else:
+                video_capture = cv2.VideoCapture(source)
+            if not video_capture.isOpened():
+                raise Exception(f"Could not open video source {source}")
+
+            source_fps = video_capture.get(cv2.CAP_PROP_FPS) or None
+            stride = sampling_stride(source_fps, video_analysis.frame_stride, video_analysis.target_fps)
+            max_frames = int(video_analysis.max_seconds * (source_fps or 25)) if video_analysis.max_seconds else None
+            sampler = FrameSampler(video_capture, stride, source_fps, max_frames)
+
+            video_analysis.source_fps = source_fps
+            video_analysis.frame_stride = stride
+            video_analysis.model_version = loaded.version or ''
+            video_analysis.detections_file = f'videos/detections/{video_analysis.id}.bin'
+            writer = DetectionWriter()
+            logger.info(f"Analysing video {video_analysis.id} at stride {stride} (source {source_fps} fps)")
+
+            def on_progress(frames_read, analyzed):
+                video_analysis.frames_decoded = frames_read
+                video_analysis.frames_analyzed = analyzed
+                video_analysis.detection_count = writer.count
+                # Also bumps updated_at, which keeps the job from being treated as stale
+                video_analysis.save(update_fields=['frames_decoded', 'frames_analyzed', 'detection_count', 'updated_at'])
+
+            analyzed = analyze_capture(video_capture, sampler, writer, loaded.engine, loaded.names, on_progress)
+        elapsed = time.monotonic() - started
+
+        video_analysis.frames_decoded = sampler.frames_read
+        video_analysis.frames_analyzed = analyzed
+        video_analysis.detection_count = writer.count
+        video_analysis.summary = {
+            'classes': dict(writer.class_counts),
+            'frames_with_detections': writer.frames_with_detections,
+            'elapsed_s': round(elapsed, 2),
+            'analyzed_fps': round(analyzed / elapsed, 2) if elapsed else 0.0,
+        }
+        video_analysis.status = VideoAnalysis.STATUS_DONE
+        video_analysis.error_message = ''
+        logger.info(f"Finished video {video_analysis.id}: {analyzed} frames, {writer.count} detections")
+    except Exception as e:
+        logger.error(f"Error analysing video {video_analysis.id}: {str(e)}")
+        video_analysis.status = VideoAnalysis.STATUS_FAILED
+        video_analysis.error_message = str(e)
+    finally:
+        if video_capture is not None:
+            video_capture.release()
+        if writer is not None:
+            # Partial results of a failed analysis are kept too
+            try:
+                writer.store(video_analysis.detections_file)
+            except Exception as e:
+                logger.error(f"Could not store detections of video {video_analysis.id}: {str(e)}")
+                video_analysis.status = VideoAnalysis.STATUS_FAILED
+                video_analysis.error_message = str(e)
+            writer.close()
+
+    video_analysis.processed_at = timezone.now()
+    video_analysis.save()
+    return video_analysis.status == VideoAnalysis.STATUS_DONE
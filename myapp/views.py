@@ -1,145 +1,115 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.core.files.storage import FileSystemStorage
-from ultralytics import YOLO
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.urls import reverse
 import os
 import cv2
 import json
+import hmac
+import time
+import hashlib
 import logging
+from datetime import datetime
+from functools import wraps
 from django.conf import settings
-from django.http import StreamingHttpResponse
-from .models import UploadedImage
+from django.http import HttpResponse, StreamingHttpResponse, JsonResponse
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.http import require_POST
+from django.db.models import Count
+from django.utils.dateparse import parse_date, parse_datetime
+from .models import UploadedImage, VideoAnalysis, Detection
+from .inference import (get_model, get_inference_engine, engine_stats, use_model, decode_image, encode_jpeg,
+                        save_detection)
+from .registry import registry
+from .tiling import MODES, detect_image
+from .gallery import gallery_page
+from .blobs import ORIGINALS, extension_of, put
+from .health import liveness, readiness
+from .metrics import collector, instrumented, stage, record_detections
+from .scheduler import PRIORITY_INTERACTIVE, PRIORITY_BULK, Overloaded, deadline_for, cpu_stats
+from .jobs import client_name, enqueue_upload
+from .bulk import iter_sources, stream_bulk_results
+from .uploads import get_content_hash, get_image_format, sniff_image, size_limit_message
+from .video import STREAM_SCHEMES, stream_url_allowed
+from .streaming import RelayedCamera, acquire_camera, release_camera, camera_stats, mjpeg_part
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
-# Load YOLO Model with better error handling
-model = None
-try:
-    if hasattr(settings, 'YOLO_MODEL_PATH') and os.path.exists(settings.YOLO_MODEL_PATH):
-        logger.info(f"Loading YOLO model from: {settings.YOLO_MODEL_PATH}")
-        model = YOLO(settings.YOLO_MODEL_PATH)
-        logger.info("YOLO model loaded successfully")
-    else:
-        logger.warning(f"YOLO model file not found at: {getattr(settings, 'YOLO_MODEL_PATH', 'Not specified')}")
-        # Try to download a default model
-        try:
-            logger.info("Attempting to download default YOLOv8n model...")
-            model = YOLO('yolov8n.pt')  # This will download the model if not present
-            logger.info("Default YOLOv8n model loaded successfully")
-        except Exception as download_error:
-            logger.error(f"Failed to download default model: {str(download_error)}")
-except Exception as e:
-    logger.error(f"Failed to load YOLO model: {str(e)}")
-    model = None
+def wants_json(request):
+    return 'application/json' in request.headers.get('Accept', '')
+
+def requested_model(request, form=True):
+    """Registry model named by a `model` query or form parameter ('' for the default model); see requested_mode"""
+    name = request.GET.get('model') or (form and request.POST.get('model')) or ''
+    if name and name not in settings.YOLO_MODELS:
+        raise ValueError(f'Unknown model {name!r}')
+    return name
+
+def requested_mode(request, form=True):
+    """
+    Detection mode named by a `mode` query or form parameter ('' for settings.INFERENCE_TILE_MODE).
+    form=False only looks at the query string, for views that must not read the body yet.
+    """
+    mode = request.GET.get('mode') or (form and request.POST.get('mode')) or ''
+    if mode and mode not in MODES:
+        raise ValueError(f"Unknown mode {mode!r}; use one of {', '.join(MODES)}")
+    return mode
 
 def index(request):
     return render(request, 'myapp/index.html')
 
+@instrumented('upload_file')
 def upload_file(request):
     if request.method == 'POST':
         try:
-            if model is None:
-                return render(request, 'myapp/upload_file.html', {'error': 'Model not loaded. Please contact administrator.'})
-
-            if 'file' not in request.FILES:
+            with stage('upload_read'):
+                # First access parses (and for large files spools) the multipart body
+                has_file = 'file' in request.FILES
+            if not has_file:
                 return render(request, 'myapp/upload_file.html', {'error': 'No file was uploaded'})
 
             uploaded_file = request.FILES['file']
             
-            # Validate file type
-            if not uploaded_file.content_type.startswith('image/'):
+            # Validate file type, by the declared type and the file's own leading bytes
+            if not uploaded_file.content_type.startswith('image/') or \
+                    not get_image_format(request, 'file', uploaded_file):
                 return render(request, 'myapp/upload_file.html', {'error': 'Only image files are allowed'})
             
-            # Validate file size (10MB limit)
-            if uploaded_file.size > 10 * 1024 * 1024:  # 10MB in bytes
-                return render(request, 'myapp/upload_file.html', {'error': 'File size exceeds 10MB limit'})
-
-            # Create new UploadedImage instance
-            uploaded_image = UploadedImage(original_image=uploaded_file)
-            uploaded_image.save()
-            logger.info(f"Saved original image with ID: {uploaded_image.id}")
+            # Validate file size (UPLOAD_MAX_IMAGE_SIZE, 10MB by default)
+            if uploaded_file.size > settings.UPLOAD_MAX_IMAGE_SIZE:
+                return render(request, 'myapp/upload_file.html', {'error': size_limit_message()})
 
             try:
-                # Set up output directory for this specific upload
-                output_dir = os.path.join(settings.MEDIA_ROOT, 'outputs', str(uploaded_image.id))
-                
-                # Clean up any existing files for this upload
-                if os.path.exists(output_dir):
-                    for root, dirs, files in os.walk(output_dir, topdown=False):
-                        for name in files:
-                            os.remove(os.path.join(root, name))
-                        for name in dirs:
-                            os.rmdir(os.path.join(root, name))
-                    os.rmdir(output_dir)
-                
-                # Create fresh output directory
-                os.makedirs(output_dir, exist_ok=True)
-                logger.info(f"Created output directory at {output_dir}")
-
-                # Run prediction
-                input_path = uploaded_image.original_image.path
-                logger.info(f"Running prediction on image at: {input_path}")
-                results = model.predict(source=input_path, save=True, project=output_dir)
-                if not results:
-                    raise Exception("No detection results generated")
-                logger.info("Successfully ran YOLO prediction")
-
-                # Process detection results
-                detection_results = []
-                for result in results:
-                    for box, conf, cls in zip(result.boxes.xyxy, result.boxes.conf, result.boxes.cls):
-                        detection_results.append({
-                            'class': model.names[int(cls)],
-                            'confidence': float(conf),
-                            'box': box.tolist()
-                        })
-                uploaded_image.detection_results = detection_results
-                logger.info(f"Processed detection results: {len(detection_results)} detections found")
-
-                # Find the processed image
-                predict_dir = os.path.join(output_dir, 'predict')
-                if not os.path.exists(predict_dir):
-                    logger.error(f"Predict directory not found at {predict_dir}")
-                    raise Exception("Output directory not found after processing")
-
-                # Get the first output image
-                output_files = [f for f in os.listdir(predict_dir) if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
-                if not output_files:
-                    logger.error("No output image files found in predict directory")
-                    raise Exception("No output image was generated")
-
-                # Save the processed image path
-                output_filename = output_files[0]
-                relative_path = os.path.join('outputs', str(uploaded_image.id), 'predict', output_filename)
-                uploaded_image.processed_image = relative_path
-                uploaded_image.save()
-                logger.info(f"Saved processed image path: {relative_path}")
-
-                # Ensure the file exists before returning
-                full_path = os.path.join(settings.MEDIA_ROOT, relative_path)
-                if not os.path.exists(full_path):
-                    logger.error(f"Processed image file not found at: {full_path}")
-                    raise Exception("Processed image file not found after saving")
-
-                logger.info(f"Found processed image at {full_path}")
-
-                # Get the URLs for both images
-                input_url = uploaded_image.original_image.url
-                output_url = uploaded_image.processed_image_url
-                logger.info(f"Input URL: {input_url}")
-                logger.info(f"Output URL: {output_url}")
-
-                # Return the response with the processed image
-                return render(request, 'myapp/upload_file.html', {
-                    'success': 'File uploaded and processed successfully',
-                    'input_file': input_url,
-                    'output_file': output_url
-                })
-
-            except Exception as e:
-                logger.error(f"Error in YOLO processing: {str(e)}")
-                uploaded_image.delete()
-                return render(request, 'myapp/upload_file.html', {'error': f'Failed to process image: {str(e)}'})
+                model_name = requested_model(request)
+                inference_mode = requested_mode(request)
+            except ValueError as e:
+                return render(request, 'myapp/upload_file.html', {'error': str(e)})
+
+            # Save the upload as a pending job; inference runs in the worker pool
+            content_hash = get_content_hash(request, 'file', uploaded_file)
+            with stage('enqueue'):
+                uploaded_image = enqueue_upload(uploaded_file, content_hash=content_hash, model_name=model_name,
+                                                inference_mode=inference_mode)
+            status_url = reverse('job_status', args=[uploaded_image.id])
+
+            if wants_json(request):
+                return JsonResponse({
+                    'job_id': uploaded_image.id,
+                    'status': uploaded_image.status,
+                    'status_url': status_url,
+                    'gallery_url': reverse('list_files'),
+                }, status=202)
+
+            if uploaded_image.is_finished:
+                message = 'File uploaded. This image was already processed, so the earlier results were reused.'
+            else:
+                message = f'File uploaded. Detection job #{uploaded_image.id} is queued and will appear in the gallery when done.'
+            return render(request, 'myapp/upload_file.html', {
+                'success': message,
+                'job_id': uploaded_image.id,
+                'job_status_url': status_url,
+            })
 
         except Exception as e:
             logger.error(f"Error processing upload: {str(e)}")
@@ -147,123 +117,411 @@ def upload_file(request):
 
     return render(request, 'myapp/upload_file.html')
 
+@csrf_exempt
+@require_POST
+@instrumented('bulk_upload')
+def bulk_upload(request):
+    # Machine-facing ingestion endpoint: many `files` (images and/or ZIP archives) in, NDJSON out.
+    # The model comes from the query string only, so an overloaded server refuses the request
+    # before the uploads are read and spooled to disk.
+    try:
+        model_name = requested_model(request, form=False)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    engine = get_inference_engine(model_name)
+    if engine is None:
+        return JsonResponse({'error': 'Model not loaded. Please contact administrator.'}, status=503)
+    # Refuse the whole request up front rather than failing its images one by one
+    try:
+        engine.admit(PRIORITY_BULK, deadline_for(PRIORITY_BULK))
+    except Overloaded as e:
+        response = JsonResponse({'error': str(e)}, status=503)
+        response['Retry-After'] = str(e.retry_after)
+        return response
+    if not request.FILES.getlist('files'):
+        return JsonResponse({'error': 'No files were uploaded'}, status=400)
+
+    response = StreamingHttpResponse(stream_bulk_results(iter_sources(request), model_name),
+                                     content_type='application/x-ndjson')
+    response['X-Accel-Buffering'] = 'no'  # let proxies pass each line through as it is produced
+    return response
+
+API_IMAGE_CONTENT_TYPES = ('image/', 'application/octet-stream')
+
+def api_error(message, status):
+    response = HttpResponse(json.dumps({'error': message}, separators=(',', ':')), status=status, content_type='application/json')
+    # Skip Django's per-response 4xx/5xx warning; gateways may send many rejected requests
+    response._has_been_logged = True
+    return response
+
+def overloaded_error(overloaded):
+    response = api_error(str(overloaded), 503)
+    response['Retry-After'] = str(overloaded.retry_after)
+    return response
+
+@csrf_exempt
+@instrumented('api_detect')
+def api_detect(request):
+    # Reject bad requests from headers alone, before the body is read or the model is touched
+    if request.method != 'POST':
+        response = api_error('Method not allowed', 405)
+        response['Allow'] = 'POST'
+        return response
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        content_length = 0
+    if content_length <= 0:
+        return api_error('Empty request body', 400)
+    if content_length > settings.API_MAX_UPLOAD_SIZE:
+        return api_error('Image exceeds the upload size limit', 413)
+    is_multipart = request.content_type == 'multipart/form-data'
+    if not is_multipart and not request.content_type.startswith(API_IMAGE_CONTENT_TYPES):
+        return api_error('Send raw image bytes or multipart/form-data with a "file" field', 415)
+    # Parameters come from the query string only, so an overloaded server sheds the request
+    # before the body is read
+    model_name = request.GET.get('model', '')
+    if model_name and model_name not in settings.YOLO_MODELS:
+        return api_error(f'Unknown model {model_name!r}', 400)
+    try:
+        inference_mode = requested_mode(request, form=False)
+    except ValueError as e:
+        return api_error(str(e), 400)
+    engine = get_inference_engine(model_name)
+    if engine is None:
+        return api_error('Model not loaded', 503)
+    # Shed before reading and decoding the body if the queue is already too long
+    deadline = deadline_for(PRIORITY_INTERACTIVE)
+    try:
+        engine.admit(PRIORITY_INTERACTIVE, deadline)
+    except Overloaded as e:
+        return overloaded_error(e)
+
+    with stage('upload_read'):
+        if is_multipart:
+            uploaded_file = request.FILES.get('file')
+            data = uploaded_file.read() if uploaded_file is not None else None
+            filename = uploaded_file.name if uploaded_file is not None else ''
+        else:
+            data = request.body
+            # Named by the bytes' own format: raw uploads are often declared application/octet-stream
+            filename = f'api.{sniff_image(data[:16]) or "jpg"}'
+    if data is None:
+        return api_error('No file was uploaded', 400)
+
+    try:
+        with stage('decode'):
+            image = decode_image(data)
+    except ValueError as e:
+        return api_error(str(e), 400)
+
+    started = time.perf_counter()
+    try:
+        with use_model(model_name) as loaded, stage('inference'):
+            detections, tiling = detect_image(image, loaded, inference_mode, PRIORITY_INTERACTIVE, deadline)
+    except Overloaded as e:
+        return overloaded_error(e)
+    inference_ms = (time.perf_counter() - started) * 1000
+    record_detections(detections, 'api')
+
+    payload = {
+        'model': loaded.name,
+        'model_version': loaded.version,
+        'mode': tiling['mode'],
+        'tiles': tiling['tiles'],
+        'width': image.shape[1],
+        'height': image.shape[0],
+        'inference_ms': round(inference_ms, 2),
+        'detections': [
+            {
+                'class_id': detection['class_id'],
+                'class': detection['class'],
+                'confidence': round(detection['confidence'], 4),
+                'box': [round(coordinate, 1) for coordinate in detection['box']],
+            }
+            for detection in detections
+        ],
+    }
+
+    # Persisting the image and annotated output is opt-in for API callers
+    if request.GET.get('persist', '').lower() in ('1', 'true', 'yes'):
+        content_hash = hashlib.sha256(data).hexdigest()
+        uploaded_image = UploadedImage(
+            original_image=put(data, ORIGINALS, extension_of(filename), content_hash),
+            original_name=client_name(filename),
+            content_hash=content_hash,
+            model_name=model_name,
+            model_version=payload['model_version'] or '',
+            inference_mode=inference_mode,
+            status=UploadedImage.STATUS_PROCESSING,
+        )
+        with stage('db_save'):
+            uploaded_image.save()
+        save_detection(uploaded_image, image, detections)
+        uploaded_image.status = UploadedImage.STATUS_DONE
+        uploaded_image.processed_at = timezone.now()
+        with stage('db_save'):
+            uploaded_image.save()
+            uploaded_image.save_detections()
+        payload['id'] = uploaded_image.id
+        payload['processed_image_url'] = uploaded_image.processed_image_url
+
+    return HttpResponse(json.dumps(payload, separators=(',', ':')), content_type='application/json')
+
+def parse_time(value):
+    """Aware datetime from an ISO date or datetime query parameter"""
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f"Invalid date: {value}")
+        parsed = datetime.combine(day, datetime.min.time())
+    return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+def api_detections(request):
+    """
+    Count stored detections in the database, e.g.
+    /api/detections?class=no-helmet&min_confidence=0.8&since=2026-10-10
+    """
+    detections = Detection.objects.all()
+    try:
+        if request.GET.get('class'):
+            detections = detections.filter(class_name__in=request.GET.getlist('class'))
+        if request.GET.get('min_confidence'):
+            detections = detections.filter(confidence__gte=float(request.GET['min_confidence']))
+        if request.GET.get('since'):
+            detections = detections.filter(uploaded_at__gte=parse_time(request.GET['since']))
+        if request.GET.get('until'):
+            detections = detections.filter(uploaded_at__lt=parse_time(request.GET['until']))
+        limit = min(int(request.GET.get('limit', 100)), 1000)
+    except ValueError as e:
+        return api_error(str(e), 400)
+
+    by_class = detections.values('class_name').annotate(count=Count('id')).order_by('-count', 'class_name')
+    image_ids = (detections.order_by('-uploaded_at', '-image_id').values_list('image_id', flat=True)
+                 .distinct()[:limit])
+    return JsonResponse({
+        'detections': detections.count(),
+        'images': detections.values('image_id').distinct().count(),
+        'by_class': {row['class_name']: row['count'] for row in by_class},
+        'image_ids': list(image_ids),
+    })
+
+def parse_optional_float(value):
+    return float(value) if value not in (None, '') else None
+
+def has_video_api_token(request):
+    token = settings.VIDEO_API_TOKEN
+    header = request.headers.get('Authorization', '')
+    return bool(token) and hmac.compare_digest(header.encode(), f'Bearer {token}'.encode())
+
+def token_or_csrf(view):
+    """Let requests with the VIDEO_API_TOKEN bearer token through, CSRF-check all others"""
+    protected = csrf_protect(view)
+
+    def wrapper(request, *args, **kwargs):
+        if has_video_api_token(request):
+            return view(request, *args, **kwargs)
+        return protected(request, *args, **kwargs)
+    return csrf_exempt(wraps(view)(wrapper))
+
+@token_or_csrf
+@require_POST
+@instrumented('video_upload')
+def video_upload(request):
+    # Queue a video file (`file`) or stream URL (`url`) for sampled analysis by the inference workers
+    uploaded_file = request.FILES.get('file')
+    source_url = request.POST.get('url', '').strip()
+    if uploaded_file is None and not source_url:
+        return JsonResponse({'error': 'Send a video `file` or a stream `url`'}, status=400)
+    if uploaded_file is not None and not (uploaded_file.content_type or '').startswith('video/'):
+        return JsonResponse({'error': 'Only video files are allowed'}, status=400)
+    if uploaded_file is None and not source_url.lower().startswith(STREAM_SCHEMES):
+        return JsonResponse({'error': 'Stream URLs must use rtsp, rtsps, http or https'}, status=400)
+    if uploaded_file is None and not stream_url_allowed(source_url):
+        # The workers connect to whatever is queued, so only known camera hosts are accepted
+        return JsonResponse({'error': 'Stream host is not in VIDEO_ALLOWED_HOSTS'}, status=400)
+
+    try:
+        model_name = requested_model(request)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    try:
+        frame_stride = int(request.POST.get('stride') or 1)
+        target_fps = parse_optional_float(request.POST.get('fps'))
+        max_seconds = parse_optional_float(request.POST.get('max_seconds'))
+    except ValueError:
+        return JsonResponse({'error': 'stride, fps and max_seconds must be numbers'}, status=400)
+    if 'stride' not in request.POST and target_fps is None:
+        target_fps = settings.VIDEO_DEFAULT_TARGET_FPS
+    if uploaded_file is None and max_seconds is None:
+        # Live streams never end on their own
+        max_seconds = settings.VIDEO_STREAM_MAX_SECONDS
+
+    video_analysis = VideoAnalysis.objects.create(
+        source_file=uploaded_file,
+        source_url=source_url if uploaded_file is None else '',
+        frame_stride=max(1, frame_stride),
+        target_fps=target_fps,
+        max_seconds=max_seconds,
+        model_name=model_name,
+    )
+    logger.info(f"Queued video analysis {video_analysis.id}")
+    return JsonResponse({
+        'id': video_analysis.id,
+        'status': video_analysis.status,
+        'status_url': reverse('video_status', args=[video_analysis.id]),
+    }, status=202)
+
+def video_status(request, pk):
+    video_analysis = get_object_or_404(VideoAnalysis, pk=pk)
+    return JsonResponse({
+        'id': video_analysis.id,
+        'status': video_analysis.status,
+        'finished': video_analysis.is_finished,
+        'source_fps': video_analysis.source_fps,
+        'frame_stride': video_analysis.frame_stride,
+        'frames_decoded': video_analysis.frames_decoded,
+        'frames_analyzed': video_analysis.frames_analyzed,
+        'detection_count': video_analysis.detection_count,
+        'summary': video_analysis.summary,
+        'detections_url': default_storage.url(video_analysis.detections_file) if video_analysis.detections_file else None,
+        'error': video_analysis.error_message or None,
+    })
+
+def job_status(request, pk):
+    uploaded_image = get_object_or_404(UploadedImage, pk=pk)
+    return JsonResponse({
+        'job_id': uploaded_image.id,
+        'status': uploaded_image.status,
+        'finished': uploaded_image.is_finished,
+        'original_image_url': uploaded_image.original_image.url if uploaded_image.original_image else None,
+        'processed_image_url': uploaded_image.processed_image_url,
+        'detection_results': uploaded_image.detection_results,
+        'model': uploaded_image.model_name or 'default',
+        'model_version': uploaded_image.model_version or None,
+        'error': uploaded_image.error_message or None,
+    })
+
+def inference_stats(request):
+    stats = engine_stats()
+    return JsonResponse({
+        'pid': os.getpid(),
+        'engine_started': stats is not None,
+        'batching': stats,
+        'registry': registry.stats(),
+        'cpu': cpu_stats(),
+        'cameras': camera_stats(),
+    })
+
+def metrics(request):
+    # Prometheus scrape endpoint, merged over all web and inference worker processes
+    return HttpResponse(collector.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def health_live(request):
+    return JsonResponse(liveness())
+
+def health_ready(request):
+    # 503 until the default model is loaded and warmed up in this process, so probes keep traffic away
+    ready, report = readiness()
+    response = JsonResponse(report, status=200 if ready else 503)
+    # Probes poll this every few seconds; don't log each 503 during warm-up
+    response._has_been_logged = True
+    return response
+
 def list_files(request):
     try:
-        uploaded_images = UploadedImage.objects.all().order_by('-uploaded_at')
-        # Filter out images with missing files
-        valid_images = []
-        for image in uploaded_images:
-            try:
-                if image.original_image and os.path.exists(image.original_image.path):
-                    valid_images.append(image)
-                else:
-                    # Delete the record if the file is missing
-                    image.delete()
-            except Exception as e:
-                logger.error(f"Error checking image {image.id}: {str(e)}")
-                continue
-        
+        # Keyset pages; missing files are cleaned up by the background sweep (myapp/sweeper.py)
+        try:
+            uploaded_images, older_cursor, newer_cursor = gallery_page(
+                settings.GALLERY_PAGE_SIZE, before=request.GET.get('before'), after=request.GET.get('after'))
+        except ValueError:
+            return redirect('list_files')
+        if not uploaded_images and (request.GET.get('before') or request.GET.get('after')):
+            # Paged past the end (rows deleted meanwhile): start again from the newest
+            return redirect('list_files')
+
         return render(request, 'myapp/file_list.html', {
-            'uploaded_images': valid_images
+            'uploaded_images': uploaded_images,
+            'older_cursor': older_cursor,
+            'newer_cursor': newer_cursor,
         })
     except Exception as e:
         logger.error(f"Error listing files: {str(e)}")
         return render(request, 'myapp/file_list.html', {'error': f'Error listing files: {str(e)}'})
 
-def gen_frames():
+def open_camera():
+    """Open the first working local camera, or return None"""
     video_capture = None
-    try:
-        # Try different camera backends and indices
-        camera_backends = [
-            (0, cv2.CAP_DSHOW),    # DirectShow (Windows)
-            (0, cv2.CAP_V4L2),     # Video4Linux2 (Linux)
-            (0, cv2.CAP_ANY),      # Auto-detect backend
-            (1, cv2.CAP_ANY),      # Try camera index 1
-            (2, cv2.CAP_ANY),      # Try camera index 2
-        ]
-        
-        for camera_index, backend in camera_backends:
-            try:
-                logger.info(f"Trying camera index {camera_index} with backend {backend}")
-                video_capture = cv2.VideoCapture(camera_index, backend)
-                
-                if video_capture.isOpened():
-                    # Test if we can read a frame
-                    ret, test_frame = video_capture.read()
-                    if ret and test_frame is not None:
-                        logger.info(f"Successfully opened camera {camera_index} with backend {backend}")
-                        break
-                    else:
-                        video_capture.release()
-                        video_capture = None
+    # Try different camera backends and indices
+    camera_backends = [
+        (0, cv2.CAP_DSHOW),    # DirectShow (Windows)
+        (0, cv2.CAP_V4L2),     # Video4Linux2 (Linux)
+        (0, cv2.CAP_ANY),      # Auto-detect backend
+        (1, cv2.CAP_ANY),      # Try camera index 1
+        (2, cv2.CAP_ANY),      # Try camera index 2
+    ]
+
+    for camera_index, backend in camera_backends:
+        try:
+            logger.info(f"Trying camera index {camera_index} with backend {backend}")
+            video_capture = cv2.VideoCapture(camera_index, backend)
+
+            if video_capture.isOpened():
+                # Test if we can read a frame
+                ret, test_frame = video_capture.read()
+                if ret and test_frame is not None:
+                    logger.info(f"Successfully opened camera {camera_index} with backend {backend}")
+                    break
                 else:
-                    if video_capture:
-                        video_capture.release()
+                    video_capture.release()
                     video_capture = None
-            except Exception as e:
-                logger.warning(f"Failed to open camera {camera_index} with backend {backend}: {str(e)}")
+            else:
                 if video_capture:
                     video_capture.release()
                 video_capture = None
-                continue
-        
-        if video_capture is None or not video_capture.isOpened():
-            logger.error("Failed to open any camera")
-            # Generate a placeholder frame indicating no camera
-            placeholder_frame = generate_no_camera_frame()
-            while True:
-                _, buffer = cv2.imencode('.jpg', placeholder_frame)
-                frame = buffer.tobytes()
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-                import time
-                time.sleep(1)  # Update every second
-            return
-
-        # Set camera properties for better performance
-        video_capture.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-        video_capture.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-        video_capture.set(cv2.CAP_PROP_FPS, 30)
-
+        except Exception as e:
+            logger.warning(f"Failed to open camera {camera_index} with backend {backend}: {str(e)}")
+            if video_capture:
+                video_capture.release()
+            video_capture = None
+            continue
+
+    if video_capture is None or not video_capture.isOpened():
+        return None
+
+    # Set camera properties for better performance
+    video_capture.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
+    video_capture.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+    video_capture.set(cv2.CAP_PROP_FPS, 30)
+    return video_capture
+
+def gen_frames(source_key='camera', open_source=open_camera):
+    camera = None
+    try:
         while True:
-            success, frame = video_capture.read()
-            if not success:
-                logger.error("Failed to read frame from webcam")
+            # All viewers share one capture + inference pipeline per camera (relayed from the process that has it)
+            camera = acquire_camera(source_key, open_source)
+            if camera is None:
+                logger.error("Failed to open any camera")
+                # Generate a placeholder frame indicating no camera
+                frame = mjpeg_part(encode_jpeg(generate_no_camera_frame()))
+                while True:
+                    yield frame
+                    time.sleep(1)  # Update every second
+
+            yield from camera.frames()
+            relayed = isinstance(camera, RelayedCamera)
+            release_camera(camera)
+            camera = None
+            if not relayed:
                 break
-
-            try:
-                if model is not None:
-                    results = model(frame)
-                    for result in results:
-                        if result.boxes is not None and len(result.boxes) > 0:
-                            for box, conf, cls in zip(result.boxes.xyxy, result.boxes.conf, result.boxes.cls):
-                                x1, y1, x2, y2 = map(int, box[:4])
-                                class_name = model.names[int(cls)]
-                                confidence = round(float(conf), 2)
-
-                                if class_name == 'helmet' and confidence < 0.7:
-                                    class_name = 'no helmet'
-
-                                label = f'{class_name} {confidence}'
-                                cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                                cv2.putText(frame, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 2)
-                else:
-                    # Add text indicating model not loaded
-                    cv2.putText(frame, "YOLO Model Not Loaded", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
-
-                _, buffer = cv2.imencode('.jpg', frame)
-                frame = buffer.tobytes()
-
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-            except Exception as e:
-                logger.error(f"Error processing frame: {str(e)}")
-                continue
+            # The process we relayed from let go of the camera: take it over
     except Exception as e:
         logger.error(f"Error in gen_frames: {str(e)}")
     finally:
-        if video_capture is not None:
-            video_capture.release()
+        if camera is not None:
+            release_camera(camera)
 
 def generate_no_camera_frame():
     """Generate a placeholder frame when no camera is available"""
@@ -279,8 +537,9 @@ def generate_no_camera_frame():
     
     return frame
 
+@instrumented('webcam_prediction')
 def webcam_prediction(request):
-    if model is None:
+    if get_model() is None:
         return render(request, 'myapp/webcam_view.html', {'error': 'Model not loaded. Please contact administrator.'})
     return StreamingHttpResponse(gen_frames(), content_type='multipart/x-mixed-replace; boundary=frame')
 
@@ -12,8 +12,10 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
+import json
 from dotenv import load_dotenv
 import dj_database_url
+from django.core.exceptions import ImproperlyConfigured
 import whitenoise.middleware
 
 # Load environment variables
@@ -142,13 +144,32 @@ STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'static'),
 ]
 
-# Simplified static file serving with WhiteNoise
-STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
-
 # Media files
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Media storage (see myapp/storage.py): 'local' (MEDIA_ROOT) or 's3' (an S3-compatible bucket, needs boto3)
+MEDIA_STORAGE = os.getenv('MEDIA_STORAGE', 'local')
+MEDIA_S3_BUCKET = os.getenv('MEDIA_S3_BUCKET', '')
+MEDIA_S3_ENDPOINT_URL = os.getenv('MEDIA_S3_ENDPOINT_URL') or None  # e.g. http://minio:9000, unset for AWS
+MEDIA_S3_REGION = os.getenv('MEDIA_S3_REGION') or None
+MEDIA_S3_PREFIX = os.getenv('MEDIA_S3_PREFIX', '')  # key prefix inside the bucket
+MEDIA_S3_PUBLIC_URL = os.getenv('MEDIA_S3_PUBLIC_URL', '')  # public bucket or CDN base URL, '' = presigned URLs
+MEDIA_S3_URL_EXPIRY = int(os.getenv('MEDIA_S3_URL_EXPIRY', '3600'))  # seconds presigned URLs stay valid
+
+MEDIA_STORAGE_BACKENDS = {
+    'local': 'myapp.storage.LocalMediaStorage',
+    's3': 'myapp.storage.S3MediaStorage',
+}
+if MEDIA_STORAGE not in MEDIA_STORAGE_BACKENDS:
+    raise ImproperlyConfigured(
+        f"MEDIA_STORAGE={MEDIA_STORAGE!r} is not supported; use one of {', '.join(MEDIA_STORAGE_BACKENDS)}")
+STORAGES = {
+    'default': {'BACKEND': MEDIA_STORAGE_BACKENDS[MEDIA_STORAGE]},
+    # Simplified static file serving with WhiteNoise
+    'staticfiles': {'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage'},
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -156,10 +177,111 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # YOLO Model Configuration
 YOLO_MODEL_PATH = os.path.join(BASE_DIR, 'yolov8n.pt')
+# Runtime that serves the weights: torch, onnx or openvino (exported next to YOLO_MODEL_PATH by setup_model.py)
+YOLO_BACKEND = os.getenv('YOLO_BACKEND', 'torch')
+YOLO_BACKEND_AUTO_EXPORT = os.getenv('YOLO_BACKEND_AUTO_EXPORT', 'False') == 'True'  # export on first load if missing
+# Intra-op torch threads per forked web/inference worker process, 0 = usable CPUs (affinity, cgroup quota) / INFERENCE_CPU_SLOTS
+INFERENCE_TORCH_THREADS = int(os.getenv('INFERENCE_TORCH_THREADS', '0'))
+
+# Model registry: named models kept resident per process, e.g. one per site or PPE class set.
+# YOLO_EXTRA_MODELS is JSON like {"site-a": {"path": "/models/site_a.pt", "backend": "onnx"}}
+YOLO_MODELS = {
+    'default': {'path': YOLO_MODEL_PATH, 'backend': YOLO_BACKEND},
+    **json.loads(os.getenv('YOLO_EXTRA_MODELS', '{}')),
+}
+MODEL_MEMORY_BUDGET_MB = int(os.getenv('MODEL_MEMORY_BUDGET_MB', '1024'))  # least recently used models are unloaded beyond this
+MODEL_RELOAD_CHECK_INTERVAL = float(os.getenv('MODEL_RELOAD_CHECK_INTERVAL', '10'))  # seconds between weights-file checks, 0 disables hot reload
+
+# INT8 quantization guardrail (manage.py quantize_model)
+TRAINING_RESULTS_CSV = os.path.join(BASE_DIR, 'runs', 'detect', 'train', 'results.csv')  # training metrics for quantize_model --recorded-baseline
+QUANTIZATION_MAX_METRIC_DROP = float(os.getenv('QUANTIZATION_MAX_METRIC_DROP', '0.01'))  # max absolute mAP / recall loss
+
+# Inference job queue (see myapp/jobs.py)
+INFERENCE_WORKERS = int(os.getenv('INFERENCE_WORKERS', '2'))
+INFERENCE_POLL_INTERVAL = float(os.getenv('INFERENCE_POLL_INTERVAL', '1.0'))  # seconds
+INFERENCE_JOB_TIMEOUT = int(os.getenv('INFERENCE_JOB_TIMEOUT', '300'))  # seconds before a processing job is considered stale
+INFERENCE_MAX_ATTEMPTS = int(os.getenv('INFERENCE_MAX_ATTEMPTS', '3'))
+INFERENCE_WORKER_THREADS = int(os.getenv('INFERENCE_WORKER_THREADS', '4'))  # concurrent jobs per worker process
+INTEGRITY_SWEEP_INTERVAL = float(os.getenv('INTEGRITY_SWEEP_INTERVAL', '3600'))  # seconds between missing-file sweeps (see myapp/sweeper.py), 0 = off
+INTEGRITY_SWEEP_ROWS = int(os.getenv('INTEGRITY_SWEEP_ROWS', '5000'))  # uploads checked per sweep, continuing where the last one stopped, 0 = whole table
+
+# Media retention, enforced by manage.py sweep_storage (see myapp/sweeper.py)
+RETENTION_DAYS = float(os.getenv('RETENTION_DAYS', '0'))  # remove finished uploads older than this, 0 = keep forever
+MEDIA_QUOTA_MB = float(os.getenv('MEDIA_QUOTA_MB', '0'))  # cap on stored media (originals, outputs, thumbnails), oldest removed first, 0 = unlimited
+ORPHAN_GRACE_SECONDS = int(os.getenv('ORPHAN_GRACE_SECONDS', '3600'))  # unreferenced files younger than this are kept
+SWEEP_STATE_FILE = os.getenv('SWEEP_STATE_FILE', os.path.join(MEDIA_ROOT, '.sweep_state.json'))  # resume checkpoints
+
+# Gallery (see myapp/gallery.py)
+GALLERY_PAGE_SIZE = int(os.getenv('GALLERY_PAGE_SIZE', '24'))
+THUMBNAIL_WIDTHS = [int(width) for width in os.getenv('THUMBNAIL_WIDTHS', '320,960').split(',')]  # pixels (see myapp/thumbnails.py)
+THUMBNAIL_FORMAT = os.getenv('THUMBNAIL_FORMAT', 'webp')  # webp or jpeg (also used where OpenCV lacks WebP)
+THUMBNAIL_QUALITY = int(os.getenv('THUMBNAIL_QUALITY', '80'))
+
+# Micro-batching of concurrent predictions (see myapp/batching.py)
+INFERENCE_MAX_BATCH_SIZE = int(os.getenv('INFERENCE_MAX_BATCH_SIZE', '8'))
+INFERENCE_MAX_BATCH_WAIT_MS = float(os.getenv('INFERENCE_MAX_BATCH_WAIT_MS', '10'))
+
+# CPU-aware scheduling (see myapp/scheduler.py)
+INFERENCE_CPU_SLOTS = int(os.getenv('INFERENCE_CPU_SLOTS', '0'))  # processes running inference on this host, 0 = this server's workers
+INFERENCE_LIVE_DEADLINE = float(os.getenv('INFERENCE_LIVE_DEADLINE', '0.5'))  # seconds a webcam frame may queue before it is skipped
+INFERENCE_INTERACTIVE_DEADLINE = float(os.getenv('INFERENCE_INTERACTIVE_DEADLINE', '15'))  # seconds /api/detect may queue before a 503
+INFERENCE_BULK_DEADLINE = float(os.getenv('INFERENCE_BULK_DEADLINE', '60'))  # seconds a bulk image may queue, 0 = no limit
+
+# Adaptive tiling of high-resolution photos (see myapp/tiling.py)
+INFERENCE_IMGSZ = int(os.getenv('INFERENCE_IMGSZ', '640'))  # model input size the weights were trained at
+INFERENCE_TILE_MODE = os.getenv('INFERENCE_TILE_MODE', 'auto')  # auto, full, downscaled or tiled
+INFERENCE_TILE_THRESHOLD = int(os.getenv('INFERENCE_TILE_THRESHOLD', '2048'))  # long side (px) above which auto mode tiles
+INFERENCE_TILE_SIZE = int(os.getenv('INFERENCE_TILE_SIZE', '1280'))  # px
+INFERENCE_TILE_OVERLAP = float(os.getenv('INFERENCE_TILE_OVERLAP', '0.2'))  # fraction of a tile shared with its neighbour
+INFERENCE_TILE_NMS_IOU = float(os.getenv('INFERENCE_TILE_NMS_IOU', '0.5'))  # IoU at which cross-tile duplicates are merged
+
+# Warm-up before a worker (or a hot-reloaded model version) reports ready (see myapp/health.py)
+# Synthetic HxW inputs, each run at batch size 1 and INFERENCE_MAX_BATCH_SIZE
+INFERENCE_WARMUP_SHAPES = os.getenv('INFERENCE_WARMUP_SHAPES', f'{INFERENCE_IMGSZ}x{INFERENCE_IMGSZ},{INFERENCE_IMGSZ * 3 // 4}x{INFERENCE_IMGSZ}')
+
+# Bulk upload endpoint (see myapp/bulk.py)
+BULK_UPLOAD_MAX_FILES = int(os.getenv('BULK_UPLOAD_MAX_FILES', '5000'))  # images per request
+BULK_UPLOAD_MAX_IN_FLIGHT = int(os.getenv('BULK_UPLOAD_MAX_IN_FLIGHT', '16'))  # decoded images held in memory at once
+
+# Webcam tracking: run the detector every N frames (or on motion) and track boxes in between
+WEBCAM_DETECT_INTERVAL = int(os.getenv('WEBCAM_DETECT_INTERVAL', '5'))  # 1 = detect on every frame
+WEBCAM_MOTION_THRESHOLD = float(os.getenv('WEBCAM_MOTION_THRESHOLD', '12'))  # mean grey-level change that forces a detection, 0 disables
+WEBCAM_TRACKER_IOU_THRESHOLD = float(os.getenv('WEBCAM_TRACKER_IOU_THRESHOLD', '0.3'))
+WEBCAM_TRACKER_SMOOTHING = float(os.getenv('WEBCAM_TRACKER_SMOOTHING', '0.3'))  # weight of the newest detection in the per-track average
+WEBCAM_TRACKER_OPTICAL_FLOW = os.getenv('WEBCAM_TRACKER_OPTICAL_FLOW', 'False') == 'True'
+WEBCAM_LOCK_DIR = os.getenv('WEBCAM_LOCK_DIR', '/tmp/ppe_cameras')  # per-camera locks and latest frames: one process on the host opens a device, the others relay its frames, '' = off
+HELMET_CONFIDENCE_THRESHOLD = float(os.getenv('HELMET_CONFIDENCE_THRESHOLD', '0.7'))  # smoothed helmet score below this shows "no helmet"
+
+# Video file / stream analysis (see myapp/video.py)
+VIDEO_DEFAULT_TARGET_FPS = float(os.getenv('VIDEO_DEFAULT_TARGET_FPS', '5'))  # used when neither stride nor fps is given
+VIDEO_STREAM_MAX_SECONDS = float(os.getenv('VIDEO_STREAM_MAX_SECONDS', '3600'))  # default cap for live stream URLs
+VIDEO_MAX_IN_FLIGHT = int(os.getenv('VIDEO_MAX_IN_FLIGHT', '16'))  # sampled frames held in memory at once
+VIDEO_PROGRESS_INTERVAL = float(os.getenv('VIDEO_PROGRESS_INTERVAL', '5'))  # seconds between progress saves
+VIDEO_STREAM_TIMEOUT = float(os.getenv('VIDEO_STREAM_TIMEOUT', '30'))  # seconds a stream may take to open or deliver a frame
+VIDEO_ALLOWED_HOSTS = [host.strip() for host in os.getenv('VIDEO_ALLOWED_HOSTS', '').split(',') if host.strip()]  # stream URL hosts workers may connect to, empty = no stream URLs
+VIDEO_API_TOKEN = os.getenv('VIDEO_API_TOKEN', '')  # bearer token that lets API clients POST /videos/ without a CSRF token
+
+# Prometheus /metrics (see myapp/metrics.py): per-process snapshots merged across web and inference workers
+METRICS_DIR = os.getenv('METRICS_DIR', '/tmp/ppe_metrics')  # shared by all processes of a host, '' = this process only
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))  # seconds
+
+# JSON detection API (/api/detect)
+API_MAX_UPLOAD_SIZE = int(os.getenv('API_MAX_UPLOAD_SIZE', str(10 * 1024 * 1024)))  # bytes
+
+# Content-hash result cache (see myapp/cache.py)
+INFERENCE_RESULT_CACHE_SIZE = int(os.getenv('INFERENCE_RESULT_CACHE_SIZE', '1024'))  # entries per process
 
 # File Upload Settings
-FILE_UPLOAD_MAX_MEMORY_SIZE = 10485760  # 10MB
+# Larger uploads stream to a temporary file in FILE_UPLOAD_TEMP_DIR, then to media storage in chunks
+FILE_UPLOAD_MAX_MEMORY_SIZE = int(os.getenv('FILE_UPLOAD_MAX_MEMORY_SIZE', str(256 * 1024)))  # bytes
+FILE_UPLOAD_TEMP_DIR = os.getenv('FILE_UPLOAD_TEMP_DIR') or None  # None = the system temp directory
+UPLOAD_MAX_IMAGE_SIZE = int(os.getenv('UPLOAD_MAX_IMAGE_SIZE', str(10 * 1024 * 1024)))  # bytes per image file
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10485760  # 10MB
+FILE_UPLOAD_HANDLERS = [
+    'myapp.uploads.ContentHashUploadHandler',  # hashes uploads as they stream in
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
 
 # OpenCV and Camera settings
 # Disable OpenCV warnings for headless environments
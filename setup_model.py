@@ -60,6 +60,25 @@ def setup_yolo_model():
         logger.error(f"Failed to setup YOLO model: {str(e)}")
         return False
 
+def setup_backend():
+    """Export the weights for the configured YOLO_BACKEND and check the export actually runs"""
+    backend = getattr(settings, 'YOLO_BACKEND', 'torch')
+    if backend == 'torch':
+        return True
+    try:
+        from myapp.backends import export_backend, load_backend, validate_backend
+
+        if not backend.endswith('_int8'):
+            # INT8 models are only produced (and accuracy-checked) by manage.py quantize_model
+            export_backend(settings.YOLO_MODEL_PATH, backend)
+        model = load_backend(backend, settings.YOLO_MODEL_PATH)
+        validate_backend(model)
+        logger.info(f"{backend} backend exported and validated")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to set up {backend} backend: {str(e)}")
+        return False
+
 def setup_directories():
     """Create necessary directories"""
     try:
@@ -94,5 +113,9 @@ if __name__ == "__main__":
     # Setup YOLO model
     if not setup_yolo_model():
         sys.exit(1)
+
+    # Export for the configured inference backend
+    if not setup_backend():
+        sys.exit(1)
     
     logger.info("Setup completed successfully!")
@@ -0,0 +1,43 @@
+#!/bin/bash
+# Container entry point: start.sh [web|worker|all] (default: $PROCESS_TYPE, else all)
+#
+#   web     gunicorn only
+#   worker  the inference worker pool only (manage.py run_inference_workers)
+#   all     both, for single-container deploys; if either one exits the
+#           other is stopped too, so the container exits and gets restarted
+#           instead of serving uploads that nothing processes
+set -e
+
+role="${1:-${PROCESS_TYPE:-all}}"
+
+if [ "$role" = "worker" ]; then
+    echo "Starting inference workers..."
+    exec python manage.py run_inference_workers
+fi
+
+echo "Starting PPE Detection System..."
+python manage.py migrate
+python manage.py collectstatic --noinput
+# Database and media only: gunicorn loads and warms up the model once, before it forks workers
+python manage.py check_system --skip-model
+
+if [ "$role" = "web" ]; then
+    echo "Starting web server..."
+    exec gunicorn ppe_project.wsgi:application --config gunicorn.conf.py
+fi
+
+echo "Starting inference workers..."
+python manage.py run_inference_workers &
+worker_pid=$!
+echo "Starting web server..."
+gunicorn ppe_project.wsgi:application --config gunicorn.conf.py &
+web_pid=$!
+
+trap 'kill -TERM $worker_pid $web_pid 2>/dev/null' TERM INT
+set +e
+wait -n $worker_pid $web_pid
+status=$?
+echo "A process exited with status $status, stopping the container"
+kill -TERM $worker_pid $web_pid 2>/dev/null
+wait
+exit $status